@@ -0,0 +1,454 @@
+import os   # script for Python 3
+import sys
+import time
+import json
+import random
+import shutil
+import argparse
+import tempfile
+import subprocess
+import psutil  # pip install psutil
+try:
+    import resource  # (Linux & Mac only) CPU time of all finished child processes
+except ImportError:
+    resource = None
+
+#  "benchmark_scan_manager.py" executable script measures how well "elmer_scan_manager.py" uses a computer with
+#   different scheduling options (policies) WITHOUT Elmer: a stand-in "ElmerSolver" executable reproduces the RAM
+#   ramp-up, CPU usage, run time versus frequency & crashes of real simulation steps in seconds instead of hours.
+#
+#                               HOW TO USE:
+#
+#   1- This "benchmark_scan_manager.py" file needs to be next to "elmer_scan_manager.py".
+#   2- Linux (or Mac) only: the stand-in ElmerSolver is a Python script started by its shebang line.
+#   3- make sure you have Python 3.7 or newer to run this script.  & use "pip install psutil" to add required package.
+#   4- "run" this "benchmark_scan_manager.py" file with Python 3. Each policy (set of elmer_scan_manager.py options)
+#           scans a fresh project with the same stand-in steps & the results are printed as a table:
+#           - makespan: wall time until all steps are finished
+#           - peak RAM: biggest sum of RAM of all running stand-in ElmerSolver processes
+#           - utilisation: CPU time of all processes / (CPU cores * makespan)
+#           - idle core-seconds: CPU cores * makespan - CPU time of all processes
+#           - kills: steps killed by the manager (kill_processes_on_overload & watchdog), crashes: simulated crashes
+#   5- DONE
+#
+# Extra tips:
+#   1- policies_file=path reads the policies from a JSON list: [{"name": "my_policy", "options": {"ram_safety_factor":
+#           0.8, ...}}, ...]. The options are arguments of main() of "elmer_scan_manager.py".
+#   2- report_file=path saves all results as JSON. With baseline_file=path (a report_file of an earlier run) the script
+#           exits with an error if a policy got slower than the baseline by more than "tolerance" - for CI hosts.
+#   3- keep_files=True keeps the projects & the printouts of the manager (manager_log.txt) for fault-tracing.
+#   4- The script also exits with an error if a policy did not complete all steps (with crash_rate=0) - for example
+#           the "batch_4" policy checks that batches of steps (batch_max_steps) are solved.
+#
+#   made for Python 3.7+                            see license details at the end of the script.
+
+# hard-coded filenames:
+stand_in_env = 'ELMER_SCAN_BENCHMARK'  # environment variable with the JSON configuration of the stand-in ElmerSolver
+runs_file = 'stand_in_runs.jsonl'  # every start & end of a stand-in ElmerSolver (in the benchmark folder)
+# a minimal Scanning project (only the lines that elmer_scan_manager.py & the stand-in read are relevant):
+stand_in_sif = '''Header
+  Mesh DB "." "."
+End
+
+Simulation
+  Simulation Type = Scanning
+  Timestep intervals = 1
+  Output Intervals = 1
+  Post File = "case.vtu"
+  vtu: fileindex offset = Integer $npart - 1
+End
+
+Solver 1
+  Equation = Helmholtz Equation
+  Linear System Solver = Iterative
+  Linear System Residual Output = 10
+  Element = "p:2"
+End
+
+Solver 2
+  Procedure = "SaveData" "SaveScalars"
+  Filename = case_Frequency_$npart$.csv
+End
+
+Equation 1
+  Frequency = Variable time; Real MATC "f(tx - 1)"
+End
+
+Material 1
+  Sound speed = 343.0
+End
+'''
+# policies compared by default (options of main() of elmer_scan_manager.py on top of the common options):
+default_policies = [{'name': 'default', 'options': {}},
+                    {'name': 'isolated_cost_model', 'options': {'isolated_instances': True, 'use_cost_model': True}},
+                    {'name': 'ram_safety_0.8', 'options': {'ram_safety_factor': 0.8}},
+                    {'name': 'no_kill_on_overload', 'options': {'kill_processes_on_overload': False}},
+                    {'name': 'suspend_on_overload', 'options': {'overload_action': 'suspend'}},
+                    {'name': 'auto_set_max_instances', 'options': {'auto_set_max_instances': True}},
+                    {'name': 'batch_4', 'options': {'batch_max_steps': 4, 'batch_target_wall_time': 30}}]
+
+
+def create_cli():
+    # 1 parse command line input ----------------------------------------------------
+
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument(
+        "--policies_file", default='', type=str,
+        help="Optional JSON file with the policies to compare. Empty string = the built-in default_policies.")
+    parser.add_argument(
+        "--steps", default='24', type=int,
+        help="Number of frequency steps of the benchmark project.")
+    parser.add_argument(
+        "--min_frequency", default='20', type=float,
+        help="Frequency of the first step in Hz (the steps are spread evenly up to max_frequency).")
+    parser.add_argument(
+        "--max_frequency", default='2000', type=float,
+        help="Frequency of the last step in Hz.")
+    parser.add_argument(
+        "--seconds_min", default='1', type=float,
+        help="Run time of a stand-in step at min_frequency (seconds).")
+    parser.add_argument(
+        "--seconds_max", default='8', type=float,
+        help="Run time of a stand-in step at max_frequency (seconds).")
+    parser.add_argument(
+        "--time_exponent", default='2', type=float,
+        help="Shape of the run time versus frequency curve (1 = linear, 2 = quadratic ...).")
+    parser.add_argument(
+        "--ram_mb_min", default='100', type=float,
+        help="Peak RAM of a stand-in step at min_frequency (MB).")
+    parser.add_argument(
+        "--ram_mb_max", default='600', type=float,
+        help="Peak RAM of a stand-in step at max_frequency (MB).")
+    parser.add_argument(
+        "--ram_exponent", default='1', type=float,
+        help="Shape of the peak RAM versus frequency curve.")
+    parser.add_argument(
+        "--ramp_seconds", default='1', type=float,
+        help="Time in which a stand-in step allocates its peak RAM (like ElmerSolver reading the mesh & assembling).")
+    parser.add_argument(
+        "--cpu_load", default='1', type=float,
+        help="Share of one CPU core that a running stand-in step uses (0 - 1).")
+    parser.add_argument(
+        "--crash_rate", default='0', type=float,
+        help="Probability that a launch of a stand-in step crashes (exits without results) halfway.")
+    parser.add_argument(
+        "--seed", default='1', type=int,
+        help="Seed of the simulated crashes (the same seed gives the same crashes for every policy).")
+    parser.add_argument(
+        "--max_instances", default='0', type=int,
+        help="max_instances of the policies without auto_set_max_instances. 0 = number of CPU cores.")
+    parser.add_argument(
+        "--sec_to_initialize", default='2', type=float,
+        help="sec_to_initialize of the policies (elmer_scan_manager.py default is 7 s for real ElmerSolver).")
+    parser.add_argument(
+        "--report_file", default='', type=str,
+        help="Optional JSON file to save the results of all policies.")
+    parser.add_argument(
+        "--baseline_file", default='', type=str,
+        help="Optional report_file of an earlier run: fail if a policy got slower than in the baseline.")
+    parser.add_argument(
+        "--tolerance", default='0.15', type=float,
+        help="Allowed relative increase of the makespan compared to baseline_file.")
+    parser.add_argument(
+        "--keep_files", default='False', choices=('True', 'False'), type=str,
+        help="Keep the benchmark folder with projects & printouts of the manager.")
+
+    args = vars(parser.parse_args())
+    return args
+
+
+# END create_cli
+
+
+def main(policies_file='', steps=24, min_frequency=20, max_frequency=2000, seconds_min=1, seconds_max=8,
+         time_exponent=2, ram_mb_min=100, ram_mb_max=600, ram_exponent=1, ramp_seconds=1, cpu_load=1, crash_rate=0,
+         seed=1, max_instances=0, sec_to_initialize=2, report_file='', baseline_file='', tolerance=0.15,
+         keep_files=False):
+    keep_files = str(keep_files) == 'True'
+    if os.name == 'nt':
+        print('ERROR - the stand-in ElmerSolver needs Linux or Mac (it is a Python script with a shebang line)')
+        raise Exception("not ok to continue")
+
+    policies = default_policies
+    if policies_file != '':
+        with open(policies_file, 'r') as contents:
+            policies = json.load(contents)
+    if max_instances <= 0:
+        max_instances = psutil.cpu_count() or 1
+    common_options = {'auto_set_max_instances': False, 'max_instances': max_instances,
+                      'sec_to_initialize': sec_to_initialize, 'journal': True}
+    stand_in = {'min_frequency': min_frequency, 'max_frequency': max_frequency, 'seconds_min': seconds_min,
+                'seconds_max': seconds_max, 'time_exponent': time_exponent, 'ram_mb_min': ram_mb_min,
+                'ram_mb_max': ram_mb_max, 'ram_exponent': ram_exponent, 'ramp_seconds': ramp_seconds,
+                'cpu_load': cpu_load, 'crash_rate': crash_rate, 'seed': seed}
+    frequencies = [round(min_frequency + (max_frequency - min_frequency) * index / max(1, steps - 1), 3)
+                   for index in range(steps)]
+
+    benchmark_dir = tempfile.mkdtemp(prefix='elmer_scan_benchmark_')
+    bin_dir = make_stand_in_solver(benchmark_dir)
+    print('--- benchmark of', str(len(policies)), 'policies with', str(steps), 'stand-in steps on',
+          str(psutil.cpu_count()), 'CPU cores,', str(round(psutil.virtual_memory().total / 1073741824, 1)),
+          'GB RAM   (in ' + benchmark_dir + ')')
+
+    results = []
+    for policy in policies:
+        options = dict(common_options)
+        options.update(policy['options'])
+        print('   running policy "' + policy['name'] + '" ...')
+        results.append(run_policy(os.path.join(benchmark_dir, policy['name']), bin_dir, frequencies, stand_in,
+                                  options))
+        results[-1]['name'] = policy['name']
+        results[-1]['options'] = options
+
+    print_report(results)
+    # (without simulated crashes every policy has to complete all steps - otherwise it measured failures)
+    failures = [result['name'] for result in results if result['exit_code'] != 0 or
+                (crash_rate == 0 and result['completed'] < result['steps'])]
+    if report_file != '':
+        with open(report_file, 'w') as text_file:
+            json.dump({'stand_in': stand_in, 'steps': steps, 'results': results}, text_file, indent=1)
+    if not keep_files:
+        shutil.rmtree(benchmark_dir, ignore_errors=True)
+
+    if len(failures) > 0:
+        print('ERROR - not all steps were completed by the policies: ' + ', '.join(failures) +
+              ' (see manager_log.txt with keep_files=True)')
+        sys.exit(1)
+    if baseline_file != '':
+        regressions = compare_to_baseline(results, baseline_file, tolerance)
+        if len(regressions) > 0:
+            for regression in regressions:
+                print('REGRESSION - ' + regression)
+            sys.exit(1)
+        print('--- no regressions compared to', baseline_file)
+
+
+# END main
+
+
+# function to create the stand-in "ElmerSolver" executable (runs "stand_in_solver" of this script). Returns its folder.
+def make_stand_in_solver(benchmark_dir):
+    bin_dir = os.path.join(benchmark_dir, 'bin')
+    os.makedirs(bin_dir)
+    with open(os.path.join(bin_dir, 'ElmerSolver'), 'w') as text_file:
+        text_file.write('#!' + sys.executable + '\nimport sys\nsys.path.insert(0, ' +
+                        repr(os.path.dirname(os.path.realpath(__file__))) +
+                        ')\nimport benchmark_scan_manager\nbenchmark_scan_manager.stand_in_solver()\n')
+    os.chmod(os.path.join(bin_dir, 'ElmerSolver'), 0o755)
+    return bin_dir
+
+
+# END make_stand_in_solver
+
+
+# function (the stand-in ElmerSolver) to simulate all Scanning timesteps of the case.sif in the working folder: RAM
+# grows to its peak during ramp_seconds, CPU is busy for "cpu_load" of the time, residuals are printed like Elmer does
+# & the same result files are written ("case_tNNNN.vtu" + "case_frequency_N.csv" with one row per timestep)
+def stand_in_solver():
+    config = json.loads(os.environ[stand_in_env])
+    with open('ELMERSOLVER_STARTINFO', 'r') as contents:
+        sif_name = contents.read().split()[0]
+    npart = 1
+    frequencies = []
+    with open(sif_name, 'r') as contents:
+        for line in contents.read().split('\n'):
+            if line.replace(' ', '').startswith('$npart='):
+                npart = int(line.split('=')[1].split()[0])
+            elif line.replace(' ', '').startswith('$f='):  # "$f = 56.7" OR "$f = [56.7 60.1]" (batch of steps)
+                frequencies = [float(value) for value in line.split('=')[1].split('!')[0].strip().strip('[]').split()]
+
+    # the same crashes for every policy: decided by seed, step & attempt (count of earlier launches of the step).
+    # There are no crashes before the first step is completed (elmer_scan_manager.py stops if the first steps fail).
+    runs = []
+    if os.path.isfile(os.path.join(config['runs_dir'], runs_file)):
+        with open(os.path.join(config['runs_dir'], runs_file), 'r') as contents:
+            runs = [json.loads(line) for line in contents]
+    attempt = sum(1 for run in runs if run['event'] == 'start' and run['step'] == npart)
+    crash = random.Random(str(config['seed']) + ' ' + str(npart) + ' ' + str(attempt)).random() < \
+        config['crash_rate'] and any(run['event'] == 'end' for run in runs)
+    record_stand_in_run(config, {'event': 'start', 'step': npart, 'pid': os.getpid()})
+
+    rows = []
+    memory = bytearray(0)
+    for index, frequency in enumerate(frequencies):
+        share = (frequency - config['min_frequency']) / max(1e-9, config['max_frequency'] - config['min_frequency'])
+        share = min(1.0, max(0.0, share))
+        run_time = config['seconds_min'] + (config['seconds_max'] - config['seconds_min']) * \
+            share ** config['time_exponent']
+        peak_mb = config['ram_mb_min'] + (config['ram_mb_max'] - config['ram_mb_min']) * share ** config['ram_exponent']
+        start_time = time.time()
+        iteration = 0
+        while time.time() - start_time < run_time:
+            elapsed = time.time() - start_time
+            target = int(peak_mb * 1048576 * min(1.0, elapsed / max(1e-9, config['ramp_seconds'])))
+            if len(memory) < target:
+                memory.extend(bytes(target - len(memory)))  # (copied = written memory = resident RAM)
+            if crash and elapsed > run_time / 2:
+                print('ERROR:: stand-in ElmerSolver crashed (simulated)')
+                record_stand_in_run(config, {'event': 'crash', 'step': npart, 'pid': os.getpid(),
+                                             'cpu_time': round(sum(os.times()[:2]), 2)})
+                sys.exit(1)
+            busy_until = time.time() + 0.01 * config['cpu_load']
+            while time.time() < busy_until:
+                pass
+            time.sleep(0.01 * (1 - config['cpu_load']))
+            iteration += 1
+            if iteration % 10 == 0:  # "Linear System Residual Output = 10"
+                print('      ' + str(iteration) + '  ' + '%.4E' % (10.0 ** (-elapsed * 10 / run_time)))
+        memory = bytearray(0)
+        with open(post_file_name(npart + index), 'w') as text_file:
+            text_file.write('stand-in result')
+        rows.append(str(frequency) + ' ' + str(share) + '\n')
+    with open('case_frequency_' + str(npart) + '.csv.names', 'w') as text_file:
+        text_file.write('Variables in columns of matrix: case_frequency_' + str(npart) + '.csv\n   1: time\n'
+                        '   2: res: stand-in value\n')
+    with open('case_frequency_' + str(npart) + '.csv', 'w') as text_file:
+        text_file.writelines(rows)
+    record_stand_in_run(config, {'event': 'end', 'step': npart, 'pid': os.getpid(),
+                                 'cpu_time': round(sum(os.times()[:2]), 2)})
+
+
+# END stand_in_solver
+
+
+# function to get the name of the .vtu result file of a step (as written by Elmer with "vtu: fileindex offset")
+def post_file_name(step):
+    return 'case_t' + str(step).zfill(4) + '.vtu'
+
+
+# END post_file_name
+
+
+# function to append one start / end / crash of a stand-in ElmerSolver to the runs file of the benchmark
+def record_stand_in_run(config, record):
+    record['time'] = round(time.time(), 3)
+    with open(os.path.join(config['runs_dir'], runs_file), 'a') as text_file:
+        text_file.write(json.dumps(record) + '\n')
+
+
+# END record_stand_in_run
+
+
+# function to scan a fresh benchmark project with elmer_scan_manager.py (in its own Python process) & measure it
+def run_policy(policy_dir, bin_dir, frequencies, stand_in, options):
+    project = os.path.join(policy_dir, 'project')
+    os.makedirs(project)
+    with open(os.path.join(project, 'Scanning_case.sif'), 'w') as text_file:
+        text_file.write(stand_in_sif)
+    with open(os.path.join(project, 'Scanning_FREQUNCIES.txt'), 'w') as text_file:
+        text_file.write(''.join(str(frequency) + '\n' for frequency in frequencies))
+    with open(os.path.join(project, 'mesh.elements'), 'w') as text_file:
+        text_file.write('')
+    with open(os.path.join(project, 'mesh.header'), 'w') as text_file:
+        text_file.write('1000 5000 0\n')  # (nodes & elements for the cost model of elmer_scan_manager.py)
+
+    config = dict(stand_in)
+    config['runs_dir'] = policy_dir
+    environment = dict(os.environ)
+    environment[stand_in_env] = json.dumps(config)
+    environment['PATH'] = bin_dir + os.pathsep + environment.get('PATH', '')
+    options = dict(options)
+    options['start_path'] = project
+    command = [sys.executable, '-c', 'import sys\nsys.path.insert(0, ' +
+               repr(os.path.dirname(os.path.realpath(__file__))) + ')\nimport elmer_scan_manager\n' +
+               'elmer_scan_manager.main(**' + repr(options) + ')']
+
+    cores = psutil.cpu_count() or 1
+    cpu_before = sum(resource.getrusage(resource.RUSAGE_CHILDREN)[:2]) if resource is not None else 0.0
+    with open(os.path.join(policy_dir, 'manager_log.txt'), 'w') as log_file_handle:
+        start_time = time.time()
+        manager = subprocess.Popen(command, stdout=log_file_handle, stderr=subprocess.STDOUT,
+                                   stdin=subprocess.DEVNULL, env=environment)
+        peak_ram = 0
+        measured_cpu = {}  # pid: CPU time (fallback without "resource")
+        while manager.poll() is None:
+            # noinspection PyBroadException
+            try:
+                solvers = [prc for prc in psutil.Process(manager.pid).children(recursive=True)]
+                ram = 0
+                for prc in solvers:
+                    with prc.oneshot():
+                        ram += prc.memory_info().rss
+                        measured_cpu[prc.pid] = sum(prc.cpu_times()[:2])
+                peak_ram = max(peak_ram, ram)
+            except BaseException:
+                pass  # processes exit while they are measured
+            time.sleep(0.1)
+        makespan = time.time() - start_time
+    if resource is not None:  # (the manager waited for all its ElmerSolver processes: their CPU time is included)
+        cpu_time = sum(resource.getrusage(resource.RUSAGE_CHILDREN)[:2]) - cpu_before
+    else:
+        cpu_time = sum(measured_cpu.values())
+
+    kills = 0
+    journal_path = os.path.join(project, 'scan_journal.jsonl')
+    if os.path.isfile(journal_path):
+        with open(journal_path, 'r') as contents:
+            kills = sum(1 for line in contents if json.loads(line)['event'] in ('kill', 'watchdog'))
+    launches = 0
+    crashes = 0
+    if os.path.isfile(os.path.join(policy_dir, runs_file)):
+        with open(os.path.join(policy_dir, runs_file), 'r') as contents:
+            for line in contents:
+                launches += json.loads(line)['event'] == 'start'
+                crashes += json.loads(line)['event'] == 'crash'
+    completed = sum(1 for a_file in os.listdir(project)
+                    if a_file.startswith('case_frequency_') and a_file.endswith('.csv'))
+
+    return {'exit_code': manager.returncode, 'makespan': round(makespan, 2),
+            'peak_ram_gb': round(peak_ram / 1073741824, 3), 'cpu_time': round(cpu_time, 2),
+            'utilisation': round(cpu_time / (cores * makespan), 3),
+            'idle_core_seconds': round(max(0.0, cores * makespan - cpu_time), 1), 'kills': kills,
+            'crashes': crashes, 'launches': launches, 'completed': completed, 'steps': len(frequencies)}
+
+
+# END run_policy
+
+
+# function to print the results of all policies as a table
+def print_report(results):
+    columns = [('name', 'policy'), ('makespan', 'makespan s'), ('peak_ram_gb', 'peak RAM GB'),
+               ('utilisation', 'utilisation'), ('idle_core_seconds', 'idle core-s'), ('kills', 'kills'),
+               ('crashes', 'crashes'), ('launches', 'launches'), ('completed', 'completed')]
+    widths = [max(len(title), max(len(str(result[key])) for result in results)) for key, title in columns]
+    print('')
+    print('  '.join(title.rjust(width) for (key, title), width in zip(columns, widths)))
+    for result in results:
+        print('  '.join(str(result[key]).rjust(width) for (key, title), width in zip(columns, widths)) +
+              ('' if result['exit_code'] == 0 else '   (manager exit code ' + str(result['exit_code']) + ')'))
+    print('')
+
+
+# END print_report
+
+
+# function to compare the results with a report_file of an earlier run. Returns a list of regression messages.
+def compare_to_baseline(results, baseline_file, tolerance):
+    with open(baseline_file, 'r') as contents:
+        baseline = dict((result['name'], result) for result in json.load(contents)['results'])
+    regressions = []
+    for result in results:
+        if result['name'] not in baseline:
+            continue
+        old = baseline[result['name']]
+        if result['completed'] < old['completed']:
+            regressions.append(result['name'] + ': ' + str(result['completed']) + ' steps completed (baseline ' +
+                               str(old['completed']) + ')')
+        if result['makespan'] > old['makespan'] * (1 + tolerance):
+            regressions.append(result['name'] + ': makespan ' + str(result['makespan']) + ' s (baseline ' +
+                               str(old['makespan']) + ' s)')
+        if result['kills'] > old['kills']:
+            regressions.append(result['name'] + ': ' + str(result['kills']) + ' kills (baseline ' +
+                               str(old['kills']) + ')')
+    return regressions
+
+
+# END compare_to_baseline
+
+
+if __name__ == '__main__':
+    main(**create_cli())
+# END __name__
+
+
+# licensed under the MIT license
@@ -1,41 +1,211 @@
 import subprocess   # script for Python 3
 import os
+import shutil
+import argparse
+import hashlib
+import concurrent.futures
 
-#  "convert_mesh_unv_to_elmer.py" executable script automatically converts ".unv" mesh to Elmer FEM "mesh." format.
-#   it reads .unv file named as specified in "Mesh_Filename_To_Convert" (usually 'FEMMesh' .unv).
+#  "convert_mesh_unv_to_elmer.py" executable script automatically converts ".unv" meshes to Elmer FEM "mesh." format.
+#   it finds all .unv files in the folder of the script (or in "start_path") and its sub-folders (usually 'FEMMesh.unv')
+#   and converts them in parallel. Meshes that did not change since the last conversion are skipped.
 
 #                               HOW TO USE:
 #
-#   1- This "convert_mesh_unv_to_elmer.py" file needs to be right next to the "FEMMesh.unv" to convert.
+#   1- This "convert_mesh_unv_to_elmer.py" file needs to be next to the "FEMMesh.unv" to convert OR one level above
+#           (or more) to convert the meshes of multiple projects at once.
 #   2- Windows only: It is recommended have Elmer added to PATH (an option during Elmer installation).
-#           Otherwise, it is necessary to enter full path to the ElmerGrid.exe as a "root_Elmer" variable.
-#   3- make sure you have Python 3.7 or newer to run this script.  & use "pip install psutil" to add required package.
+#           Otherwise, it is necessary to enter full path to the ElmerGrid.exe as a "root_elmer" variable.
+#   3- make sure you have Python 3.7 or newer to run this script.
 #   4- "run" this "convert_mesh_unv_to_elmer.py" file with Python 3.  DONE
-#           - output "FEMMesh" folder will contain all Elmer mesh related files.
-#           - Bonus_VTU_output: "FEMMesh.vtu" file for opening and slicing in ParaView.
+#           - output "FEMMesh" folder (next to each "FEMMesh.unv") will contain all Elmer mesh related files.
+#           - Bonus vtu_output: "FEMMesh.vtu" file for opening and slicing in ParaView.
+#           - Bonus partitions: "partitioning.N" sub-folders of the mesh for ElmerSolver_mpi runs with N partitions.
 #   5- DONE
 #
+# Extra tips:
+#   1- The hash of the converted .unv file is saved as "mesh_source_hash.txt" in the mesh folder. Delete it to force
+#           a new conversion.
+#   2- The functions can be imported (elmer_scan_manager.py uses them with convert_meshes=True).
+#
 #   made for Python 3.7+                            see license details at the end of the script.
 #       v1.00    2024-01-13     First version. Tested on Windows 11. (by Sergejs D.)
 #
 
-Mesh_Filename_To_Convert = 'FEMMesh'  # without file type extension.
-root_Elmer = ''   # keep empty string if Elmer is added to PATH. Otherwise, provide full path to ..\bin\!
-Bonus_VTU_output = False    # set to True  if you want
+# hard-coded filenames:
+mesh_hash_file = 'mesh_source_hash.txt'  # hash of the .unv file that the mesh folder was converted from
+if os.name == 'nt':  # Windows detected
+    elmergrid_executable = "ElmerGrid.exe"
+else:  # elif os.name == 'posix': # Linux or Mac detected
+    elmergrid_executable = "ElmerGrid"
+
+
+def create_cli():
+    # 1 parse command line input ----------------------------------------------------
+
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument(
+        "--start_path", default='False', type=str,
+        help=("Optional Search directory for .unv files (sub-folders are searched too). "
+              "If start_path='False' - .unv files are searched right next to this script OR in sub-folders."))
+    parser.add_argument(
+        "--root_elmer", default='', type=str,
+        help=("Optional full path to  Elmer bin folder in case ElmerGrid can not be found by filename alone. "
+              "The default empty string works great if Elmer was added to PATH during installation."))
+    parser.add_argument(
+        "--vtu_output", default='False', choices=('True', 'False'), type=str,
+        help="Also convert each .unv to .vtu for viewing the mesh in ParaView (fault-tracing).")
+    parser.add_argument(
+        "--partitions", default='', type=str,
+        help=("Optional comma separated numbers of partitions (for example '4,8') - the mesh is also partitioned "
+              "with METIS for ElmerSolver_mpi runs with that many partitions."))
+    parser.add_argument(
+        "--max_workers", default='0', type=int,
+        help="Number of ElmerGrid processes that run at the same time. 0 = number of CPU cores.")
+    parser.add_argument(
+        "--hold_window", default='True', choices=('True', 'False'), type=str,
+        help="Wait for Enter at the end (keeps the Windows command-line window open).")
+
+    args = vars(parser.parse_args())
+    return args
+
+
+# END create_cli
+
+
+def main(start_path='False', root_elmer='', vtu_output=False, partitions='', max_workers=0, hold_window=True):
+    vtu_output = str(vtu_output) == 'True'
+    hold_window = str(hold_window) == 'True'
+    partitions = [int(k) for k in str(partitions).replace(',', ' ').split()]
+
+    if start_path == 'False':
+        start_path = os.path.dirname(os.path.realpath(__file__))
+
+    unv_meshes = find_unv_meshes(start_path)
+    if len(unv_meshes) == 0:
+        print('ERROR - no .unv mesh files found in "' + start_path + '"')
+    else:
+        results = convert_meshes([(unv_path, '') for unv_path in unv_meshes], root_elmer, vtu_output, partitions,
+                                 max_workers)
+        print('\n-------READY - ' + str(sum(1 for result in results if result[1] != 'failed')) + '/' +
+              str(len(results)) + ' meshes converted or up to date (see output in the mesh folder next to each .unv)')
+
+    if hold_window:
+        # hold Windows command-line window open:
+        input('Hit >>> ENTER <<< to EXIT   ')
+
+
+# END main
+
+
+# function to find all .unv files in a folder & its sub-folders
+def find_unv_meshes(start_path):
+    unv_meshes = []
+    for folder, sub_folders, files in os.walk(start_path):
+        for a_file in files:
+            if a_file.lower().endswith('.unv'):
+                unv_meshes.append(os.path.join(folder, a_file))
+    return sorted(unv_meshes)
+
+
+# END find_unv_meshes
+
+
+# function to hash the content of a file (in blocks - mesh files can be big)
+def file_hash(file_path):
+    content_hash = hashlib.sha256()
+    with open(file_path, 'rb') as contents:
+        for block in iter(lambda: contents.read(1048576), b''):
+            content_hash.update(block)
+    return content_hash.hexdigest()
+
+
+# END file_hash
+
+
+# function to run ElmerGrid in the folder of the .unv file. Returns an error message ('' if all good).
+def run_elmergrid(arguments, working_dir, root_elmer):
+    completed = subprocess.run([os.path.join(root_elmer, elmergrid_executable)] + arguments, cwd=working_dir,
+                               stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    if completed.returncode != 0:
+        return 'ElmerGrid ' + ' '.join(arguments) + ' failed:\n' + completed.stdout.decode(errors='replace')[-2000:]
+    return ''
+
+
+# END run_elmergrid
+
+
+# function to convert one .unv mesh into an Elmer mesh folder (default: folder with the name of the .unv file) +
+# optional .vtu & METIS partitionings. Nothing is done for a mesh folder that was converted from the same .unv.
+# Returns (unv_path, 'converted' / 'up to date' / 'failed', error message)
+def convert_mesh(unv_path, output_dir='', root_elmer='', vtu_output=False, partitions=()):
+    working_dir, unv_name = os.path.split(os.path.abspath(unv_path))
+    mesh_name = os.path.splitext(unv_name)[0]
+    if output_dir == '':
+        output_dir = os.path.join(working_dir, mesh_name)
+    unv_hash = file_hash(unv_path)
+
+    previous_hash = ''
+    if os.path.isfile(os.path.join(output_dir, mesh_hash_file)):
+        with open(os.path.join(output_dir, mesh_hash_file), 'r') as contents:
+            previous_hash = contents.read().strip()
+    up_to_date = previous_hash == unv_hash and os.path.isfile(os.path.join(output_dir, 'mesh.header'))
+
+    if not up_to_date:
+        if os.path.isdir(output_dir):
+            for a_dir in os.listdir(output_dir):  # partitionings of the old mesh
+                if a_dir.startswith('partitioning.') and os.path.isdir(os.path.join(output_dir, a_dir)):
+                    shutil.rmtree(os.path.join(output_dir, a_dir), ignore_errors=True)
+            if os.path.isfile(os.path.join(output_dir, mesh_hash_file)):
+                os.remove(os.path.join(output_dir, mesh_hash_file))
+        # convert ".unv" mesh to Elmer FEM "mesh." format
+        error = run_elmergrid(['8', '2', unv_name, '-autoclean', '-out', output_dir], working_dir, root_elmer)
+        if error != '':
+            return unv_path, 'failed', error
+        with open(os.path.join(output_dir, mesh_hash_file), 'w') as text_file:
+            text_file.write(unv_hash + '\n')  # written last: the mesh folder is complete
+
+    if vtu_output and (not up_to_date or not os.path.isfile(os.path.join(working_dir, mesh_name + '.vtu'))):
+        # convert .unv to .vtu for viewing mesh in ParaView (fault-tracing)
+        error = run_elmergrid(['8', '5', unv_name, '-autoclean'], working_dir, root_elmer)
+        if error != '':
+            return unv_path, 'failed', error
+
+    for k in partitions:
+        if k > 1 and not os.path.isdir(os.path.join(output_dir, 'partitioning.' + str(k))):
+            error = run_elmergrid(['2', '2', output_dir, '-partdual', '-metiskway', str(k)], working_dir, root_elmer)
+            if error != '':
+                return unv_path, 'failed', error
+
+    return unv_path, 'up to date' if up_to_date else 'converted', ''
+
+
+# END convert_mesh
 
 
-# convert ".unv" mesh to Elmer FEM "mesh." format
-subprocess.call(os.path.join(root_Elmer, 'ElmerGrid 8 2 ' + Mesh_Filename_To_Convert + ' -autoclean'))
+# function to convert many meshes [(unv_path, output_dir), ...] in parallel. Every conversion is an ElmerGrid process,
+# so a pool of threads (each waiting for its own ElmerGrid) keeps max_workers CPU cores busy. Returns the results of
+# "convert_mesh" in the same order.
+def convert_meshes(jobs, root_elmer='', vtu_output=False, partitions=(), max_workers=0):
+    if max_workers <= 0:
+        max_workers = os.cpu_count() or 1
+    results = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(jobs)))) as pool:
+        futures = [pool.submit(convert_mesh, unv_path, output_dir, root_elmer, vtu_output, partitions)
+                   for unv_path, output_dir in jobs]
+        for future in futures:
+            results.append(future.result())
+            print('   mesh', results[-1][1] + ':', results[-1][0])
+            if results[-1][1] == 'failed':
+                print(results[-1][2])
+    return results
 
 
-if Bonus_VTU_output:
-    # convert .unv to .vtk for viewing mesh in ParaView (fault-tracing)
-    subprocess.call(os.path.join(root_Elmer, 'ElmerGrid 8 5 ' + Mesh_Filename_To_Convert + ' -autoclean'))
+# END convert_meshes
 
 
-# hold Windows command-line window open:
-print('\n-------READY - (see output in the new "' + Mesh_Filename_To_Convert + '" folder) ---------------------------')
-input('Hit >>> ENTER <<< to EXIT   ')
+if __name__ == '__main__':
+    main(**create_cli())
+# END __name__
 
 
 # Made for Elmer FEM   https://github.com/elmercsc/elmerfem
@@ -1,9 +1,28 @@
 import os
 import shutil
 import time
+import tempfile
 import argparse
 import psutil  # pip install psutil
 import subprocess
+import posixpath
+import queue
+import threading
+import csv
+import socket
+import json
+import sqlite3
+import hashlib
+import atexit
+import concurrent.futures
+import re
+import struct
+import zlib
+import math
+try:  # optional pre-stage (convert_meshes=True): "convert_mesh_unv_to_elmer.py" next to this script
+    import convert_mesh_unv_to_elmer
+except ImportError:
+    convert_mesh_unv_to_elmer = None
 
 #       ---  "psutil" is required !  https://github.com/giampaolo/psutil/blob/master/INSTALL.rst  ---
 
@@ -32,9 +51,62 @@ import subprocess
 #
 # Extra tips:
 #   1- It is not recommended to run multiple elmer_scan_manager.py scripts on the same computer (but it would work)
+#           UNLESS they are started with distributed=True: then any number of ElmerScanManagers (on one or multiple
+#           computers sharing the project folder) split the steps between them using "case_frequency_ .lease" files.
 #   2- avoid folder names with spaces. Code is not tested for that.
 #   3- To re-run any instance, just delete its "case_frequency_ .csv" file. That will tell elmer_scan_manager.py to
 #           re-simulate that frequency step (in case there was a problem).
+#   4- With isolated_instances=True each instance runs in its own "instance_step_ " folder inside the project.
+#           Results are moved into the project folder when the instance finishes (the "case_frequency_ .csv" last).
+#   5- Peak RAM, CPU & wall time of each completed step are recorded in "scan_cost_history.csv" of each project.
+#           They are used to predict RAM of the next steps (use_cost_model=True). Delete the file to forget the records.
+#   6- With journal=True every launch, exit (with exit code, times, peak RAM & linear solver iterations), kill &
+#           re-try of a step is appended to "scan_journal.jsonl" of its project. metrics_file=path writes the live
+#           status in Prometheus text format (for example for the textfile collector of node_exporter).
+#   7- With result_store=True SaveScalars values of all completed steps are collected in "scan_results.sqlite" of
+#           each project: table "results" with one row per step (step, frequency & one column per scalar named as in
+#           the .csv.names file).
+#           A whole frequency response is one query, for example with read_result_store() or any SQLite tool.
+#           In distributed mode the file is written once per project (by the manager that finishes it). The row of a
+#           re-run step (its "case_frequency_ .csv" was deleted or changed) is replaced.
+#   8- cache_dir=path keeps the results of every solved step in a (shared) cache folder, found by a hash of the .sif
+#           (without comments), the mesh files, the ElmerSolver executable & the frequency. Steps of copied projects or
+#           of overlapping sweeps are then restored (hard-linked) from the cache instead of being solved again.
+#           With isolated_instances=False the files are copied (ElmerSolver re-writes the results of a re-run step
+#           in place, a hard-linked cache entry would change with them).
+#   9- A "Scanning_SWEEP.txt" file in a project defines a parameter sweep: each row is a MATC variable of the .sif
+#           (for example "U" of "$ U = 10") followed by all values to scan. One "sweep_ " project folder per
+#           combination is generated inside the project (sharing its mesh) & all of them are run together. Values
+#           that would give the same folder name (for example "x/y" & "x:y") get a short hash of the values added.
+#   10- With adaptive_refinement=True a coarse "Scanning_FREQUNCIES.txt" is enough: steps are added (and appended to
+#           the file as "step frequency" rows) where the results of neighbouring frequencies change fast.
+#   11- With warm_start=True the solution of the nearest completed frequency is the initial guess of the linear solver
+#           (Elmer restart from "scan_restart" of the project). Steps run in chains of adjacent frequencies & the
+#           linear solver iterations of cold & warm started steps are reported per octave band.
+#   12- With autotune=True the "Solver 1" settings of each octave band are chosen by trial solves of its highest
+#           frequency with the candidate "tuning_profiles" (iterative & direct). Iterative trials stop after
+#           autotune_trial_iterations & their time to convergence is extrapolated from the residual decrease. The
+#           trials of all bands run in parallel on the free cores (while RAM allows). The winners are kept in
+#           "solver_tuning.json" of the mesh folder (delete it to tune again, for example after big .sif changes).
+#           Bands where no trial succeeded are tuned again on the next launch.
+#   13- With points_per_wavelength=N the element p-order of each step is chosen from its wavelength ("Sound speed" of
+#           the materials) & the element size of the mesh: low frequencies run with p:1, high ones with a higher order.
+#           Extra pre-converted meshes of the same geometry in sub-folders of the mesh folder are used where cheaper.
+#   14- On prolonged overload (kill_processes_on_overload=True) the last started instance is killed by default
+#           (overload_action='kill'). With overload_action='suspend' the least progressed instance (least CPU time) is
+#           paused on CPU overload instead: first its priority is lowered, then it is suspended & resumed where it
+#           stopped once CPU & RAM allow. On RAM overload the least progressed instance is killed right away (a paused
+#           instance keeps its RAM) & its step is re-tried later.
+#   15- With placement=True every instance runs on its own physical cores (CPU affinity, all cores of an instance on
+#           one NUMA node when possible) with OMP_NUM_THREADS & BLAS threads set to its number of cores. Big steps
+#           (fewer fit into RAM) get more threads, small steps run 1 thread each. Linux: the instances are started by
+#           numactl (its RAM is then bound to the NUMA node of its cores) OR by taskset if numactl is not installed.
+#   16- With scratch_dir=path (a local disk or tmpfs) the instance folders are created there instead of in the project
+#           folder. Mover threads ship the results of finished steps to the project folder (.vtu files re-encoded
+#           with zlib compression if compress_vtu=True, the "case_frequency_ .csv" last). No new steps are started
+#           while more than scratch_max_gb of results wait to be shipped.
+#   17- "extract_vtu_probes.py" extracts the SPL versus frequency at listening positions ("Scanning_PROBES.txt") from
+#           the .vtu files - also during the scan (follow=True): new steps are added as they complete.
 #   + It is recommended to re-launch ElmerScanManager after the simulation is finished. This way it will quickly
 #       re-check the status and either confirm 100% ready or attempt to re-launch some instances that did not complete.
 #
@@ -48,6 +120,68 @@ import subprocess
 #       v1.20    2024-01-21     added "kill_processes_on_overload" function + optimizations (by S. D.)
 version = 'v1.20'  # <<<  for printouts.
 
+# hard-coded filenames:
+main_frequencies_to_simulate = 'Scanning_FREQUNCIES.txt'  # each row contains one frequency value in [Hz]
+sweep_spec_file = 'Scanning_SWEEP.txt'  # optional: each row = MATC variable name of the .sif + all values to scan
+sweep_dir_prefix = 'sweep_'  # one generated project folder per combination of sweep values (inside the project)
+main_solver_input = 'Scanning_case.sif'  # used as the base for generating startup instructions into "generated_sif"
+generated_sif = 'case.sif'
+start_info_file = 'ELMERSOLVER_STARTINFO'
+post_file = 'case_t'
+freq_file = 'case_frequency_'
+freq_file_ext = '.csv'
+headers_to_delete = '.csv.names'
+instance_dir_prefix = 'instance_step_'  # private working folder of each instance when isolated_instances == True
+autotune_dir_prefix = 'autotune_step_'  # working folder of an autotune trial solve (inside the project)
+solver_tuning_file = 'solver_tuning.json'  # autotune: winning "Solver 1" profile per octave band (in the mesh folder)
+restart_dir = 'scan_restart'  # warm_start: solutions of completed steps (Elmer "Output File") for the next steps
+batch_steps_file = 'batch_steps.txt'  # step numbers of a batch (one per Scanning timestep) inside its instance folder
+lease_file_ext = '.lease'  # distributed mode: "case_frequency_N.lease" marks a step claimed by an ElmerScanManager
+lease_clock_margin = 30  # seconds a lease is kept on top of lease_seconds (the clocks of the computers may differ)
+manifest_file = os.path.join('scan_manifest', 'manifest.json')  # state of all steps of a project (in a sub-folder so
+#                             that re-writing it does not change the modification time of the project folder itself)
+manifest_flush_seconds = 30  # how often the state of the steps is saved during the run
+result_store_file = 'scan_results.sqlite'  # SaveScalars values of all completed steps of a project (see "store_step_results")
+journal_file = 'scan_journal.jsonl'  # append-only record of all scheduling events of a project (one JSON object per line)
+cost_history_file = 'scan_cost_history.csv'  # peak RAM, CPU & wall time of each completed step (for predictions)
+cost_history_columns = ['step', 'frequency', 'mesh_nodes', 'mesh_elements', 'element_order', 'peak_rss', 'cpu_time',
+                        'wall_time', 'partitions']
+# corner node pairs of the edges of Elmer elements (by element family = element type code // 100)
+element_edges = {2: ((0, 1),), 3: ((0, 1), (1, 2), (2, 0)), 4: ((0, 1), (1, 2), (2, 3), (3, 0)),
+                 5: ((0, 1), (0, 2), (0, 3), (1, 2), (1, 3), (2, 3)),
+                 6: ((0, 1), (1, 2), (2, 3), (3, 0), (0, 4), (1, 4), (2, 4), (3, 4)),
+                 7: ((0, 1), (1, 2), (2, 0), (3, 4), (4, 5), (5, 3), (0, 3), (1, 4), (2, 5)),
+                 8: ((0, 1), (1, 2), (2, 3), (3, 0), (4, 5), (5, 6), (6, 7), (7, 4), (0, 4), (1, 5), (2, 6), (3, 7))}
+#  not used:     post_file_ext = '.vtu'
+if os.name == 'nt':  # Windows detected
+    elmersolver_executable = "ElmerSolver.exe"
+    elmersolver_mpi_executable = "ElmerSolver_mpi.exe"
+    elmergrid_executable = "ElmerGrid.exe"
+else:  # elif os.name == 'posix': # Linux or Mac detected
+    elmersolver_executable = "ElmerSolver"
+    elmersolver_mpi_executable = "ElmerSolver_mpi"
+    elmergrid_executable = "ElmerGrid"
+mpi_ram_overhead = 0.1  # assumed extra RAM of an MPI run per additional partition (relative to a serial run)
+# placement=True: thread count variables of OpenMP & the BLAS libraries that Elmer can be built with
+thread_variables = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS', 'BLIS_NUM_THREADS']
+cpu_topology_dir = '/sys/devices/system'  # Linux: NUMA nodes & physical cores (other systems: one node)
+# "Solver 1" settings for re-tries of steps that did not converge (profile 0 = the .sif as it is):
+solver_profiles = [{},
+                   {'Linear System ILUT Tolerance': '1.0e-5', 'Linear System Max Iterations': '2000',
+                    'BiCGstabl polynomial degree': '4'},
+                   {'Linear System Solver': 'Direct', 'Linear System Direct Method': 'Umfpack'}]
+# candidate "Solver 1" settings for autotune (name: settings on top of the .sif, 'sif' = the .sif as it is). Profiles
+# that do not work with the installed Elmer (for example without MUMPS) simply lose their trials.
+autotune_trial_iterations = 100  # linear solver iterations of an iterative trial solve (the rest is extrapolated)
+tuning_profiles = {'sif': {},
+                   'bicgstabl4': {'Linear System Iterative Method': 'BiCGStabl', 'BiCGstabl polynomial degree': '4'},
+                   'bicgstabl4_ilut1e-4': {'Linear System Iterative Method': 'BiCGStabl',
+                                           'BiCGstabl polynomial degree': '4', 'Linear System ILUT Tolerance': '1.0e-4'},
+                   'idrs': {'Linear System Iterative Method': 'IDRS', 'IDRS Parameter': 'Integer 6'},
+                   'gcr_ilu2': {'Linear System Iterative Method': 'GCR', 'Linear System Preconditioning': 'ILU2'},
+                   'umfpack': {'Linear System Solver': 'Direct', 'Linear System Direct Method': 'Umfpack'},
+                   'mumps': {'Linear System Solver': 'Direct', 'Linear System Direct Method': 'Mumps'}}
+
 
 #
 # The logic is:
@@ -55,6 +189,8 @@ version = 'v1.20'  # <<<  for printouts.
 #   system. It keeps launching new instances as resources free up. In addition, it tries to not overload the CPU
 #   in case there is more than enough RAM. (all of this resource monitoring works reasonably well). To have full
 #   control over RAM usage ElmerScanManager runs ElmerSolver instances with a single frequency step at a time.
+#   Only ElmerSolver processes launched by this ElmerScanManager are monitored (other users/managers are ignored).
+#   A watcher thread per instance reports its exit immediately, so the next step is launched without polling delays.
 #
 # to see all options run   "python elmer_scan_manager.py --help"
 def create_cli():
@@ -72,7 +208,8 @@ def create_cli():
     parser.add_argument(
         "--auto_set_max_instances", default='True', choices=('True', 'False'), type=str,
         help=("Feature to autodetect how many solver instances can be run concurrently to not overload CPU."
-              " NOTE - does not work very reliably! Usually is fine, but you may prefer manual max_instances."))
+              " NOTE - does not work very reliably! Usually is fine, but you may prefer manual max_instances."
+              " With placement=True: number of physical cores * max_cpu_load_percent (no measurement)."))
     parser.add_argument(
         "--max_instances", default='8', type=int,
         help='Default instance limit is used in case auto_set_max_instances=False.')
@@ -94,8 +231,174 @@ def create_cli():
               " Note: the actual CPU usage can be higher - not a precise algorithm!."))
     parser.add_argument(
         "--kill_processes_on_overload", default='True', choices=('True', 'False'), type=str,
-        help=("Kill some running Elmer solver processes in case CPU usage consistently over max_cpu_load_percent OR "
-              "RAM memory consistently has less than 500 BM free. "))
+        help=("Act on running Elmer solver processes in case CPU usage consistently over max_cpu_load_percent OR "
+              "RAM memory consistently has less than 500 MB free: pause OR kill some of them (see overload_action)."))
+    parser.add_argument(
+        "--overload_action", default='kill', choices=('suspend', 'kill'), type=str,
+        help=("What kill_processes_on_overload does: 'suspend' lowers the priority of the least progressed instance "
+              "OR pauses it (SIGSTOP) & resumes it (SIGCONT) when CPU & RAM allow on CPU overload - its step is "
+              "not lost. On RAM overload it kills the least progressed instance (paused processes keep their RAM). "
+              "'kill' kills the last started instance (its step is re-tried from the start)."))
+    parser.add_argument(
+        "--scratch_dir", default='', type=str,
+        help=("Optional local scratch folder (fast disk or tmpfs) for the instance folders: ElmerSolver writes its "
+              "results there & mover threads ship them to the project folder in the background (for project folders "
+              "on network shares). Empty string = instance folders in the project folder."))
+    parser.add_argument(
+        "--scratch_max_gb", default='20', type=float,
+        help="scratch_dir: no new steps are started while more results than this wait to be shipped.")
+    parser.add_argument(
+        "--mover_threads", default='2', type=int,
+        help="scratch_dir: number of threads that ship results to the project folders at the same time.")
+    parser.add_argument(
+        "--compress_vtu", default='True', choices=('True', 'False'), type=str,
+        help=("scratch_dir: re-encode the raw appended data of shipped .vtu files with zlib compression (read by "
+              "ParaView as any compressed .vtu)."))
+    parser.add_argument(
+        "--convert_meshes", default='False', choices=('True', 'False'), type=str,
+        help=("Before the start: convert the .unv mesh of each project folder (if there is exactly one) into the "
+              "Elmer mesh folder of its Scanning_case.sif. All meshes are converted in parallel & unchanged meshes "
+              "are skipped. Needs convert_mesh_unv_to_elmer.py next to this script."))
+    parser.add_argument(
+        "--isolated_instances", default='False', choices=('True', 'False'), type=str,
+        help=("Run every frequency step in its own working folder with its own generated case.sif and "
+              "ELMERSOLVER_STARTINFO (the mesh is still read from the project folder). This allows launching "
+              "instances back-to-back without waiting for ElmerSolver to read a shared case.sif."))
+    parser.add_argument(
+        "--use_cost_model", default='False', choices=('True', 'False'), type=str,
+        help=("Predict peak RAM of each step from the RAM recorded for completed steps of the same project "
+              "(scan_cost_history.csv). This allows to launch instances without waiting for them to initialize RAM."))
+    parser.add_argument(
+        "--project_policy", default='priority', choices=('priority', 'fair'), type=str,
+        help=("How steps of multiple projects share the computer. 'priority' - projects run in the order they are "
+              "found, steps of the next projects only fill up resources that the current project can not use. "
+              "'fair' - steps of all projects are interleaved so that all projects progress at the same pace."))
+    parser.add_argument(
+        "--step_order", default='largest_first',
+        choices=('largest_first', 'shortest_first', 'coarse_to_fine', 'longest_first'), type=str,
+        help=("Order of the steps of a project. 'largest_first' - highest frequency (most RAM) first. "
+              "'shortest_first' - shortest predicted run time first for many results soon. 'coarse_to_fine' - every "
+              "8th frequency, then every 4th etc. so that partial results cover the whole band early. 'longest_first' "
+              "- longest predicted run time first to shorten the total run time (uses scan_cost_history.csv)."))
+    parser.add_argument(
+        "--placement", default='False', choices=('True', 'False'), type=str,
+        help=("Pin each instance to its own physical cores (on one NUMA node when possible) & set its OpenMP/BLAS "
+              "threads to that number of cores. max_instances is then the number of cores that may be used. "
+              "Linux: started with numactl (RAM bound to the NUMA node of the cores) OR taskset (CPUs only)."))
+    parser.add_argument(
+        "--max_threads", default='4', type=int,
+        help=("placement=True: most OpenMP/BLAS threads (cores) per instance (per partition of MPI instances). "
+              "Threads are only given to steps when not all free cores are needed by parallel instances."))
+    parser.add_argument(
+        "--autotune", default='False', choices=('True', 'False'), type=str,
+        help=("Before the scan: choose the linear solver settings of each octave band by short trial solves of "
+              "representative steps with all candidate profiles (iterative & direct), measuring (extrapolated) wall "
+              "time & peak RAM. Trials run in parallel (up to max_instances OR one per physical core) while RAM "
+              "allows. Not available with distributed=True. The winners are cached per mesh (solver_tuning.json) & "
+              "injected into the case.sif of each step."))
+    parser.add_argument(
+        "--autotune_samples", default='1', type=int,
+        help="Number of representative steps per octave band (spread over the band, the highest frequency first).")
+    parser.add_argument(
+        "--autotune_max_seconds", default='600', type=float,
+        help=("A trial solve is stopped after this many seconds OR when it takes twice as long as the best trial "
+              "of the same step. (Iterative trials are short: they stop after autotune_trial_iterations.)"))
+    parser.add_argument(
+        "--warm_start", default='False', choices=('True', 'False'), type=str,
+        help=("Start the linear solver of each step from the solution of the nearest completed frequency (with the "
+              "same mesh & element order) instead of zero. Steps are run in chains of adjacent frequencies (replaces "
+              "step_order). Serial steps only, not available in distributed mode."))
+    parser.add_argument(
+        "--warm_start_chains", default='0', type=int,
+        help=("Number of chains the frequency band is split into for warm_start: fewer chains = more warm starts, "
+              "more chains = more steps that can run in parallel. 0 = one chain per instance."))
+    parser.add_argument(
+        "--points_per_wavelength", default='0', type=float,
+        help=("Choose the element p-order (and mesh) of each step so that element p-order * wavelength / element size "
+              "is at least this many points per wavelength (for example 10) - the cheapest discretisation that is "
+              "fine enough is used. Extra meshes of the same geometry can be placed in sub-folders of the mesh folder."
+              " 0 = the Element p-order & mesh of the .sif are used for all steps."))
+    parser.add_argument(
+        "--max_element_order", default='4', type=int,
+        help="Highest element p-order used by points_per_wavelength.")
+    parser.add_argument(
+        "--distributed", default='False', choices=('True', 'False'), type=str,
+        help=("Allow several ElmerScanManagers (on one or multiple computers with a shared project folder) to work "
+              "on the same projects. Each step is claimed with a lease file next to its case_frequency_ .csv file. "
+              "Requires isolated_instances=True."))
+    parser.add_argument(
+        "--lease_seconds", default='60', type=float,
+        help=("distributed mode: a lease that was not renewed for this many seconds belongs to a stopped "
+              "ElmerScanManager and its step is taken over by another one (after " + str(lease_clock_margin) +
+              " more seconds: the clocks of the computers may differ). Must be much larger than sec_to_initialize."))
+    parser.add_argument(
+        "--mpi_max_partitions", default='0', type=int,
+        help=("Maximum number of MPI partitions of one step. Values above 1 allow to run long steps with "
+              "ElmerSolver_mpi when there are more free instance slots than steps left (for example the end of a scan). "
+              "Partitioned meshes are generated once with ElmerGrid & re-used. 0 = serial ElmerSolver only."))
+    parser.add_argument(
+        "--mpi_min_wall_time", default='600', type=float,
+        help=("Only steps with a predicted run time (seconds, see use_cost_model) of at least this much "
+              "are worth running with MPI."))
+    parser.add_argument(
+        "--mpi_launcher", default='mpiexec -n {np}', type=str,
+        help=("Command to start ElmerSolver_mpi, {np} is replaced by the number of partitions. "
+              "For example add a hostfile option to spread the partitions over multiple computers."))
+    parser.add_argument(
+        "--batch_max_steps", default='1', type=int,
+        help=("Maximum number of adjacent frequency steps that are solved by one ElmerSolver launch (as Scanning "
+              "timesteps) to save the start-up time of each step. 1 = one step per launch. Requires "
+              "isolated_instances=True & use_cost_model=True (batches are sized by predicted run time)."))
+    parser.add_argument(
+        "--batch_target_wall_time", default='300', type=float,
+        help="Steps are added to a batch while its predicted run time (seconds) stays below this value.")
+    parser.add_argument(
+        "--adaptive_refinement", default='False', choices=('True', 'False'), type=str,
+        help=("Add new frequency steps at run time where the results (SaveScalars .csv values) of completed "
+              "neighbour steps change fast, for example around room modes. New steps are appended to "
+              "Scanning_FREQUNCIES.txt. Start from a coarse frequency list. Not available in distributed mode."))
+    parser.add_argument(
+        "--refine_tolerance", default='0.1', type=float,
+        help=("A step is refined when its values differ more than this (relative) from the straight line between "
+              "its neighbour frequencies."))
+    parser.add_argument(
+        "--refine_min_df", default='0.5', type=float,
+        help="Minimum distance in Hz between frequency steps added by adaptive_refinement.")
+    parser.add_argument(
+        "--refine_max_steps", default='100', type=int,
+        help="Maximum number of steps added by adaptive_refinement per project (during one run).")
+    parser.add_argument(
+        "--watchdog", default='False', choices=('True', 'False'), type=str,
+        help=("Follow the linear solver residuals in the _log.txt file of each running step. A step whose residual "
+              "stagnates or diverges is stopped & re-tried with the next solver profile (tighter ILUT, then a direct "
+              "solver). Needs \"Linear System Residual Output\" in the .sif."))
+    parser.add_argument(
+        "--watchdog_stall_iterations", default='200', type=int,
+        help="A linear solve is stalled when its best residual did not halve during this many iterations.")
+    parser.add_argument(
+        "--watchdog_divergence", default='1e4', type=float,
+        help="A linear solve diverges when its residual grows this many times above its best residual.")
+    parser.add_argument(
+        "--result_store", default='False', choices=('True', 'False'), type=str,
+        help=("Collect the SaveScalars values of each completed step into scan_results.sqlite of its project "
+              "(one row per step, one column per scalar) so that a frequency response is one query. "
+              "distributed=True: written once when the project is finished (not after every step)."))
+    parser.add_argument(
+        "--cache_dir", default='', type=str,
+        help=("Optional folder of a result cache shared by all projects: solved steps are stored in it & steps with "
+              "the same .sif (comments are ignored), mesh, ElmerSolver & frequency are restored from it instead of "
+              "being solved. Empty string = no cache."))
+    parser.add_argument(
+        "--cache_max_gb", default='50', type=float,
+        help="Size limit of the result cache, the least recently used results are deleted first.")
+    parser.add_argument(
+        "--journal", default='False', choices=('True', 'False'), type=str,
+        help=("Append every scheduling event (queued, launch, exit with times, peak RAM & linear solver iterations, "
+              "kill, re-try) to scan_journal.jsonl in each project folder."))
+    parser.add_argument(
+        "--metrics_file", default='', type=str,
+        help=("Optional file that is re-written with the live status (steps per project, instances, RAM) in "
+              "Prometheus text format. Empty string = no metrics."))
     parser.add_argument(
         "--cleanup_after_finish", default='True', choices=('True', 'False'), type=str,
         help="Delete not-useful files generated during simulation after completion.")
@@ -108,24 +411,36 @@ def create_cli():
 
 
 def main(start_path='False', auto_set_max_instances=True, max_instances=8, root_elmer='', sec_to_initialize=7,
-         ram_safety_factor=0.95, max_cpu_load_percent=80, kill_processes_on_overload=True, cleanup_after_finish=True):
+         ram_safety_factor=0.95, max_cpu_load_percent=80, kill_processes_on_overload=True, cleanup_after_finish=True,
+         isolated_instances=False, use_cost_model=False, project_policy='priority', distributed=False, lease_seconds=60,
+         mpi_max_partitions=0, mpi_min_wall_time=600, mpi_launcher='mpiexec -n {np}', batch_max_steps=1,
+         batch_target_wall_time=300, adaptive_refinement=False, refine_tolerance=0.1, refine_min_df=0.5,
+         refine_max_steps=100, step_order='largest_first', journal=False, metrics_file='',
+         watchdog=False, watchdog_stall_iterations=200, watchdog_divergence=1e4, result_store=False,
+         cache_dir='', cache_max_gb=50, convert_meshes=False, points_per_wavelength=0, max_element_order=4,
+         warm_start=False, warm_start_chains=0, autotune=False, autotune_samples=1, autotune_max_seconds=600,
+         overload_action='kill', placement=False, max_threads=4, scratch_dir='', scratch_max_gb=20,
+         mover_threads=2, compress_vtu=True):
     # 2 initialization --------------------------------------------------------------
 
-    # hard-coded filenames:
-    main_frequencies_to_simulate = 'Scanning_FREQUNCIES.txt'  # each row contains one frequency value in [Hz]
-    main_solver_input = 'Scanning_case.sif'  # used as the base for generating startup instructions into "generated_sif"
-    generated_sif = 'case.sif'
-    start_info_file = 'ELMERSOLVER_STARTINFO'
-    post_file = 'case_t'
-    freq_file = 'case_frequency_'
-    freq_file_ext = '.csv'
-    headers_to_delete = '.csv.names'
-    #  not used:     post_file_ext = '.vtu'
+    # accept both bool and CLI string input ('True'/'False'):
+    auto_set_max_instances = str(auto_set_max_instances) == 'True'
+    kill_processes_on_overload = str(kill_processes_on_overload) == 'True'
+    cleanup_after_finish = str(cleanup_after_finish) == 'True'
+    isolated_instances = str(isolated_instances) == 'True'
+    use_cost_model = str(use_cost_model) == 'True'
+    distributed = str(distributed) == 'True'
+    adaptive_refinement = str(adaptive_refinement) == 'True'
+    journal = str(journal) == 'True'
+    watchdog = str(watchdog) == 'True'
+    result_store = str(result_store) == 'True'
+    convert_meshes = str(convert_meshes) == 'True'
+    warm_start = str(warm_start) == 'True'
+    autotune = str(autotune) == 'True'
+    placement = str(placement) == 'True'
+    compress_vtu = str(compress_vtu) == 'True'
+
     required_input_files = [main_solver_input, main_frequencies_to_simulate, 'mesh.elements']
-    if os.name == 'nt':  # Windows detected
-        elmersolver_executable = "ElmerSolver.exe"
-    else:  # elif os.name == 'posix': # Linux or Mac detected
-        elmersolver_executable = "ElmerSolver"
     temp_max_instances = 999999  # reset temporary limit
 
     os.system("")  # trick to get colored print-outs   https://stackoverflow.com/a/54955094
@@ -145,7 +460,58 @@ def main(start_path='False', auto_set_max_instances=True, max_instances=8, root_
     print('   input arg:  "root_elmer" = ' + str(root_elmer))
     print('   input arg:  "ram_safety_factor" = ' + str(ram_safety_factor))
     print('   input arg:  "max_cpu_load_percent" = ' + str(max_cpu_load_percent) + '%')
+    print('   input arg:  "kill_processes_on_overload" = ' + str(kill_processes_on_overload))
+    if kill_processes_on_overload:
+        print('   input arg:  "overload_action" = ' + str(overload_action))
     print('   input arg:  "cleanup_after_finish" = ' + str(cleanup_after_finish))
+    print('   input arg:  "convert_meshes" = ' + str(convert_meshes))
+    print('   input arg:  "scratch_dir" = ' + str(scratch_dir))
+    if scratch_dir != '':
+        print('   input arg:  "scratch_max_gb" = ' + str(scratch_max_gb) + ' GB')
+        print('   input arg:  "mover_threads" = ' + str(mover_threads))
+        print('   input arg:  "compress_vtu" = ' + str(compress_vtu))
+    print('   input arg:  "isolated_instances" = ' + str(isolated_instances))
+    print('   input arg:  "use_cost_model" = ' + str(use_cost_model))
+    print('   input arg:  "project_policy" = ' + str(project_policy))
+    print('   input arg:  "step_order" = ' + str(step_order))
+    print('   input arg:  "placement" = ' + str(placement))
+    if placement:
+        print('   input arg:  "max_threads" = ' + str(max_threads))
+    print('   input arg:  "autotune" = ' + str(autotune))
+    if autotune:
+        print('   input arg:  "autotune_samples" = ' + str(autotune_samples))
+        print('   input arg:  "autotune_max_seconds" = ' + str(autotune_max_seconds) + ' s')
+    print('   input arg:  "warm_start" = ' + str(warm_start))
+    if warm_start:
+        print('   input arg:  "warm_start_chains" = ' + str(warm_start_chains))
+    print('   input arg:  "points_per_wavelength" = ' + str(points_per_wavelength))
+    if points_per_wavelength > 0:
+        print('   input arg:  "max_element_order" = ' + str(max_element_order))
+    print('   input arg:  "distributed" = ' + str(distributed))
+    if distributed:
+        print('   input arg:  "lease_seconds" = ' + str(lease_seconds))
+    print('   input arg:  "mpi_max_partitions" = ' + str(mpi_max_partitions))
+    print('   input arg:  "batch_max_steps" = ' + str(batch_max_steps))
+    if batch_max_steps > 1:
+        print('   input arg:  "batch_target_wall_time" = ' + str(batch_target_wall_time) + ' s')
+    print('   input arg:  "adaptive_refinement" = ' + str(adaptive_refinement))
+    print('   input arg:  "watchdog" = ' + str(watchdog))
+    if watchdog:
+        print('   input arg:  "watchdog_stall_iterations" = ' + str(watchdog_stall_iterations))
+        print('   input arg:  "watchdog_divergence" = ' + str(watchdog_divergence))
+    print('   input arg:  "result_store" = ' + str(result_store))
+    print('   input arg:  "cache_dir" = ' + str(cache_dir))
+    if cache_dir != '':
+        print('   input arg:  "cache_max_gb" = ' + str(cache_max_gb))
+    print('   input arg:  "journal" = ' + str(journal))
+    print('   input arg:  "metrics_file" = ' + str(metrics_file))
+    if adaptive_refinement:
+        print('   input arg:  "refine_tolerance" = ' + str(refine_tolerance))
+        print('   input arg:  "refine_min_df" = ' + str(refine_min_df) + ' Hz')
+        print('   input arg:  "refine_max_steps" = ' + str(refine_max_steps))
+    if mpi_max_partitions > 1:
+        print('   input arg:  "mpi_min_wall_time" = ' + str(mpi_min_wall_time) + ' s')
+        print('   input arg:  "mpi_launcher" = ' + str(mpi_launcher))
 
     if start_path == 'False':
         print('   (searching for simulation projects next to "' + os.path.basename(__file__) + '")')
@@ -154,6 +520,70 @@ def main(start_path='False', auto_set_max_instances=True, max_instances=8, root_
     if auto_set_max_instances:
         max_instances = 0  # this allows to set instances several times
 
+    cpu_topology = None  # placement=True: [NUMA node][physical core] = logical CPUs
+    if placement:
+        cpu_topology = read_cpu_topology()
+        nr_cores = sum(len(node) for node in cpu_topology)
+        if auto_set_max_instances:
+            max_instances = max(1, round(nr_cores * max_cpu_load_percent / 100))
+        max_instances = min(max_instances, nr_cores)  # (one core per instance at least)
+        print("   CPU placement:", str(len(cpu_topology)), "NUMA nodes with", str(nr_cores),
+              "physical cores  =>  max_instances =", str(max_instances), "cores")
+
+    # identifies leases of this ElmerScanManager (the random part keeps it unique if a pid is re-used)
+    worker_id = socket.gethostname() + ':' + str(os.getpid()) + ':' + os.urandom(4).hex()
+    if mpi_max_partitions > 1 and (shutil.which(os.path.join(root_elmer, elmersolver_mpi_executable)) is None or
+                                   shutil.which(mpi_launcher.split()[0]) is None):
+        print("NOTE - ElmerSolver_mpi or " + mpi_launcher.split()[0] + " was not found - only serial ElmerSolver "
+              "instances will be used.")
+        mpi_max_partitions = 0
+
+    if batch_max_steps > 1 and not (isolated_instances and use_cost_model):
+        print("NOTE - batch_max_steps needs isolated_instances=True & use_cost_model=True - both are switched on.")
+        isolated_instances = True
+        use_cost_model = True
+
+    cache_size = 0  # bytes in the result cache (counted once, then kept up to date by this ElmerScanManager)
+    if cache_dir != '':
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        cache_size = evict_result_cache(cache_dir, cache_max_gb)
+
+    if distributed and adaptive_refinement:
+        print("NOTE - adaptive_refinement is not available in distributed mode (several ElmerScanManagers would add "
+              "the same steps) - it is switched off.")
+        adaptive_refinement = False
+
+    if distributed and autotune:
+        print("NOTE - autotune is not available in distributed mode (trial solves are not leased & would collide with "
+              "steps of other ElmerScanManagers) - it is switched off.")
+        autotune = False
+
+    if distributed and warm_start:
+        print("NOTE - warm_start is not available in distributed mode (solutions of other ElmerScanManagers are not "
+              "known) - it is switched off.")
+        warm_start = False
+    if warm_start and warm_start_chains <= 0:  # one chain per instance that can run in parallel
+        warm_start_chains = max_instances if max_instances > 0 else psutil.cpu_count(logical=False) or 1
+
+    if distributed and not isolated_instances:
+        print("NOTE - distributed mode needs isolated_instances=True (a shared case.sif can not be used by multiple "
+              "ElmerScanManagers) - isolated_instances is switched on.")
+        isolated_instances = True
+
+    if scratch_dir != '' and not isolated_instances:
+        print("NOTE - scratch_dir needs isolated_instances=True (results are written into instance folders) - "
+              "isolated_instances is switched on.")
+        isolated_instances = True
+    if scratch_dir != '' and not os.path.isdir(scratch_dir):
+        os.makedirs(scratch_dir)
+
+    if convert_meshes:  # (before the projects are checked: a project without mesh.elements would be skipped)
+        if convert_mesh_unv_to_elmer is None:
+            print("NOTE - convert_mesh_unv_to_elmer.py was not found next to this script - meshes are not converted.")
+        else:
+            convert_project_meshes(start_path, root_elmer, text_color_red, text_color_reset)
+
     # Detect what the start_path is pointing to:
     if os.path.isfile(os.path.join(start_path, main_solver_input)):  # - is it Project folder?
         all_projects = [start_path]  # correct project folder
@@ -164,7 +594,7 @@ def main(start_path='False', auto_set_max_instances=True, max_instances=8, root_
                 # Check that all necessary project files are present:
                 all_good = True  # re-init
                 for calc_file in required_input_files:
-                    if not os.path.isfile(os.path.join(start_path, subdir, calc_file)):
+                    if not os.path.isfile(required_file_path(os.path.join(start_path, subdir), calc_file)):
                         all_good = False
                 if all_good:
                     all_projects.append(os.path.join(start_path, subdir))  # generate list of project folders to execute
@@ -172,6 +602,13 @@ def main(start_path='False', auto_set_max_instances=True, max_instances=8, root_
                     print("NOTE - incomplete project folder skipped: " +
                           os.path.join(start_path, subdir))
 
+    # projects with a sweep specification are replaced by one generated project per combination of sweep values
+    all_projects = expand_sweeps(all_projects)
+
+    if scratch_dir != '':  # results that were not yet shipped when ElmerScanManager stopped
+        for project_folder in all_projects:
+            collect_scratch_outputs(project_folder, scratch_dir, compress_vtu)
+
     if len(all_projects) == 0:  # not good
         print(text_color_red + 'ERROR - start_path = "' + start_path + '" does not contain any valid projects to run')
         print(text_color_red + ' Please make sure that "start_path" is valid')
@@ -190,12 +627,15 @@ def main(start_path='False', auto_set_max_instances=True, max_instances=8, root_
         raise Exception("not ok to continue")
 
     # Check all projects that may need to be executed:
+    checked_projects = {}  # project folder: result of "check_project" (each project is checked only once)
+    element_sizes = {}  # mesh folder: element size (meshes shared by projects, for example sweeps, are read once)
     if len(all_projects) > 1:
         projects_to_run = []  # init boolean
         for proj in range(len(all_projects)):
-            all_steps, steps_to_run, freq_of_steps_to_run = \
+            checked_projects[all_projects[proj]] = \
                 check_project(all_projects[proj], required_input_files, main_frequencies_to_simulate, freq_file,
                               freq_file_ext, text_color_red)
+            all_steps, steps_to_run, freq_of_steps_to_run = checked_projects[all_projects[proj]]
             if len(steps_to_run) > 0:
                 projects_to_run.append(all_projects[proj])  # mark to run this project
                 print('Project "' + os.path.basename(all_projects[proj]) + '" has ' + str(len(steps_to_run)) +
@@ -207,303 +647,973 @@ def main(start_path='False', auto_set_max_instances=True, max_instances=8, root_
         # #    if not all(Project_to_run):  # all projects are finished  (no problem)
     del all_projects  # just to avoid bugs: removing variables that are no longer relevant
 
-    # 3 Loop to process all projects  --------------------------------------------------------------    
+    # 3 Prepare all projects & one common queue of steps from all projects  ---------------------------------------
+    projects = {}  # bookkeeping of each project to run (key = project folder)
     for proj in range(len(projects_to_run)):
-
-        os.chdir(projects_to_run[proj])  # change to the project directory (for ElmerSolver to find input files)
-
         # Check how many instances are in this Project:
-        all_steps, steps_to_run, freq_of_steps_to_run = \
-            check_project(projects_to_run[proj], required_input_files, main_frequencies_to_simulate, freq_file,
-                          freq_file_ext, text_color_red)
-        total_nr_to_run = len(steps_to_run)
+        if projects_to_run[proj] not in checked_projects:
+            checked_projects[projects_to_run[proj]] = \
+                check_project(projects_to_run[proj], required_input_files, main_frequencies_to_simulate, freq_file,
+                              freq_file_ext, text_color_red)
+        all_steps, steps_to_run, freq_of_steps_to_run = checked_projects[projects_to_run[proj]]
 
         # Status printouts:
-        if len(projects_to_run) > 1:
-            print(text_color_reset + " ")
-            print(text_color_reset + " ")
-            print(text_color_cyan + " Started Project", str(proj + 1), " out of ", str(len(projects_to_run)),
-                  "detected projects to run")
-            print(text_color_reset + " ")
-            print(text_color_reset + " ")
+        print(text_color_reset + " ")
+        print(text_color_cyan + "--- Project", str(proj + 1), "out of", str(len(projects_to_run)), ":",
+              projects_to_run[proj] + text_color_reset)
         print("--- ", str(len(all_steps)), "frequency steps defined in this Elmer Scanning simulation project")
-        if total_nr_to_run == 0:
+        if len(steps_to_run) == 0:
             print("--- This Simulation project is already Complete. ---")
         else:
-            print("--- ", str(total_nr_to_run),
-                  "steps are not yet completed. (Starting from the max frequency)")
-
-        # Sort list to run the largest frequencies that consume the most RAM first
-        sorting_list = sorted(zip(freq_of_steps_to_run, steps_to_run), reverse=True)
-        steps_to_run = [x for y, x in sorting_list]  # sort "steps_to_run" according to decreasing frequency
-        freq_of_steps_to_run = [y for y, x in sorting_list]  # update Matched list to correspond to "steps_to_run"
-        del sorting_list  # remove no longer needed variables
-
-        start_time = time.localtime()
-        print(time.strftime("%d %b - %H:%M:%S", start_time))
+            print("--- ", str(len(steps_to_run)),
+                  "steps are not yet completed. (step_order = " + step_order + ")")
 
         # read in simulation parameters once:
         with open(os.path.join(projects_to_run[proj], main_solver_input), 'r') as contents:
             main_case_sif = contents.read()
+        mesh_dir = read_mesh_dir(main_case_sif)  # the mesh folder relative to the project folder
+        if isolated_instances:
+            main_case_sif = relocate_sif_paths(main_case_sif)  # instance folders are one level below the mesh
 
         # make sure there is a start_info_file (generate it if needed)
-        if not os.path.isfile(os.path.join(projects_to_run[proj], start_info_file)):
+        if not isolated_instances and not os.path.isfile(os.path.join(projects_to_run[proj], start_info_file)):
             with open(os.path.join(projects_to_run[proj], start_info_file), "w", encoding="utf8",
                       newline="\n") as text_file:
                 text_file.write(generated_sif + "\n1\n")  # first & second lines
 
-        # 4 main loop for each step/instance  --------------------------------------------------------------
-        sim_step = -1  # re-init
-        running_processes = []  # re-init
-        process_was_killed = False  # re-set flag
-        while sim_step < total_nr_to_run-1:    # loop until all steps are executed (with option to repeat)
-            sim_step += 1  # increment by one
-            step = steps_to_run[sim_step]
-            too_much_cpu_load_strike = 0    # re-init for kill_processes_on_overload
-            too_much_ram_load_strike = 0    # re-init for kill_processes_on_overload
-            # print("- ", str(sim_step + 1), "/", str(total_nr_to_run), " preparing >>>",
-            #       str(freq_of_steps_to_run[sim_step]),
-            #       "Hz <<< instance at step", str(step))
-
-            # double check (roughly) that this instance does not have output
-            path_to_check = os.path.join(projects_to_run[proj], freq_file + str(step) + freq_file_ext)
-            if os.path.isfile(path_to_check):
-                print(text_color_cyan, "Skipping step with output file", freq_file + str(step) + freq_file_ext,
-                      "--- because already has output data!")
-                print(text_color_reset + " ")
-                running_processes.append(0)  # append dummy zero
-                continue  # jump over this instance
-
-            # Check the RAM & run instance if feasible
+        # load what was learned about RAM & run time of the steps of this project (during this and previous runs)
+        project = {'priority': proj, 'case_sif': main_case_sif, 'mesh_dir': mesh_dir,
+                   'meshes': {mesh_dir: [read_mesh_size(os.path.join(projects_to_run[proj], mesh_dir)), 0.0]},
+                   'element_order': read_element_order(main_case_sif), 'discretisation': None,
+                   'cost_history': load_cost_history(projects_to_run[proj]),
+                   'cost_models': {} if use_cost_model else None,
+                   'steps': set(steps_to_run), 'completed': set(), 'failed': [], 'finished': False, 'pending': [],
+                   'responses': {}, 'refine_budget': refine_max_steps,
+                   'manifest': load_manifest(projects_to_run[proj]), 'cache_base': '', 'cache_bases': {},
+                   'restarts': {}, 'iterations': [], 'tuned': {}}
+        if points_per_wavelength > 0:  # mesh & element p-order per step (see "choose_discretisation")
+            sound_speeds = read_sif_numbers(main_case_sif, 'Sound speed')
+            coordinate_scaling = (read_sif_numbers(main_case_sif, 'Coordinate Scaling') + [1.0])[0]
+            for mesh in find_project_meshes(projects_to_run[proj], mesh_dir):
+                mesh_folder = os.path.normpath(os.path.join(projects_to_run[proj], mesh))
+                if mesh_folder not in element_sizes:
+                    element_sizes[mesh_folder] = read_element_size(mesh_folder)
+                if element_sizes[mesh_folder] > 0:
+                    project['meshes'][mesh] = [read_mesh_size(mesh_folder),
+                                               element_sizes[mesh_folder] * coordinate_scaling]
+            if len(sound_speeds) == 0 or project['meshes'][mesh_dir][1] == 0:
+                print("NOTE - no \"Sound speed\" number in the .sif OR the element size of the mesh is not known - "
+                      "the Element p-order of the .sif is used for all steps.")
+            else:
+                project['discretisation'] = {'sound_speed': min(sound_speeds),
+                                             'points_per_wavelength': points_per_wavelength,
+                                             'max_element_order': max_element_order}
+                print("--- element size", str(round(project['meshes'][mesh_dir][1], 4)), "m,",
+                      str(len(project['meshes'])), "mesh(es), sound speed", str(min(sound_speeds)), "m/s")
+        if step_cost_model(project, {'mesh_dir': mesh_dir, 'element_order': project['element_order']}) is not None:
+            print("--- RAM & run time are predicted from", str(project['cost_models'][
+                (mesh_dir, project['element_order'])]['samples']), "recorded steps", "(" + cost_history_file + ")")
+
+        # Sort list to run the largest frequencies that consume the most RAM first (then re-order, see "order_steps")
+        for frequency, step in sorted(zip(freq_of_steps_to_run, steps_to_run), reverse=True):
+            project['pending'].append({'project': projects_to_run[proj], 'step': step, 'frequency': frequency})
+        if project['discretisation'] is not None:
+            discretisations = {}  # (mesh folder, element p-order): number of steps
+            for entry in project['pending']:
+                discretisations[step_discretisation(project, entry)] = \
+                    discretisations.get(step_discretisation(project, entry), 0) + 1
+            for (mesh, element_order), count in sorted(discretisations.items()):
+                print("      p:" + str(element_order), "with mesh", '"' + mesh + '"', "for", str(count), "steps")
+            coarse = [entry['frequency'] for entry in project['pending']
+                      if entry['resolution'] < points_per_wavelength]
+            if len(coarse) > 0:
+                print(text_color_red + "NOTE -", str(len(coarse)), "steps from", str(min(coarse)), "Hz have less than",
+                      str(points_per_wavelength), "points per wavelength (down to", str(round(min(
+                        entry['resolution'] for entry in project['pending']), 1)) + ") - add a finer mesh OR "
+                      "increase max_element_order" + text_color_reset)
+        if cache_dir != '':  # restore steps that were already solved (in any project) from the result cache
+            project['cache_base'] = result_cache_base(projects_to_run[proj], main_case_sif, mesh_dir, root_elmer)
+            for entry in project['pending'].copy():
+                if restore_cached_step(cache_dir, entry, project, root_elmer, isolated_instances):
+                    project['pending'].remove(entry)
+                    complete_step(project, entry['step'])
+                    if journal:
+                        journal_event(entry['project'], 'cache_hit', worker_id, {'step': entry['step'],
+                                                                                  'frequency': entry['frequency']})
+            if len(project['completed']) > 0:
+                print("--- ", str(len(project['completed'])), "steps restored from the result cache")
+        project['pending'] = order_steps(project['pending'], project, step_order)
+        if warm_start:  # (solutions of earlier runs may belong to another mesh or .sif - they are not used)
+            shutil.rmtree(os.path.join(projects_to_run[proj], restart_dir), ignore_errors=True)
+            os.makedirs(os.path.join(projects_to_run[proj], restart_dir))
+            project['pending'] = order_chains(project['pending'], warm_start_chains)
+        if adaptive_refinement:  # (results of previous runs may already show where steps are missing)
+            new_steps = refine_project(projects_to_run[proj], project, refine_tolerance, refine_min_df)
+            for entry in new_steps:
+                project['manifest']['steps'][str(entry['step'])] = [entry['frequency'], 'pending']
+            project['pending'] += new_steps
+            if len(steps_to_run) < len(project['steps']):
+                print("--- ", str(len(project['steps']) - len(steps_to_run)), "steps added by adaptive refinement")
+        projects[projects_to_run[proj]] = project
+
+    if autotune:  # (before the queue is formed: steps solved by a winning trial are not queued)
+        for project_folder in projects:
+            autotune_project(project_folder, projects[project_folder], root_elmer, isolated_instances,
+                             autotune_samples, autotune_max_seconds,
+                             max_instances if max_instances > 0 else psutil.cpu_count(logical=False) or 1,
+                             ram_safety_factor)
+
+    for project_folder in projects:
+        if len(projects[project_folder]['pending']) == 0:  # nothing to run - only status & clean-up
+            finish_project(project_folder, projects[project_folder], cleanup_after_finish, text_color_cyan,
+                           text_color_red, text_color_reset, worker_id if distributed else '', result_store)
+
+    # one queue for all projects (see "order_project_steps"), the order of steps inside each project is kept
+    pending_steps = order_project_steps(projects, project_policy)
+    for entry in pending_steps:
+        entry['queue_time'] = time.time()
+        if journal:
+            journal_event(entry['project'], 'queued', worker_id, {'step': entry['step'],
+                                                                   'frequency': entry['frequency']})
+    total_nr_to_run = len(pending_steps)
+    start_time = time.localtime()
+    print(text_color_reset + " ")
+    print("--- ", str(total_nr_to_run), "steps to run in total   ", time.strftime("%d %b - %H:%M:%S", start_time))
+
+    # 4 main loop: launch instances while resources allow & react as soon as any of them exits  -------------------
+    running = []  # instances launched (and supervised) by this ElmerScanManager - other processes are ignored
+    shipping = []  # scratch_dir: exited instances whose results are being shipped to the project folder
+    mover = None
+    if scratch_dir != '':
+        mover = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, mover_threads))
+    claimed_elsewhere = []  # distributed mode: queued steps that are currently run by other ElmerScanManagers
+    exit_events = queue.Queue()  # watcher threads put each instance here the moment its ElmerSolver exits
+    nr_launched = 0  # init counter for printouts
+    ram_per_instance = 0  # the biggest RAM of an initialized instance = worst-case RAM need of the next instance
+    cpu_sample = [0.0, 0.0]  # [time, value] of the last system CPU load measurement
+    too_much_cpu_load_strike = 0  # re-init for kill_processes_on_overload
+    too_much_ram_load_strike = 0  # re-init for kill_processes_on_overload
+    head_overtaken = 0  # how many times other steps were launched before the first step in the queue
+    waiting_for_last = False  # re-set flag (for printouts)
+    last_manifest_save = time.time()
+    atexit.register(resume_suspended_instances, running)  # no paused ElmerSolver is left behind if the script stops
+    while len(pending_steps) > 0 or len(running) > 0 or len(claimed_elsewhere) > 0 or len(shipping) > 0:
+
+        # 4.1 finalize all instances that have exited since the last loop
+        while not exit_events.empty():
+            instance = exit_events.get()
+            if instance in running:
+                running.remove(instance)
+                if instance['lease_lost']:  # another ElmerScanManager runs the steps now (in the same folder)
+                    instance['log'].close()
+                    for member in entry_members(instance['entry']):
+                        claimed_elsewhere.append(member)
+                        set_step_state(projects[instance['project']], member['step'], 'running')
+                        if journal:
+                            journal_event(member['project'], 'lease_lost', worker_id, {'step': member['step']})
+                    continue
+                if mover is not None:  # the results are shipped from scratch_dir first (back here when done)
+                    instance['staged_bytes'] = folder_size(instance['dir'])
+                    shipping.append(instance)
+                    mover.submit(ship_instance_outputs, instance, compress_vtu, exit_events)
+                    continue
+            else:
+                shipping.remove(instance)
+            project = projects[instance['project']]
+            status = finish_instance(instance)
+            members = entry_members(instance['entry'])  # all steps of the instance (more than one for a batch)
+            if status == 'failed' and instance['warm_start_from'] is not None:
+                status = 'escalated'  # re-try without the initial guess first
+                print("   warm started step", str(instance['step']), "failed - re-try without warm start")
+                for member in members:
+                    member['cold_start'] = True
+                if journal:
+                    journal_event(instance['project'], 'escalated', worker_id, {
+                        'steps': [member['step'] for member in members], 'reason': 'warm start failed'})
+            if status == 'failed' and watchdog and next_solver_profile(members) is not None and \
+                    log_reports_not_converged(instance['log'].name):
+                status = 'escalated'  # ElmerSolver aborted as not converged - re-try with the next solver profile
+                instance['escalate_to'] = next_solver_profile(members)
+                print("   step", str(instance['step']), "did not converge - re-try with solver profile",
+                      str(instance['escalate_to']))
+                if journal:
+                    journal_event(instance['project'], 'escalated', worker_id, {
+                        'steps': [member['step'] for member in members], 'reason': 'not converged',
+                        'profile': instance['escalate_to']})
+            if status == 'failed' and len(members) > 1:
+                status = 'split'  # a batch stops at its first failed step - the steps after it did not run at all
+                print("   batch of steps", str(members[0]['step']) + "-" + str(members[-1]['step']), "failed - its "
+                      "steps without results are re-tried one by one")
+                for member in members:
+                    member['single'] = True  # (not batched again, see "form_batch")
+                if journal:
+                    journal_event(instance['project'], 'split', worker_id, {
+                        'steps': [member['step'] for member in members]})
+            if status in ('killed', 'escalated', 'split'):  # re-try it first (once its instance folder is cleaned up)
+                # (steps of a batch that were completed before it stopped are not re-tried)
+                retries = [member for member in members if not os.path.isfile(
+                    os.path.join(member['project'], freq_file + str(member['step']) + freq_file_ext))]
+                for member in retries:
+                    if instance['escalate_to'] is not None:
+                        member['profile'] = instance['escalate_to']
+                    member['queue_time'] = time.time()
+                    set_step_state(project, member['step'], 'pending')
+                pending_steps[0:0] = retries
+                total_nr_to_run += len(retries)
+            for member in members:
+                if distributed:
+                    release_step(member, worker_id)
+                if os.path.isfile(os.path.join(member['project'], freq_file + str(member['step']) + freq_file_ext)):
+                    complete_step(project, member['step'])
+                    # (RAM & time of escalated solver profiles are different, those of a stopped batch are not known)
+                    if member.get('profile', 0) == 0 and status == 'done':
+                        mesh, element_order = step_discretisation(project, member)
+                        project['cost_history'].append(record_step_cost(instance['project'], instance, member,
+                                                                        len(members), project['meshes'][mesh][0],
+                                                                        element_order))
+                    print("   finished step", str(member['step']), "(" + str(member['frequency']), "Hz)   ",
+                          str(len(project['completed'])) + "/" + str(len(project['steps'])), "completed in",
+                          os.path.basename(instance['project']), "    [",
+                          time.strftime("%d %b - %H:%M:%S", time.localtime()), "]")
+                elif status not in ('killed', 'escalated', 'split'):  # (re-tried steps were already re-queued)
+                    project['failed'].append(member['step'])
+                    set_step_state(project, member['step'], 'failed')
+                    print(text_color_red + "ERROR - ElmerSolver instance of step " + str(member['step']) +
+                          " exited without results! Read " + post_file + str(instance['step']) +
+                          "_log.txt file for more details." + text_color_reset)
+                    if len(project['completed']) == 0 and len(running) == 0:  # likely all steps would fail the same way
+                        input(text_color_red + "  -press Enter- to exit ElmerScanManager.")
+                        raise Exception("not ok to continue")
+            if warm_start and status == 'done':
+                if instance['restart_file'] is not None and os.path.isfile(instance['restart_file']):
+                    for index, member in enumerate(members):  # (one position per step in the file of a batch)
+                        project['restarts'][member['step']] = {
+                            'step': member['step'], 'frequency': member['frequency'], 'file': instance['restart_file'],
+                            'position': index + 1, 'discretisation': step_discretisation(project, member)}
+                project['iterations'].append((instance['frequency'], instance['warm_start_from'] is not None,
+                                              read_solver_iterations(instance['log'].name)[1] / len(members)))
+            if result_store and not distributed:  # (distributed: written once in "finish_project")
+                store_step_results(instance['project'], [(member['step'], member['frequency']) for member in members])
+            if cache_dir != '' and instance['partitions'] == 1:  # (MPI results are split into partition files)
+                # (copies of big results: the leases of the held steps are renewed meanwhile)
+                cache_size = run_with_heartbeat(store_cached_steps, (
+                    cache_dir, members, project, root_elmer, isolated_instances, cache_size, cache_max_gb),
+                    held_steps(running, shipping), worker_id if distributed else '', lease_seconds)
+            if journal:
+                linear_solves, linear_iterations = read_solver_iterations(instance['log'].name)
+                journal_event(instance['project'], 'exit', worker_id, {
+                    'steps': [member['step'] for member in members], 'status': status,
+                    'exit_code': instance['process'].returncode, 'partitions': instance['partitions'],
+                    'wall_time': round(time.time() - instance['launch_time'] - instance['suspended_time'], 2),
+                    'cpu_time': round(instance['cpu_time'], 2), 'peak_rss': instance['peak_rss'],
+                    'linear_solves': linear_solves, 'linear_iterations': linear_iterations,
+                    'failed_steps': [member['step'] for member in members if member['step'] in project['failed']]})
+            if use_cost_model and status not in ('killed', 'escalated', 'split'):
+                project['cost_models'] = {}  # re-fitted with the new record when needed (see "step_cost_model")
+            if adaptive_refinement and status not in ('killed', 'escalated', 'split'):
+                new_steps = refine_project(instance['project'], project, refine_tolerance, refine_min_df)
+                if len(new_steps) > 0:
+                    for entry in new_steps:
+                        entry['queue_time'] = time.time()
+                        project['manifest']['steps'][str(entry['step'])] = [entry['frequency'], 'pending']
+                        if journal:
+                            journal_event(entry['project'], 'queued', worker_id,
+                                          {'step': entry['step'], 'frequency': entry['frequency'],
+                                           'reason': 'adaptive refinement'})
+                    pending_steps += new_steps
+                    total_nr_to_run += len(new_steps)
+                    waiting_for_last = False
+                    print("   + adaptive refinement added", str(len(new_steps)), "steps:",
+                          ", ".join(str(entry['frequency']) for entry in new_steps), "Hz")
+
+            if project_is_finished(project):
+                finish_project(instance['project'], project, cleanup_after_finish, text_color_cyan,
+                               text_color_red, text_color_reset, worker_id if distributed else '', result_store)
+
+        # distributed mode: steps running on other managers are either completed by them or re-queued here once
+        # their lease expires (= the other manager has stopped)
+        for entry in claimed_elsewhere.copy():
+            project = projects[entry['project']]
+            if os.path.isfile(os.path.join(entry['project'], freq_file + str(entry['step']) + freq_file_ext)):
+                claimed_elsewhere.remove(entry)
+                complete_step(project, entry['step'])
+                if journal:
+                    journal_event(entry['project'], 'completed_elsewhere', worker_id, {'step': entry['step']})
+                print("   step", str(entry['step']), "(" + str(entry['frequency']), "Hz) was completed by another",
+                      "ElmerScanManager   ", str(len(project['completed'])) + "/" + str(len(project['steps'])),
+                      "completed in", os.path.basename(entry['project']))
+                if project_is_finished(project):
+                    finish_project(entry['project'], project, cleanup_after_finish, text_color_cyan,
+                                   text_color_red, text_color_reset, worker_id if distributed else '', result_store)
+            elif not step_is_claimed(entry, lease_seconds):
+                claimed_elsewhere.remove(entry)
+                pending_steps.append(entry)  # the other manager has stopped - re-try this step here
+                set_step_state(project, entry['step'], 'pending')
+                entry['queue_time'] = time.time()
+                if journal:
+                    journal_event(entry['project'], 'queued', worker_id,
+                                  {'step': entry['step'], 'frequency': entry['frequency'], 'reason': 'lease expired'})
+
+        # 4.2 RAM & CPU time of own instances (instances younger than sec_to_initialize may still allocate RAM)
+        young_instances = 0
+        if distributed:
+            for instance in shipping:
+                for member in entry_members(instance['entry']):
+                    renew_step(member, worker_id)  # (the step is complete once its results are shipped)
+        for instance in running:
+            if distributed and not instance['lease_lost']:
+                for member in entry_members(instance['entry']):  # heartbeat: keep the lease of this step valid
+                    if not renew_step(member, worker_id):  # taken over by another manager - give the step up
+                        print(text_color_red + "NOTE - the lease of step " + str(member['step']) + " was taken over "
+                              "by another ElmerScanManager - its instance is stopped here" + text_color_reset)
+                        instance['lease_lost'] = True
+                        instance['killed'] = True
+                        instance['process'].kill()
+                        break
+            sample_instance(instance)
+            if watchdog and not instance['killed']:
+                problem = check_convergence(instance, watchdog_stall_iterations, watchdog_divergence)
+                if problem is not None:  # stop the step now instead of after all "Linear System Max Iterations"
+                    members = entry_members(instance['entry'])
+                    instance['escalate_to'] = next_solver_profile(members)
+                    # (without a next solver profile the step is reported as failed when it exits)
+                    instance['killed'] = instance['escalate_to'] is not None
+                    instance['process'].kill()
+                    print(text_color_red + "XXX - Watchdog stopped step", str(instance['step']), "of",
+                          os.path.basename(instance['project']) + ": linear solver", problem,
+                          "(will re-try with solver profile " + str(instance['escalate_to']) + ")"
+                          if instance['killed'] else "(no more solver profiles to try)", text_color_reset)
+                    if journal:
+                        journal_event(instance['project'], 'watchdog', worker_id, {
+                            'steps': [member['step'] for member in members], 'reason': problem,
+                            'iteration': instance['iteration'], 'profile': instance['escalate_to']})
+            if time.time() - instance['launch_time'] < sec_to_initialize:
+                young_instances += 1
+            else:
+                ram_per_instance = max(ram_per_instance, instance['peak_rss'])
+        if metrics_file != '':
+            write_metrics(metrics_file, projects, running, pending_steps, claimed_elsewhere, max_instances,
+                          ram_per_instance, nr_launched)
+        if time.time() - last_manifest_save > manifest_flush_seconds:
+            for project_folder in projects:
+                save_manifest(project_folder, projects[project_folder]['manifest'])
+            last_manifest_save = time.time()
+
+        # resume a paused instance (the most progressed one first) as soon as CPU & RAM allow it to continue
+        suspended = [instance for instance in running if instance['suspended']]
+        if len(suspended) > 0:
+            instance = max(suspended, key=lambda prc: prc['cpu_time'])
+            ram_growth = max(0, instance['predicted_rss'] - instance['rss']) * ram_safety_factor
+            cpu_share = 100 * instance['partitions'] / psutil.cpu_count()  # CPU load this instance will add
+            if len(suspended) == len(running) or (  # (always run one instance)
+                    time.time() - instance['suspend_time'] >= sec_to_initialize and
+                    system_cpu_load(cpu_sample) + cpu_share < max_cpu_load_percent and
+                    psutil.virtual_memory().available > 536870912 + ram_growth):
+                preempt_instance(instance, 'resume')
+                print("--- Resumed step", str(instance['step']), "of", os.path.basename(instance['project']),
+                      "   [", time.strftime("%d %b - %H:%M:%S", time.localtime()), "]")
+                if journal:
+                    journal_event(instance['project'], 'resume', worker_id, {
+                        'steps': [member['step'] for member in entry_members(instance['entry'])],
+                        'suspended_time': round(time.time() - instance['suspend_time'], 2)})
+                instance['suspended_time'] += time.time() - instance['suspend_time']
+
+        if len(pending_steps) == 0:
+            if len(running) == 0 and len(claimed_elsewhere) == 0 and len(shipping) == 0:
+                break  # all done
+            if not waiting_for_last:
+                print("waiting for last processes to finish")
+                if len(claimed_elsewhere) > 0:
+                    print("   (+", str(len(claimed_elsewhere)), "steps running on other ElmerScanManagers)")
+                waiting_for_last = True
+            try:  # nothing more to launch - just wait for the next instance to exit (& put it back for 4.1)
+                exit_events.put(exit_events.get(timeout=sec_to_initialize))
+            except queue.Empty:
+                pass
+            continue
+
+        # Run this once - normally before launching the 2nd instance IF "auto_set_max_instances == True"
+        if max_instances == 0 and len(running) > young_instances:
+            # noinspection PyBroadException
+            try:
+                # measure the oldest own instance that is not paused (that one has finished its initialization)
+                prc_info = psutil.Process([prc for prc in running if not prc['suspended']][0]['process'].pid)
+                instance_cpu_usage_now = prc_info.cpu_percent(interval=1.0) / psutil.cpu_count()
+
+                # calculate optimal maximum number of ElmerSolver processes for this system:
+                max_instances = max(1, round(max_cpu_load_percent / instance_cpu_usage_now))
+                print("One instance loads CPU to", str(round(instance_cpu_usage_now, 1)),
+                      "% on this machine, therefore",
+                      "max_instances is now automatically set =", str(max_instances))
+            except BaseException:
+                print(
+                    "!!! Failed to auto_set_max_instances - this can happen if ElmerSolver process finished ",
+                    "very fast - you could try to lower your ""sec_to_initialize"" setting.")
+
+        # 4.3 Main checks before launching the next instance (to avoid system resource overload)
+        next_index = None  # index in pending_steps of the step to launch now (None = wait)
+        ram_reserved = 0
+        for instance in running:
+            if instance['predicted_rss'] > 0:  # predicted RAM growth of running instances is reserved
+                ram_reserved += max(0, instance['predicted_rss'] - instance['rss'])
+            elif time.time() - instance['launch_time'] < sec_to_initialize:
+                ram_reserved += ram_per_instance  # RAM of the biggest instance is reserved while initializing
+        ram_needed = step_ram_need(pending_steps[0], projects, ram_per_instance)
+
+        if len(shipping) > 0 and (sum(prc['staged_bytes'] for prc in shipping) > scratch_max_gb * 1073741824 or
+                                  shutil.disk_usage(scratch_dir).free < 1073741824):
+            print("   ... waiting for the results of", str(len(shipping)), "steps to be shipped from scratch_dir   [",
+                  time.strftime("%d %b - %H:%M:%S", time.localtime()), "]")
+        elif len(running) == 0:
+            next_index = 0  # always run one instance.
+        elif max_instances == 0:
+            print("   ... waiting for the 1st instance to initialize")
+        elif sum(prc['partitions'] * prc['threads'] for prc in running) >= min(max_instances, temp_max_instances):
+            print("   No more instances allowed - waiting for 1 out of", str(
+                min(max_instances, temp_max_instances)), "instances to finish")
+            too_much_cpu_load_strike = 0  # reset strikes
+            too_much_ram_load_strike = 0  # reset strikes
+        else:
+            # check if we can run more:  Is free RAM (minus reserved RAM) is greater than
+            #      predicted RAM of the next step OR RAM consumption of the biggest instance * ram_safety_factor .
             ram_info = psutil.virtual_memory()
-            print(str(round((ram_info.available / 1073741824), 2)), "GB free", "    ---    RAM memory used:",
-                  str(ram_info.percent), "%     [", time.strftime("%d %b - %H:%M:%S", time.localtime()), "]")
+            total_cpu_load = system_cpu_load(cpu_sample)
+            if total_cpu_load < max_cpu_load_percent and not any(prc['suspended'] for prc in running):
+                # first step in the queue that fits into free RAM (smaller steps can fill RAM next to bigger steps)
+                next_index = fit_next_step(pending_steps, projects, ram_per_instance,
+                                           ram_info.available - ram_reserved, ram_safety_factor,
+                                           head_overtaken < len(running))
 
-            # Run this once - normally before launching the 2nd instance IF "auto_set_max_instances == True"
-            if sim_step > 0 and max_instances == 0:  # use this to autodetect how many instances should be executed.
-                # noinspection PyBroadException
-                try:
-                    # it is better to get fresh pid (hopefully at least one ElmerSolver process is still running)
-                    pid_name_bytes = [(p.pid, p.info['name'], p.info['memory_info'].rss) for p in
-                                      psutil.process_iter(['name', 'memory_info']) if
-                                      p.info['name'] == elmersolver_executable]
-                    prc_info = psutil.Process(pid_name_bytes[0][0])
-                    instance_cpu_usage_now = prc_info.cpu_percent(interval=1.0) / psutil.cpu_count()
-
-                    # calculate optimal maximum number of ElmerSolver processes for this system:
-                    max_instances = round(max_cpu_load_percent / instance_cpu_usage_now)
-                    print("One instance loads CPU to", str(round(instance_cpu_usage_now, 1)),
-                          "% on this machine, therefore",
-                          "max_instances is now automatically set =", str(max_instances))
-                except BaseException:
-                    print(
-                        "!!! Failed to auto_set_max_instances - this can happen if ElmerSolver process finished ",
-                        "very fast - you could try to lower your ""sec_to_initialize"" setting.")
-
-            #  Main checks before launching the next instance (to avoid system resource overload)
-            wait_for_resources = True  # re-init
-            if sim_step == 0:
-                wait_for_resources = False  # always run 1st instance.
-
-            while wait_for_resources:
-                # Find all ElmerSolver Processes
-                pid_name_bytes = [(p.pid, p.info['name'], p.info['memory_info'].rss) for p in
-                                  psutil.process_iter(['name', 'memory_info']) if
-                                  p.info['name'] == elmersolver_executable]
-                # # FOR DEBUGGING --- Find Processes consuming more than 250MB of memory:
-                # # pid_name_bytes = [(p.pid, p.info['name'], p.info['memory_info'].rss) for p in psutil.process_iter(
-                #       ['name', 'memory_info']) if p.info['memory_info'].rss > 250 * 1048576]
-
-                if len(pid_name_bytes) == 0:  # if no ElmerSolver processes are running, so Go start one instance.
-                    break
-
-                # find out how much RAM consumes the biggest ElmerSolver Instance
-                max_elmersolver_ram = pid_name_bytes[0][2]  # init
-                if len(pid_name_bytes) > 1:  # if more than one process
-                    for prcNr in range(1, len(pid_name_bytes)):
-                        if pid_name_bytes[prcNr][2] > max_elmersolver_ram:
-                            # finding ElmerSolver process that consumes the most RAM
-                            max_elmersolver_ram = pid_name_bytes[prcNr][2]
-
-                # check if we can run more:  Is free RAM is greater than
-                #                       RAM consumption of the biggest ElmerSolver instance * ram_safety_factor .
-                ram_info = psutil.virtual_memory()
-                # CPU load - still not the same CPU load estimate compared to Windows TaskManager!
-                total_cpu_load = psutil.cpu_percent(interval=0.5, percpu=False)  # takes 0.5 seconds!!!
-                if ((ram_info.available > max_elmersolver_ram * ram_safety_factor) &
-                        (total_cpu_load < max_cpu_load_percent)):
-
-                    if len(pid_name_bytes) < min(max_instances, temp_max_instances):
-                        # if the max number of instances to launch is not exceeded:
-
-                        print("   enough RAM to run one more:     ", str(round((ram_info.available / 1073741824), 1)),
-                              "GB free", "     [", time.strftime("%d %b - %H:%M:%S", time.localtime()), "]")
-
-                        break  # out of wait for resources loop
-
-                    else:
-                        print("   No more instances allowed - waiting for 1 out of", str(
-                            min(max_instances, temp_max_instances)), "instances to finish")
-                        too_much_cpu_load_strike = 0  # reset strikes
-                        too_much_ram_load_strike = 0  # reset strikes
+            if next_index is not None:
+                print("   enough RAM to run one more:     ", str(round((ram_info.available / 1073741824), 1)),
+                      "GB free", "     [", time.strftime("%d %b - %H:%M:%S", time.localtime()), "]")
 
+            else:
+                if ram_info.available / 1073741824 < 0.5:  # less than 500 MB of free RAM
+                    too_much_ram_load_strike += 1  # count strikes
                 else:
-                    if ram_info.available / 1073741824 < 0.5:   # less than 500 MB of free RAM
-                        too_much_ram_load_strike += 1   # count strikes
-                    else:
-                        too_much_ram_load_strike = 0  # reset strikes
-
-                    if total_cpu_load > max_cpu_load_percent:  # CPU limitation
-                        too_much_cpu_load_strike += 1   # count strikes
-                        print("   Waiting for less load on CPU:     ", str(total_cpu_load), "% CPU load   ("
-                              + str(max_cpu_load_percent), "% allowed | strike", str(too_much_cpu_load_strike) +
-                              ")  [", time.strftime("%d %b - %H:%M:%S", time.localtime()), "]")
-
-                    else:   # RAM limitation
-                        print("   Waiting for more free RAM:     ",
-                              str(round((ram_info.available / 1073741824), 1)), "GB free    (" +
-                              str(round((max_elmersolver_ram * ram_safety_factor / 1073741824), 1)),
-                              "GB needed | strike", str(too_much_ram_load_strike) + ")   [",
-                              time.strftime("%d %b - %H:%M:%S", time.localtime()), "]")
-                        too_much_cpu_load_strike = 0  # reset strikes
-
-                    if len(pid_name_bytes) == 1:  # if only one process
-                        # extra delay before trying the while loop again for very large processes
-                        time.sleep(4 * sec_to_initialize)
-                    elif (kill_processes_on_overload == 'True' and
-                          (too_much_cpu_load_strike > 4 or too_much_ram_load_strike > 4)):
-                        # if time to kill processes due to prolonged resource overload
-                        if running_processes[sim_step-1] != 0:  # only possible if there are no dummy zero processes
-                            print("XXX - Killing", str(sim_step + 0) + "/" + str(total_nr_to_run),
-                                  "to free-up resources for other processes (will re-try when possible)")
-
-                            # kill last started Elmer process
-                            running_processes[sim_step-1].kill()
-                            del running_processes[sim_step-1]  # remove handle of the killed process
-
-                            # temporarily limit number of processes
-                            pid_name_bytes = [(p.pid, p.info['name'], p.info['memory_info'].rss) for p in
-                                              psutil.process_iter(['name', 'memory_info']) if
-                                              p.info['name'] == elmersolver_executable]
-                            temp_max_instances = len(pid_name_bytes)  # set temporary limit
-
-                            # mark that max instances should be checked again.
-                            max_instances = 0
-                            process_was_killed = True  # set flag
-                            break
-
-                # delay before trying the while loop again
-                time.sleep(sec_to_initialize)
-
-            # END of wait_for_resources while loop
-
-            if process_was_killed:
-                sim_step -= 2  # roll-back step counter to retry the killed instance
-                process_was_killed = False  # re-set flag
-                continue  # skip to beginning of the main loop
-
-            temp_max_instances = 999999  # reset temporary limit
-
-            # START one more instance
-            print("-", str(sim_step + 1) + "/" + str(total_nr_to_run), "Starting >>> "
-                  + str(freq_of_steps_to_run[sim_step]) + " Hz <<<  step", str(step), " from:", projects_to_run[proj])
-
-            # (over) Write the simulation .sif parameters for this instance:
-            two_lines = "$npart = " + str(step) + "\n$f = " + str(freq_of_steps_to_run[sim_step]) + " 		! Hz \n\n"
-            with open(os.path.join(projects_to_run[proj], generated_sif), 'w') as contents:
-                contents.write(two_lines + main_case_sif)  # overwrite case.sif with instructions for this step
-
-            if os.name == 'nt':  # Windows detected
-                log_file_handle = open(post_file + str(step) + "_log.txt", "w")  # create a log file for all print-outs
-                # run ElmerSolver & route all printouts to a log file
-                process = subprocess.Popen(
-                    os.path.join(root_elmer, elmersolver_executable), stdout=log_file_handle)
-
-            else:  # elif os.name == 'posix': # Linux or Mac detected
-                # run ElmerSolver & route all printouts to a log file
-                process = subprocess.Popen(
-                    elmersolver_executable + " >" + post_file + str(step) + "_log.txt", shell=True)
-
-            running_processes.append(process)  # store handle to the process
-
-            # optimize waiting time (important if available RAM >>> than needed RAM)
-            if sim_step > 0:  # on the not-first loop
-                # noinspection PyUnboundLocalVariable
-                if ram_info.available > max_elmersolver_ram * 3:  # if there is RAM for over (3-1) instances
-                    wait_time = 0.5  # practically do not wait if we have lots of RAM
-                elif ram_info.available > max_elmersolver_ram * 2:  # if there is 2x more RAM than necessary, speed up
-                    wait_time = sec_to_initialize / 2  # practically do not wait if we have lots of RAM
-                else:
-                    wait_time = sec_to_initialize  # wait properly to assess how muchRAM will be left
-                print("   ... waiting", str(wait_time), "s for current instance to initialize RAM")
+                    too_much_ram_load_strike = 0  # reset strikes
+
+                if total_cpu_load > max_cpu_load_percent:  # CPU limitation
+                    too_much_cpu_load_strike += 1  # count strikes
+                    print("   Waiting for less load on CPU:     ", str(total_cpu_load), "% CPU load   ("
+                          + str(max_cpu_load_percent), "% allowed | strike", str(too_much_cpu_load_strike) +
+                          ")  [", time.strftime("%d %b - %H:%M:%S", time.localtime()), "]")
+
+                elif any(prc['suspended'] for prc in running):  # paused instances continue first
+                    print("   ... waiting to resume", str(sum(1 for prc in running if prc['suspended'])),
+                          "paused instances before launching more   [",
+                          time.strftime("%d %b - %H:%M:%S", time.localtime()), "]")
+
+                elif ram_needed == 0:  # no RAM estimate yet
+                    print("   ... waiting for the 1st instance to initialize RAM")
+
+                else:  # RAM limitation
+                    print("   Waiting for more free RAM:     ",
+                          str(round((ram_info.available / 1073741824), 1)), "GB free    (" +
+                          str(round(((ram_reserved + ram_needed * ram_safety_factor) / 1073741824), 1)),
+                          "GB needed | strike", str(too_much_ram_load_strike) + ")   [",
+                          time.strftime("%d %b - %H:%M:%S", time.localtime()), "]")
+                    too_much_cpu_load_strike = 0  # reset strikes
+
+                if kill_processes_on_overload and len(running) > 1 and \
+                        (too_much_cpu_load_strike > 4 or too_much_ram_load_strike > 4):
+                    reason = 'CPU overload' if too_much_cpu_load_strike > 4 else 'RAM overload'
+                    active = [prc for prc in running if not prc['suspended']]
+                    if overload_action == 'suspend' and reason == 'CPU overload' and len(active) > 1:
+                        # time to preempt: the least progressed instance gives way (without losing its step)
+                        instance = min(active, key=lambda prc: prc['cpu_time'])
+                        if not instance['niced']:
+                            lower_priority(instance)
+                            event = 'renice'
+                            print("--- Lowered priority of step", str(instance['step']), "of",
+                                  os.path.basename(instance['project']), "to give CPU to other processes")
+                        else:
+                            preempt_instance(instance, 'suspend')
+                            event = 'suspend'
+                            print("--- Paused step", str(instance['step']), "of", os.path.basename(instance['project']),
+                                  "to free-up resources for other processes (will resume when possible)")
+                            # temporarily limit number of processes (slots = cores of the running instances)
+                            temp_max_instances = sum(prc['partitions'] * prc['threads'] for prc in running)
+                        if journal:
+                            journal_event(instance['project'], event, worker_id, {
+                                'steps': [member['step'] for member in entry_members(instance['entry'])],
+                                'reason': reason, 'cpu_time': round(instance['cpu_time'], 2), 'rss': instance['rss']})
+                    elif overload_action == 'kill' or reason == 'RAM overload':
+                        # time to kill processes due to prolonged resource overload - kill last started instance
+                        # (suspend: the least progressed instance - pausing it would not free its RAM)
+                        if overload_action == 'suspend':
+                            instance = min(running, key=lambda prc: prc['cpu_time'])
+                        else:
+                            instance = max(running, key=lambda prc: prc['launch_time'])
+                        print("XXX - Killing step", str(instance['step']), "of", os.path.basename(instance['project']),
+                              "to free-up resources for other processes (will re-try when possible)")
+                        instance['killed'] = True  # (re-queued once it has exited)
+                        instance['process'].kill()
+                        if journal:
+                            journal_event(instance['project'], 'kill', worker_id, {
+                                'steps': [member['step'] for member in entry_members(instance['entry'])],
+                                'reason': reason,
+                                'wall_time': round(time.time() - instance['launch_time'], 2),
+                                'peak_rss': instance['peak_rss']})
+                        # temporarily limit number of processes (slots = cores of the instances that keep running)
+                        temp_max_instances = sum(prc['partitions'] * prc['threads'] for prc in running) - \
+                            instance['partitions'] * instance['threads']
+                        if auto_set_max_instances and not placement:
+                            max_instances = 0  # mark that max instances should be checked again.
+                    too_much_cpu_load_strike = 0  # reset strikes
+                    too_much_ram_load_strike = 0  # reset strikes
+
+        if next_index is None:
+            # wait until an instance exits OR until it is time to re-check the resources (& put it back for 4.1)
+            try:
+                exit_events.put(exit_events.get(timeout=sec_to_initialize))
+            except queue.Empty:
+                pass
+            continue
+
+        # 4.4 START one more instance
+        temp_max_instances = 999999  # reset temporary limit
+        too_much_cpu_load_strike = 0  # reset strikes
+        too_much_ram_load_strike = 0  # reset strikes
+        if next_index == 0:
+            head_overtaken = 0
+        else:
+            head_overtaken += 1
+        entry = pending_steps.pop(next_index)
+        project = projects[entry['project']]
+
+        # double check (roughly) that this instance does not have output
+        if os.path.isfile(os.path.join(entry['project'], freq_file + str(entry['step']) + freq_file_ext)):
+            print(text_color_cyan, "Skipping step with output file", freq_file + str(entry['step']) + freq_file_ext,
+                  "--- because already has output data!")
+            print(text_color_reset + " ")
+            complete_step(project, entry['step'])
+            if journal:
+                journal_event(entry['project'], 'skipped', worker_id, {'step': entry['step'],
+                                                                        'reason': 'output file exists'})
+            if project_is_finished(project):
+                finish_project(entry['project'], project, cleanup_after_finish, text_color_cyan,
+                               text_color_red, text_color_reset, worker_id if distributed else '', result_store)
+            continue  # jump over this instance
+
+        if cache_dir != '' and run_with_heartbeat(restore_cached_step, (
+                cache_dir, entry, project, root_elmer, isolated_instances), held_steps(running, shipping),
+                worker_id if distributed else '', lease_seconds):  # (for example a refined step)
+            print("   step", str(entry['step']), "(" + str(entry['frequency']), "Hz) restored from the result cache")
+            complete_step(project, entry['step'])
+            if journal:
+                journal_event(entry['project'], 'cache_hit', worker_id, {'step': entry['step'],
+                                                                          'frequency': entry['frequency']})
+            if project_is_finished(project):
+                finish_project(entry['project'], project, cleanup_after_finish, text_color_cyan,
+                               text_color_red, text_color_reset, worker_id if distributed else '', result_store)
+            continue  # jump over this instance
+
+        if distributed:
+            if not claim_step(entry, worker_id, lease_seconds):
+                claimed_elsewhere.append(entry)  # another ElmerScanManager runs this step
+                set_step_state(project, entry['step'], 'running')
+                if journal:
+                    journal_event(entry['project'], 'claimed_elsewhere', worker_id, {'step': entry['step']})
+                continue
+            if os.path.isfile(os.path.join(entry['project'], freq_file + str(entry['step']) + freq_file_ext)):
+                release_step(entry, worker_id)  # was completed by another ElmerScanManager just now
+                pending_steps.insert(0, entry)  # will be skipped as completed in the next loop
+                continue
+
+        # group adjacent cheap steps of the same project into one ElmerSolver launch (saves start-up per step)
+        if batch_max_steps > 1:
+            entry = form_batch(pending_steps, entry, project, batch_max_steps, batch_target_wall_time,
+                               (lambda member: claim_step(member, worker_id, lease_seconds)) if distributed else None)
+
+        # serial ElmerSolver OR ElmerSolver_mpi for long steps when there are more free slots than steps left
+        partitions = 1
+        if mpi_max_partitions > 1:
+            partitions = choose_partitions(entry, project, len(pending_steps) + 1,
+                                           min(max_instances, temp_max_instances) -
+                                           sum(prc['partitions'] * prc['threads'] for prc in running),
+                                           psutil.virtual_memory().available - ram_reserved, ram_safety_factor,
+                                           mpi_max_partitions, mpi_min_wall_time)
+            # (ElmerGrid may run for minutes on big meshes: the leases of all held steps are renewed meanwhile)
+            if partitions > 1 and not run_with_heartbeat(prepare_partitioned_mesh, (
+                    entry['project'], step_discretisation(project, entry)[0], partitions, root_elmer),
+                    held_steps(running, shipping, entry), worker_id if distributed else '', lease_seconds):
+                print(text_color_red + "!!! ElmerGrid failed to partition the mesh into", str(partitions),
+                      "parts - step", str(entry['step']), "runs as a serial instance" + text_color_reset)
+                partitions = 1
+
+        # placement=True: own physical cores for this instance (more threads for steps of which fewer fit in RAM)
+        threads = 1
+        numa_node = None
+        cpus = []
+        if placement:
+            threads = choose_threads(entry, projects, len(pending_steps) + 1,
+                                     min(max_instances, temp_max_instances) -
+                                     sum(prc['partitions'] * prc['threads'] for prc in running),
+                                     psutil.virtual_memory().available - ram_reserved, ram_safety_factor,
+                                     ram_per_instance, max_threads, partitions)
+            numa_node, cpus, nr_cores = place_instance(cpu_topology, running, partitions * threads, partitions)
+            threads = max(1, nr_cores // partitions)
+
+        nr_launched += len(entry_members(entry))
+        mesh, element_order = step_discretisation(project, entry)
+        discretisation_info = ""
+        if project['discretisation'] is not None:
+            discretisation_info = "   (p:" + str(element_order) + ("" if mesh == project['mesh_dir'] else
+                                                                   ', mesh "' + mesh + '"') + ")"
+        if placement:
+            discretisation_info += "   (" + str(threads) + (" threads" if threads > 1 else " thread") + \
+                                   (" on NUMA node " + str(numa_node) if numa_node is not None else "") + ")"
+        if 'batch' in entry:
+            print("-", str(nr_launched) + "/" + str(total_nr_to_run), "Starting >>> " +
+                  str(entry['batch'][0]['frequency']), "...", str(entry['batch'][-1]['frequency']) +
+                  " Hz <<<  steps", str(entry['batch'][0]['step']) + "-" + str(entry['batch'][-1]['step']),
+                  " from:", entry['project'], "   (batch of", str(len(entry['batch'])), "steps)",
+                  "" if partitions == 1 else "   (MPI with " + str(partitions) + " partitions)", discretisation_info)
+        else:
+            print("-", str(nr_launched) + "/" + str(total_nr_to_run), "Starting >>> "
+                  + str(entry['frequency']) + " Hz <<<  step", str(entry['step']), " from:", entry['project'],
+                  "" if partitions == 1 else "   (MPI with " + str(partitions) + " partitions)", discretisation_info)
+        for member in entry_members(entry):
+            set_step_state(project, member['step'], 'running')
+        case_sif = project['case_sif']
+        if (mesh, element_order) != (project['mesh_dir'], project['element_order']):
+            case_sif = set_discretisation(case_sif, mesh, element_order, isolated_instances)
+        tuned = project['tuned'].get((mesh, element_order, octave_band(entry['frequency'])), 'sif')
+        if entry.get('profile', 0) > 0:  # re-try of a step that did not converge (on top of the .sif)
+            case_sif = apply_solver_profile(case_sif, solver_profiles[entry['profile']], partitions)
+            tuned = 'sif'
+        elif tuned != 'sif':  # the winner of autotune for this band
+            case_sif = apply_solver_profile(case_sif, tuning_profiles.get(tuned, {}), partitions)
+        warm_start_from = None
+        restart_file = None
+        if warm_start and partitions == 1:  # (MPI runs would need the solution in partitions)
+            restart_file = os.path.abspath(os.path.join(entry['project'], restart_dir, 'step_' + str(entry['step']) +
+                                                        '.result'))
+            if not entry.get('cold_start', False):
+                warm_start_from = warm_start_source(entry, project)
+            case_sif = set_restart(case_sif, restart_file, warm_start_from)
+        running.append(launch_instance(entry, case_sif, root_elmer, isolated_instances, exit_events,
+                                       partitions, mpi_launcher, threads if placement else 0, cpus,
+                                       scratch_project_dir(scratch_dir, entry['project']) if scratch_dir != '' else '',
+                                       numa_node))
+        running[-1]['restart_file'] = restart_file
+        running[-1]['warm_start_from'] = None if warm_start_from is None else warm_start_from['step']
+        if journal:
+            journal_event(entry['project'], 'launch', worker_id, {
+                'steps': [member['step'] for member in entry_members(entry)],
+                'frequencies': [member['frequency'] for member in entry_members(entry)],
+                'partitions': partitions, 'pid': running[-1]['process'].pid, 'element_order': element_order,
+                'mesh': mesh, 'warm_start_from': running[-1]['warm_start_from'], 'solver_profile': tuned,
+                'threads': threads, 'numa_node': numa_node, 'cpus': cpus,
+                'queue_wait': round(time.time() - entry_members(entry)[0].get('queue_time', time.time()), 2)})
+        if step_cost_model(project, entry) is not None and entry.get('profile', 0) == 0:
+            running[-1]['predicted_rss'] = predict_step_cost(step_cost_model(project, entry), entry['frequency'])[0] * \
+                                           (1 + mpi_ram_overhead * (partitions - 1))
+
+        if not isolated_instances:
+            # shared case.sif: wait for the current instance to read it before it is overwritten by the next one
+            ram_info = psutil.virtual_memory()
+            if len(running) > 1 and ram_info.available > ram_per_instance * 3:  # RAM for over (3-1) instances
+                wait_time = 0.5  # practically do not wait if we have lots of RAM
+            elif len(running) > 1 and ram_info.available > ram_per_instance * 2:  # 2x more RAM than necessary
+                wait_time = sec_to_initialize / 2
+            else:
+                wait_time = sec_to_initialize  # wait properly to assess how much RAM will be left
+            print("   ... waiting", str(wait_time), "s for current instance to initialize")
+            time.sleep(wait_time)
 
-            else:  # effectively: NC_ins == 0:
-                wait_time = sec_to_initialize  # always let the 1st instance to initialize to get worst-case RAM use
-                print("   ... waiting", str(sec_to_initialize), "s for the 1st instance to initialize RAM")
+    #  END of the main loop.
+    if metrics_file != '':
+        write_metrics(metrics_file, projects, running, pending_steps, claimed_elsewhere, max_instances,
+                      ram_per_instance, nr_launched)
+    if mover is not None:
+        mover.shutdown()
+        for project_folder in projects:
+            work_dir = scratch_project_dir(scratch_dir, project_folder)
+            if cleanup_after_finish and not distributed and os.path.isdir(work_dir):
+                # folders of failed attempts are deleted (re-created when re-tried). Folders with a completion marker
+                # hold results that could not be shipped - they are kept & shipped on the next launch
+                for a_dir in os.listdir(work_dir):
+                    if os.path.isdir(os.path.join(work_dir, a_dir)) and not any(
+                            c_file.startswith(freq_file) and c_file.endswith(freq_file_ext)
+                            for c_file in os.listdir(os.path.join(work_dir, a_dir))):
+                        shutil.rmtree(os.path.join(work_dir, a_dir), ignore_errors=True)
+                if len(os.listdir(work_dir)) == 0:
+                    os.rmdir(work_dir)
 
-            # Wait for current instance to initialize before attempting to start the next instance
-            time.sleep(wait_time)
+    # finalize
+    # # print("Total processing time with ElmerScanManager:   ", time.strftime("%H:%M:%S", time.time() - start_time))
+    print("ElmerScan project is COMPLETE.   ", time.strftime("%d %b - %H:%M:%S", time.localtime()))
 
-            # Check if all ElmerSolver processes crashed:    Find all ElmerSolver Processes
-            pid_name_bytes = [(p.pid, p.info['name'], p.info['memory_info'].rss) for p in
-                              psutil.process_iter(['name', 'memory_info']) if p.info['name'] == elmersolver_executable]
-            if len(pid_name_bytes) == 0:
-                print(text_color_red +
-                      "ERROR - ElmerSolver processes are NOT running! likely the last launched instance crashed.")
-                print(text_color_red + " Read " + post_file + str(step) + "_log.txt file for more details.")
-                input(text_color_red + "  -press Enter- to exit ElmerScanManager.")
-                raise Exception("not ok to continue")
+# END main
 
-        #  END of the main project loop.
 
-        print("waiting for last processes to finish (in this project)")
-        while True:
-            # Find all ElmerSolver Processes
-            pid_name_bytes = [(p.pid, p.info['name'], p.info['memory_info'].rss) for p in
-                              psutil.process_iter(['name', 'memory_info']) if p.info['name'] == elmersolver_executable]
+# function to convert the .unv meshes of all projects in start_path (in parallel, see "convert_mesh_unv_to_elmer.py")
+def convert_project_meshes(start_path, root_elmer, text_color_red, text_color_reset):
+    jobs = []  # [(unv file, mesh folder), ...]
+    for project in [start_path] + [os.path.join(start_path, subdir) for subdir in os.listdir(start_path)]:
+        if not os.path.isfile(os.path.join(project, main_solver_input)):
+            continue
+        unv_files = [a_file for a_file in os.listdir(project) if a_file.lower().endswith('.unv')]
+        if len(unv_files) == 1:
+            with open(os.path.join(project, main_solver_input), 'r') as contents:
+                mesh_dir = read_mesh_dir(contents.read())
+            jobs.append((os.path.join(project, unv_files[0]), os.path.normpath(os.path.join(project, mesh_dir))))
+        elif len(unv_files) > 1:
+            print("NOTE - more than one .unv file in " + project + " - its mesh is not converted.")
+    if len(jobs) > 0:
+        print("--- Converting", str(len(jobs)), ".unv meshes (unchanged meshes are skipped)")
+        for unv_path, status, error in convert_mesh_unv_to_elmer.convert_meshes(jobs, root_elmer):
+            if status == 'failed':
+                print(text_color_red + "ERROR - mesh conversion failed: " + unv_path + text_color_reset)
+
+
+# END convert_project_meshes
+
+
+# function to get the path of a required project file (mesh files are in the "Mesh DB" folder of the .sif)
+def required_file_path(project, calc_file):
+    if calc_file.startswith('mesh.') and os.path.isfile(os.path.join(project, main_solver_input)):
+        with open(os.path.join(project, main_solver_input), 'r') as contents:
+            return os.path.join(project, read_mesh_dir(contents.read()), calc_file)
+    return os.path.join(project, calc_file)
+
+
+# END required_file_path
+
+
+# function to read a sweep specification: rows "name value1 value2 ..." (values as written in the .sif, "!" starts a
+# comment). Returns all combinations [[(name, value), ...], ...] without duplicates (repeated values are ignored).
+def read_sweep_spec(project):
+    parameters = []  # [(name, [values])]
+    with open(os.path.join(project, sweep_spec_file), 'r') as contents:
+        for line in contents.readlines():
+            words = line.split('!')[0].split()
+            if len(words) == 1:
+                raise Exception("no values for " + words[0] + " in " + os.path.join(project, sweep_spec_file))
+            elif len(words) > 1:
+                values = []
+                for value in words[1:]:
+                    if value not in values:
+                        values.append(value)
+                parameters.append((words[0].lstrip('$'), values))
+    combinations = [[]]
+    for name, values in parameters:
+        combinations = [combination + [(name, value)] for combination in combinations for value in values]
+    unique_combinations = []
+    for combination in combinations:
+        if dict(combination) not in [dict(unique) for unique in unique_combinations]:  # (a name on multiple rows)
+            unique_combinations.append(combination)
+    return unique_combinations
+
+
+# END read_sweep_spec
+
+
+# function to set MATC variables in a .sif: existing "$ name = ..." lines get the new value, other variables are
+# defined in the first lines of the .sif
+def apply_sweep_parameters(case_sif, combination):
+    values = dict(combination)
+    new_lines = []
+    for line in case_sif.split('\n'):
+        stripped = line.strip()
+        if stripped.startswith('$') and '=' in stripped and stripped[1:].split('=')[0].strip() in values:
+            name = stripped[1:].split('=')[0].strip()
+            line = line[:len(line) - len(line.lstrip())] + '$ ' + name + ' = ' + values.pop(name)
+        new_lines.append(line)
+    header = ''.join('$ ' + name + ' = ' + value + '\n' for name, value in values.items())
+    return header + '\n'.join(new_lines)
+
+
+# END apply_sweep_parameters
+
+
+# function to replace projects that have a sweep specification by one generated project folder per combination of
+# sweep values. The generated folders (inside the project) get the .sif with the values of the combination (& with
+# the mesh of the project) + the frequency list of the project. Files are only re-written if their content changes.
+def expand_sweeps(all_projects):
+    expanded_projects = []
+    for project in all_projects:
+        if not os.path.isfile(os.path.join(project, sweep_spec_file)):
+            expanded_projects.append(project)
+            continue
+        with open(os.path.join(project, main_solver_input), 'r') as contents:
+            case_sif = relocate_sif_paths(contents.read())  # the mesh is one folder up
+        with open(os.path.join(project, main_frequencies_to_simulate), 'r') as contents:
+            frequencies = contents.read()
+        combinations = read_sweep_spec(project)
+        print("--- Sweep of", str(len(combinations)), "combinations in", project)
+        folder_names = [sweep_dir_prefix + '_'.join(
+            name + '=' + ''.join(c if c.isalnum() or c in '.-+' else '-' for c in value)
+            for name, value in combination) for combination in combinations]
+        for index, combination in enumerate(combinations):
+            folder_name = folder_names[index]
+            # different values can give the same folder name (characters that are replaced, OR upper & lower case on
+            # Windows & macOS): such variants get a short hash of their values as well
+            if sum(1 for other in folder_names if other.lower() == folder_name.lower()) > 1:
+                folder_name += '_' + hashlib.sha256(repr(combination).encode('utf8')).hexdigest()[:8]
+            variant = os.path.join(project, folder_name)
+            if not os.path.isdir(variant):
+                os.makedirs(variant)
+            for file_name, content in ((main_solver_input, apply_sweep_parameters(case_sif, combination)),
+                                       (main_frequencies_to_simulate, frequencies)):
+                old_content = None
+                if os.path.isfile(os.path.join(variant, file_name)):
+                    with open(os.path.join(variant, file_name), 'r') as contents:
+                        old_content = contents.read()
+                # (steps appended by adaptive refinement are kept)
+                if old_content is None or not old_content.startswith(content):
+                    with open(os.path.join(variant, file_name), 'w') as text_file:
+                        text_file.write(content)
+            expanded_projects.append(variant)
+    return expanded_projects
+
+
+# END expand_sweeps
 
-            if len(pid_name_bytes) == 0:
-                break  # no ElmerSolver processes are running, so Finish.
 
-            print("... waiting", str(2 * sec_to_initialize), "s for the last ElmerSolver instances to finish")
-            time.sleep(2 * sec_to_initialize)
+# function to find all unfinished instances in a given project folder + other problems & details
+def check_project(project, required_input_files, main_freq_to_simulate, freq_file, freq_f_ext, text_color_red):
+    # Check that all necessary project files are present:
+    for calc_file in required_input_files:
+        if not os.path.isfile(required_file_path(project, calc_file)):
+            print(text_color_red + "ERROR - Required project file " + calc_file + " is not found in folder:")
+            print(text_color_red + "         " + os.path.dirname(required_file_path(project, calc_file)))
+            input(text_color_red + "  -press Enter- to exit ElmerScanManager.")
+            raise Exception("not ok to continue")
 
-        # Clean-up
-        if cleanup_after_finish:  # cleanup_after_finish == TRUE
-            print("Cleaning away not-needed and confusing files after completion because cleanup_after_finish == True")
-            if os.path.isfile(os.path.join(projects_to_run[proj], generated_sif)):
-                os.remove(os.path.join(projects_to_run[proj], generated_sif))  # delete case.sif to not confuse
+    # the manifest remembers all steps & their state: the frequency file is only parsed again when it has changed
+    manifest = load_manifest(project)
+    manifest_changed = False  # (a finished project is checked without writing anything)
+    freq_file_stat = os.stat(os.path.join(project, main_freq_to_simulate))
+    if manifest is None or manifest['frequency_file'] != [freq_file_stat.st_mtime_ns, freq_file_stat.st_size]:
+        all_step_nr, frequencies = read_frequencies(project, main_freq_to_simulate)
+
+        # quick sanity check of input for duplicates:
+        if len(set(all_step_nr)) != len(all_step_nr):
+            print(text_color_red + "ERROR - " + main_freq_to_simulate + " file contains duplicate step numbers!")
+            print(text_color_red + "         in project " + project)
+            input(text_color_red + "  -press Enter- to exit ElmerScanManager.")
+            raise Exception("not ok to continue")
 
-            for a_file in os.listdir(projects_to_run[proj]):
-                if a_file.startswith(freq_file) & a_file.endswith(headers_to_delete):
-                    os.remove(os.path.join(projects_to_run[proj], a_file))  # delete all header files for frequency
+        old_steps = {} if manifest is None else manifest['steps']
+        manifest = {'frequency_file': [freq_file_stat.st_mtime_ns, freq_file_stat.st_size],
+                    'dir_mtime': None if manifest is None else manifest['dir_mtime'],
+                    'steps': dict((str(step), [frequency, old_steps.get(str(step), [0, 'pending'])[1]])
+                                  for step, frequency in zip(all_step_nr, frequencies))}
+        manifest_changed = True
 
-    #  END of all_projects loop.
+    # check already completed simulation steps:
+    if manifest['dir_mtime'] != os.stat(project).st_mtime_ns:  # files were added or deleted since the last check
+        # collect results of isolated instances that finished while ElmerScanManager was not running:
+        for a_dir in os.listdir(project):
+            if a_dir.startswith(instance_dir_prefix) and os.path.isdir(os.path.join(project, a_dir)):
+                collect_instance_outputs(project, os.path.join(project, a_dir))
 
-    os.chdir(working_dir)  # change back to initial directory (wrapping up)
+        # use the Frequency text file as proof of completed simulation because it is written After the main result .vtu
+        # file & is very small: likelihood that simulation is interrupted while this file is being written is very low.
+        completed = set()
+        for b_file in os.listdir(project):
+            if b_file.startswith(freq_file) and b_file.endswith(freq_f_ext):
+                completed.add(b_file[len(freq_file): -len(freq_f_ext)])  # (the step number as in the manifest)
+        for step in manifest['steps']:
+            manifest['steps'][step][1] = 'done' if step in completed else 'pending'
+        manifest['dir_mtime'] = os.stat(project).st_mtime_ns
+        manifest_changed = True
+    else:  # nothing was added or deleted: only the steps that were not completed need a look
+        for step in manifest['steps']:
+            if manifest['steps'][step][1] != 'done':
+                manifest['steps'][step][1] = 'done' if os.path.isfile(
+                    os.path.join(project, freq_file + step + freq_f_ext)) else 'pending'
+                manifest_changed = True
+    if manifest_changed:
+        save_manifest(project, manifest)
+
+    all_step_nr = [int(step) for step in manifest['steps']]
+    steps_to_run = []  # init list of steps        that need to be simulated
+    freq_of_steps_to_run = []  # init list of frequencies  that need to be simulated
+    for step in manifest['steps']:
+        if manifest['steps'][step][1] != 'done':
+            steps_to_run.append(int(step))
+            freq_of_steps_to_run.append(manifest['steps'][step][0])
 
-    # finalize
-    # # print("Total processing time with ElmerScanManager:   ", time.strftime("%H:%M:%S", time.time() - start_time))
-    print("ElmerScan project is COMPLETE.   ", time.strftime("%d %b - %H:%M:%S", time.localtime()))
+    return all_step_nr, steps_to_run, freq_of_steps_to_run
 
-# END main
 
+# END check_project
 
-# function to find all unfinished instances in a given project folder + other problems & details
-def check_project(project, required_input_files, main_freq_to_simulate, freq_file, freq_f_ext, text_color_red):
+
+# function to read the manifest of a project: {'frequency_file': [mtime, size] of the frequency file when it was
+# parsed, 'dir_mtime': modification time of the project folder when all states were checked,
+# 'steps': {step: [frequency, state]}} - state is 'pending', 'running', 'done' or 'failed'. None if there is none.
+def load_manifest(project):
+    # noinspection PyBroadException
+    try:
+        with open(os.path.join(project, manifest_file), 'r') as contents:
+            manifest = json.load(contents)
+        if isinstance(manifest, dict) and 'frequency_file' in manifest and 'steps' in manifest:
+            return manifest
+    except BaseException:
+        pass  # no manifest yet OR it is damaged - it is re-built from the project folder
+    return None
+
+
+# END load_manifest
+
+
+# function to (atomically) save the manifest of a project. Each save writes its own temporary file: in distributed
+# mode several ElmerScanManagers save the manifest of the same project.
+def save_manifest(project, manifest):
+    manifest_dir = os.path.dirname(os.path.join(project, manifest_file))
+    os.makedirs(manifest_dir, exist_ok=True)
+    file_handle, temp_path = tempfile.mkstemp(suffix='.tmp', dir=manifest_dir)
+    try:
+        with open(file_handle, 'w', encoding="utf8", newline="\n") as text_file:
+            json.dump(manifest, text_file)
+        os.replace(temp_path, os.path.join(project, manifest_file))
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+
+# END save_manifest
+
+
+# function to update the state of a step in the manifest of its project (saved by the main loop every now and then)
+def set_step_state(project, step, state):
+    if str(step) in project['manifest']['steps']:
+        project['manifest']['steps'][str(step)][1] = state
+
+
+# END set_step_state
+
+
+# function to mark a step of a project as completed (a step that is reported again - for example the completed step
+# of a stopped batch - is counted only once)
+def complete_step(project, step):
+    project['completed'].add(step)
+    set_step_state(project, step, 'done')
+
+
+# END complete_step
+
+
+# function to check if every step of a project has either completed OR failed & the project was not finished yet
+def project_is_finished(project):
+    return not project['finished'] and project['steps'] <= project['completed'] | set(project['failed'])
+
+
+# END project_is_finished
+
+
+# function to parse Main_frequencies_to_simulate .txt to get info about frequencies and instances
+def read_frequencies(project, main_freq_to_simulate):
     frequencies = []  # init  Values of frequency for each scanning step
     all_step_nr = []  # init  Numbers of each step. (it can be useful to explicitly simulate only specific numbers)
     step_counter: int = 0  # init  number of simulation steps (same as "len(frequencies)"  )
 
-    # Check that all necessary project files are present:
-    for calc_file in required_input_files:
-        if not os.path.isfile(os.path.join(project, calc_file)):
-            print(text_color_red + "ERROR - Required project file " + calc_file + " is not found in folder:")
-            print(text_color_red + "         " + project)
-            input(text_color_red + "  -press Enter- to exit ElmerScanManager.")
-            raise Exception("not ok to continue")
-
-    # parse Main_frequencies_to_simulate .txt to get info about frequencies and instances
     # open file, iterate over lines, append values (accepts . and , separated decimals but no thousand separators)
     with open(os.path.join(project, main_freq_to_simulate), 'r') as f:
         for line in f.readlines():
@@ -518,31 +1628,1914 @@ def check_project(project, required_input_files, main_freq_to_simulate, freq_fil
                 all_step_nr.append(int(_line[0]))
             elif not len(_line) == 0:  # empty lines are OK - just skip
                 raise Exception("incompatible " + main_freq_to_simulate + " file!")
+    return all_step_nr, frequencies
+
+
+# END read_frequencies
+
+
+# function to order the queued steps of one project according to "step_order":
+#   'largest_first'  - highest frequency first: the worst-case RAM is known early (the steps are already in this order)
+#   'shortest_first' - shortest predicted run time first (without cost model: lowest frequency first) for many
+#                      results soon
+#   'coarse_to_fine' - every 8th step (by frequency), then the steps in between, etc. partial results cover the whole
+#                      frequency band early (highest frequency first within each level)
+#   'longest_first'  - longest predicted run time first (LPT) to shorten the total run time (makespan): short steps
+#                      fill up the gaps at the end (without cost model: same as 'largest_first')
+# (predictions need a cost model for the discretisation of every step, see "step_cost_model")
+def order_steps(pending, project, step_order):
+    predictable = all(step_cost_model(project, entry) is not None for entry in pending)
+    if step_order == 'shortest_first':
+        if not predictable:
+            return sorted(pending, key=lambda entry: entry['frequency'])
+        return sorted(pending, key=lambda entry: predict_step_cost(step_cost_model(project, entry),
+                                                                   entry['frequency'])[1])
+    elif step_order == 'longest_first' and predictable:
+        return sorted(pending, key=lambda entry: predict_step_cost(step_cost_model(project, entry),
+                                                                   entry['frequency'])[1], reverse=True)
+    elif step_order == 'coarse_to_fine':
+        by_frequency = sorted(pending, key=lambda entry: entry['frequency'])
+        stride = 1
+        while stride * 2 < len(by_frequency):
+            stride *= 2
+        ordered = []
+        taken = set()  # indexes in by_frequency
+        while stride >= 1:
+            for index in reversed(range(0, len(by_frequency), stride)):
+                if index not in taken:
+                    ordered.append(by_frequency[index])
+                    taken.add(index)
+            stride = stride // 2
+        return ordered
+    return pending
+
+
+# END order_steps
+
+
+# function to build one queue of steps from all projects according to "project_policy":
+#   'priority' - projects are run in the order they were found (steps of later projects only fill up free resources)
+#   'fair'     - steps of all projects are interleaved one by one (all projects progress at the same pace)
+def order_project_steps(projects, project_policy):
+    project_list = sorted(projects.values(), key=lambda prj: prj['priority'])
+    pending_steps = []
+    if project_policy == 'fair':
+        for index in range(max([len(prj['pending']) for prj in project_list] + [0])):
+            pending_steps.extend(prj['pending'][index] for prj in project_list if index < len(prj['pending']))
+    else:
+        for prj in project_list:
+            pending_steps.extend(prj['pending'])
+    return pending_steps
+
+
+# END order_project_steps
+
+
+# function to estimate RAM need of a queued step: predicted by the cost model of its project if available,
+# otherwise RAM of the biggest initialized instance (0 = not known yet)
+def step_ram_need(entry, projects, ram_per_instance):
+    cost_model = step_cost_model(projects[entry['project']], entry)
+    if cost_model is not None:
+        return predict_step_cost(cost_model, entry['frequency'])[0]
+    return ram_per_instance
+
+
+# END step_ram_need
+
+
+# function to find the first queued step that fits into free RAM (first-fit packing). Steps behind the first one
+# may only be used while "allow_overtaking" - so that a big step is not postponed forever by smaller steps.
+def fit_next_step(pending_steps, projects, ram_per_instance, free_ram, ram_safety_factor, allow_overtaking):
+    for index in range(len(pending_steps) if allow_overtaking else 1):
+        ram_needed = step_ram_need(pending_steps[index], projects, ram_per_instance)
+        if 0 < ram_needed * ram_safety_factor < free_ram:
+            return index
+    return None
+
+
+# END fit_next_step
+
+
+# function to print the final status of a project & clean-up its folder once all of its steps have finished
+# (worker_id is only given in distributed mode: folders of steps leased by other ElmerScanManagers are kept)
+def finish_project(project_folder, project, cleanup_after_finish, text_color_cyan, text_color_red, text_color_reset,
+                   worker_id='', result_store=False):
+    project['finished'] = True
+    print(text_color_cyan + "--- Project " + project_folder + " is finished: " + str(len(project['completed'])) +
+          "/" + str(len(project['steps'])) + " steps completed   [" +
+          time.strftime("%d %b - %H:%M:%S", time.localtime()) + "]" + text_color_reset)
+    if len(project['failed']) > 0:
+        print(text_color_red + "WARNING - " + str(len(project['failed'])) + " steps did not complete: " +
+              str(project['failed']) + " - re-launch ElmerScanManager to re-try them." + text_color_reset)
+
+    if len(project['iterations']) > 0:  # warm_start: is the initial guess worth it?
+        print_warm_start_report(project['iterations'])
+
+    # collect steps that are not yet in the result store (before .csv.names files are deleted). In distributed mode
+    # only one ElmerScanManager at a time writes it (SQLite locking is not reliable on network file systems)
+    if result_store and (worker_id == '' or claim_result_store(project_folder, worker_id)):
+        all_steps, frequencies = read_frequencies(project_folder, main_frequencies_to_simulate)
+        try:
+            store_step_results(project_folder, list(zip(all_steps, frequencies)))
+        finally:
+            if worker_id != '':
+                os.remove(os.path.join(project_folder, result_store_file + lease_file_ext))
+
+    # Clean-up
+    if cleanup_after_finish:  # cleanup_after_finish == TRUE
+        print("Cleaning away not-needed and confusing files after completion because cleanup_after_finish == True")
+        if os.path.isfile(os.path.join(project_folder, generated_sif)):
+            os.remove(os.path.join(project_folder, generated_sif))  # delete case.sif to not confuse
+
+        for a_file in os.listdir(project_folder):
+            if a_file.startswith(freq_file) & a_file.endswith(headers_to_delete):
+                os.remove(os.path.join(project_folder, a_file))  # delete all header files for frequency
+            elif a_file == restart_dir:  # (solutions for warm_start are as big as the results)
+                shutil.rmtree(os.path.join(project_folder, a_file), ignore_errors=True)
+            elif a_file.startswith(instance_dir_prefix):
+                # instance folders are only left behind by crashed or killed instances (or run by other managers)
+                if worker_id == '' or not os.path.isfile(os.path.join(
+                        project_folder, freq_file + a_file[len(instance_dir_prefix):] + lease_file_ext)):
+                    shutil.rmtree(os.path.join(project_folder, a_file), ignore_errors=True)
+
+    # the folder content now matches the state of all steps: the next "check_project" does not need to list it
+    project['manifest']['dir_mtime'] = os.stat(project_folder).st_mtime_ns
+    save_manifest(project_folder, project['manifest'])
+
+
+# END finish_project
+
+
+# function to atomically claim a step for this ElmerScanManager (distributed mode) by creating its lease file next to
+# the "case_frequency_ .csv" marker. Returns False if another manager holds a valid lease. Leases that were not
+# renewed for lease_seconds belong to a stopped manager and are taken over: the stale lease is renamed away first &
+# checked after the rename - if another manager has replaced it in the meantime, its fresh lease is put back.
+def claim_step(entry, worker_id, lease_seconds):
+    lease_path = os.path.join(entry['project'], freq_file + str(entry['step']) + lease_file_ext)
+    for attempt in range(2):
+        try:
+            lease_handle = os.open(lease_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            stale_lease = read_lease(lease_path)
+            if stale_lease is None:
+                continue  # deleted just now - try again
+            if not lease_expired(stale_lease[1] / 1e9, lease_seconds):
+                return False
+            expired_path = lease_path + '.' + worker_id.replace(':', '_') + '.expired'
+            try:
+                os.rename(lease_path, expired_path)
+            except OSError:
+                continue  # another manager was faster
+            if read_lease(expired_path) != stale_lease:  # not the lease that was judged - a fresh one
+                # noinspection PyBroadException
+                try:
+                    os.rename(expired_path, lease_path)
+                except BaseException:
+                    pass
+                return False
+            os.remove(expired_path)
+            continue
+        with os.fdopen(lease_handle, 'w') as lease_file:
+            lease_file.write(worker_id + '\n')
+        return True
+    return False
 
-    # quick sanity check of input for duplicates:
-    if len(set(all_step_nr)) != len(all_step_nr):
-        print(text_color_red + "ERROR - " + main_freq_to_simulate + " file contains duplicate step numbers!")
-        print(text_color_red + "         in project " + project)
-        input(text_color_red + "  -press Enter- to exit ElmerScanManager.")
-        raise Exception("not ok to continue")
 
-    # check already completed simulation steps:
-    steps_to_run = all_step_nr.copy()  # init list of steps        that need to be simulated
-    freq_of_steps_to_run = frequencies.copy()  # init list of frequencies  that need to be simulated
-    for b_file in os.listdir(project):
-        # use the Frequency text file as proof of completed simulation because it is written After the main result .vtu
-        # file & is very small: likelihood that simulation is interrupted while this file is being written is very low.
-        if b_file.startswith(freq_file) & b_file.endswith(freq_f_ext):
-            this_all_step_nr = int(b_file[len(freq_file): -len(freq_f_ext)])
-            index_to_drop = steps_to_run.index(this_all_step_nr)
-            # Drop this scanning simulation step of the to-do list
-            del steps_to_run[index_to_drop]
-            del freq_of_steps_to_run[index_to_drop]
+# END claim_step
 
-    return all_step_nr, steps_to_run, freq_of_steps_to_run
 
+# function to read a lease file: (owner, modification time in ns) OR None if there is no lease
+def read_lease(lease_path):
+    try:
+        with open(lease_path, 'r') as lease_file:
+            owner = lease_file.read().strip()
+        return owner, os.stat(lease_path).st_mtime_ns
+    except OSError:
+        return None
 
-# END check_project
+
+# END read_lease
+
+
+# function to check if a step has a valid (recently renewed) lease of any ElmerScanManager
+def step_is_claimed(entry, lease_seconds):
+    try:
+        lease_time = os.path.getmtime(os.path.join(entry['project'], freq_file + str(entry['step']) + lease_file_ext))
+    except OSError:
+        return False  # no lease
+    return not lease_expired(lease_time, lease_seconds)
+
+
+# END step_is_claimed
+
+
+# function to check if a lease (OR lock) file with the given modification time was not renewed for lease_seconds.
+# The modification time may come from the clock of another computer (OR the file server): lease_clock_margin more
+# seconds have to pass, so a manager with a clock that runs ahead does not take over leases that are still renewed.
+def lease_expired(lease_time, lease_seconds):
+    return time.time() - lease_time > lease_seconds + lease_clock_margin
+
+
+# END lease_expired
+
+
+# function to run a long task (partitioning a mesh, copying results of the result cache) in a thread & renew the
+# leases of all steps held by this ElmerScanManager meanwhile (distributed mode heartbeat - otherwise other managers
+# would take the steps over when the task takes longer than lease_seconds). Returns the result of the task.
+def run_with_heartbeat(task, args, held_steps, worker_id, lease_seconds):
+    if worker_id == '' or len(held_steps) == 0:
+        return task(*args)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        future = executor.submit(task, *args)
+        while True:
+            try:
+                return future.result(timeout=lease_seconds / 4)
+            except concurrent.futures.TimeoutError:
+                for entry in held_steps:
+                    renew_step(entry, worker_id)  # (a lost lease is noticed by the next heartbeat of the main loop)
+
+
+# END run_with_heartbeat
+
+
+# function to list the steps whose leases are held by this ElmerScanManager: steps of running instances, of instances
+# whose results are being shipped & of the entry that is being launched
+def held_steps(running, shipping, entry=None):
+    steps = [member for instance in running + shipping if not instance['lease_lost']
+             for member in entry_members(instance['entry'])]
+    if entry is not None:
+        steps += entry_members(entry)
+    return steps
+
+
+# END held_steps
+
+
+# function to renew the lease of a running step (heartbeat). Returns False if the lease is no longer owned by this
+# ElmerScanManager (taken over by another manager) - the step has to be given up.
+def renew_step(entry, worker_id):
+    lease_path = os.path.join(entry['project'], freq_file + str(entry['step']) + lease_file_ext)
+    lease = read_lease(lease_path)
+    if lease is None or lease[0] != worker_id:
+        return False
+    # noinspection PyBroadException
+    try:
+        os.utime(lease_path, None)
+    except BaseException:
+        pass
+    return True
+
+
+# END renew_step
+
+
+# function to delete the lease of a step if it is (still) owned by this ElmerScanManager
+def release_step(entry, worker_id):
+    lease_path = os.path.join(entry['project'], freq_file + str(entry['step']) + lease_file_ext)
+    # noinspection PyBroadException
+    try:
+        with open(lease_path, 'r') as lease_file:
+            owner = lease_file.read().strip()
+        if owner == worker_id:
+            os.remove(lease_path)
+    except BaseException:
+        pass
+
+
+# END release_step
+
+
+# function to re-point relative "Mesh DB" & "Include Path" entries of a .sif one folder up. This way the case.sif
+# generated inside an instance folder (see "isolated_instances") still uses the shared mesh of the project folder.
+def relocate_sif_paths(case_sif):
+    relocated_lines = []
+    for line in case_sif.split('\n'):
+        if line.strip().lower().startswith(('mesh db', 'include path')):
+            parts = line.split('"')  # for example:  ['  Mesh DB ', '.', ' ', '.', '']
+            if len(parts) >= 3 and not os.path.isabs(parts[1]):
+                parts[1] = posixpath.normpath(posixpath.join('..', parts[1].replace('\\', '/')))
+                line = '"'.join(parts)
+        relocated_lines.append(line)
+    return '\n'.join(relocated_lines)
+
+
+# END relocate_sif_paths
+
+
+# function to make relative "Mesh DB" & "Include Path" entries of a .sif absolute (relative to base_dir). This way the
+# case.sif of an instance folder in scratch_dir still uses the mesh of the project folder.
+def anchor_sif_paths(case_sif, base_dir):
+    anchored_lines = []
+    for line in case_sif.split('\n'):
+        if line.strip().lower().startswith(('mesh db', 'include path')):
+            parts = line.split('"')
+            if len(parts) >= 3 and not os.path.isabs(parts[1]):
+                parts[1] = os.path.normpath(os.path.join(os.path.abspath(base_dir), parts[1])).replace('\\', '/')
+                line = '"'.join(parts)
+        anchored_lines.append(line)
+    return '\n'.join(anchored_lines)
+
+
+# END anchor_sif_paths
+
+
+# function to (re)create the private working folder of one instance with its own case.sif & ELMERSOLVER_STARTINFO
+def prepare_instance_dir(instance_dir, case_sif, batch_steps=()):
+    if os.path.isdir(instance_dir):
+        shutil.rmtree(instance_dir)  # remove leftovers of a crashed or killed attempt
+    os.makedirs(instance_dir)
+    with open(os.path.join(instance_dir, generated_sif), 'w') as contents:
+        contents.write(case_sif)
+    with open(os.path.join(instance_dir, start_info_file), "w", encoding="utf8", newline="\n") as text_file:
+        text_file.write(generated_sif + "\n1\n")  # first & second lines
+    if len(batch_steps) > 1:  # tells "collect_instance_outputs" which step each row of the .csv file belongs to
+        with open(os.path.join(instance_dir, batch_steps_file), 'w') as text_file:
+            text_file.write("\n".join(str(step) for step in batch_steps) + "\n")
+
+
+# END prepare_instance_dir
+
+
+# function to move results of a finished instance folder into the project folder & delete the instance folder.
+# The "case_frequency_ .csv" file is moved last, so an interrupted move is simply re-simulated on the next launch.
+def collect_instance_outputs(project, instance_dir, compress_vtu=False):
+    results = os.listdir(instance_dir)
+    markers = []
+    for c_file in results:
+        if c_file.startswith(freq_file) and c_file.endswith(freq_file_ext):
+            with open(os.path.join(instance_dir, c_file), 'r') as contents:
+                empty = contents.read().strip() == ''
+            if empty:  # ElmerSolver was stopped while writing it - the step(s) did not complete
+                os.remove(os.path.join(instance_dir, c_file))
+                continue
+            markers.append(c_file)
+    if len(markers) == 0:
+        return False  # not finished (or crashed) - nothing to collect
+
+    batch_steps = []
+    if batch_steps_file in results:  # batch: one row in the .csv file of the first step per completed step
+        with open(os.path.join(instance_dir, batch_steps_file), 'r') as text_file:
+            batch_steps = [int(line) for line in text_file.read().split()]
+        with open(os.path.join(instance_dir, markers[0]), 'r') as contents:
+            batch_rows = [line for line in contents.readlines() if line.strip() != '']
+        batch_names = ''
+        if markers[0] + '.names' in results:
+            with open(os.path.join(instance_dir, markers[0] + '.names'), 'r') as contents:
+                batch_names = contents.read()
+
+    for c_file in results:
+        if c_file not in markers and c_file not in (generated_sif, start_info_file, batch_steps_file) and \
+                os.path.isfile(os.path.join(instance_dir, c_file)):
+            move_output(os.path.join(instance_dir, c_file), os.path.join(project, c_file), compress_vtu)
+    if len(batch_steps) > 0:
+        # write the completion markers of later steps first (the file of the first step is moved last)
+        for step, row in list(zip(batch_steps, batch_rows))[1:]:
+            if batch_names != '':
+                with open(os.path.join(project, freq_file + str(step) + freq_file_ext + '.names'), 'w') as contents:
+                    contents.write(batch_names)
+            with open(os.path.join(project, freq_file + str(step) + freq_file_ext), 'w') as contents:
+                contents.write(row)
+        with open(os.path.join(instance_dir, markers[0]), 'w') as contents:
+            contents.write(batch_rows[0])  # only the row of the first step
+    for c_file in markers:
+        move_output(os.path.join(instance_dir, c_file), os.path.join(project, c_file))
+    shutil.rmtree(instance_dir, ignore_errors=True)
+    return True
+
+
+# END collect_instance_outputs
+
+
+# function to move one result file into the project folder. Across file systems (scratch_dir) the file is copied
+# under a temporary name first, so a file with the final name is always complete.
+def move_output(source, target, compress_vtu=False):
+    if compress_vtu and source.endswith('.vtu'):
+        compress_vtu_file(source, target + '.tmp')
+    else:
+        try:
+            os.replace(source, target)
+            return
+        except OSError:  # another file system
+            shutil.copyfile(source, target + '.tmp')
+    os.replace(target + '.tmp', target)
+    os.remove(source)
+
+
+# END move_output
+
+
+# function to re-write a .vtu file with "raw" appended data (as written by ElmerSolver) with zlib compressed data
+# blocks (VTK "vtkZLibDataCompressor" format). Other .vtu files (ASCII, base64 or already compressed) are copied.
+def compress_vtu_file(source, target, block_size=1048576):
+    with open(source, 'rb') as contents:
+        data = contents.read()
+    appended = data.find(b'<AppendedData encoding="raw">')
+    xml_head = data[:max(0, appended)].decode('utf8', errors='replace')
+    if appended < 0 or 'compressor=' in xml_head:
+        shutil.copyfile(source, target)
+        return
+    raw_start = data.index(b'_', appended) + 1  # the binary data starts after "_"
+    size_format = ('>' if 'byte_order="BigEndian"' in xml_head else '<') + \
+                  ('Q' if 'header_type="UInt64"' in xml_head else 'I')
+    header_size = struct.calcsize(size_format)
+
+    compressed_arrays = []
+    new_offsets = {}
+    new_offset = 0
+    for offset in sorted(set(int(value) for value in re.findall(r'offset="(\d+)"', xml_head))):
+        size = struct.unpack_from(size_format, data, raw_start + offset)[0]
+        array_data = data[raw_start + offset + header_size: raw_start + offset + header_size + size]
+        blocks = [zlib.compress(array_data[start:start + block_size]) for start in range(0, size, block_size)]
+        # header: number of blocks, block size, size of the last (partial) block, compressed size of each block
+        header = [len(blocks), block_size, size % block_size] + [len(block) for block in blocks]
+        compressed_arrays.append(struct.pack(size_format[0] + size_format[1] * len(header), *header) +
+                                 b''.join(blocks))
+        new_offsets[offset] = new_offset
+        new_offset += len(compressed_arrays[-1])
+    xml_head = re.sub(r'offset="(\d+)"', lambda match: 'offset="' + str(new_offsets[int(match.group(1))]) + '"',
+                      xml_head)
+    xml_head = xml_head.replace('<VTKFile ', '<VTKFile compressor="vtkZLibDataCompressor" ', 1)
+
+    with open(target, 'wb') as contents:
+        contents.write(xml_head.encode('utf8') + data[appended:raw_start])
+        for compressed_array in compressed_arrays:
+            contents.write(compressed_array)
+        contents.write(b'\n  ' + data[data.rfind(b'</AppendedData>'):])
+
+
+# END compress_vtu_file
+
+
+# function to get the folder of a project inside scratch_dir (the hash of the full path keeps projects with the same
+# folder name apart)
+def scratch_project_dir(scratch_dir, project_folder):
+    path_hash = hashlib.sha256(os.path.abspath(project_folder).encode('utf8')).hexdigest()[:10]
+    return os.path.join(scratch_dir, os.path.basename(os.path.abspath(project_folder)) + '_' + path_hash)
+
+
+# END scratch_project_dir
+
+
+# function to get the size of all files in a folder & its sub-folders (bytes)
+def folder_size(folder):
+    size = 0
+    for sub_folder, sub_folders, files in os.walk(folder):
+        for a_file in files:
+            # noinspection PyBroadException
+            try:
+                size += os.path.getsize(os.path.join(sub_folder, a_file))
+            except BaseException:
+                pass
+    return size
+
+
+# END folder_size
+
+
+# function (mover thread) to ship the results of an exited instance from scratch_dir to its project folder. The
+# instance is then reported to the main loop again (its step is complete once its "case_frequency_ .csv" arrived).
+def ship_instance_outputs(instance, compress_vtu, exit_events):
+    # noinspection PyBroadException
+    try:
+        if collect_instance_outputs(instance['project'], instance['dir'], compress_vtu):
+            instance['dir'] = None  # (nothing left to collect)
+    except BaseException as error:
+        print('!!! Failed to ship the results of step', str(instance['step']), 'from "' + instance['dir'] + '":',
+              str(error), '(the folder is kept - its results are shipped on the next launch)')
+        instance['dir'] = None  # (not collected again now - the step counts as failed in this run)
+    exit_events.put(instance)
+
+
+# END ship_instance_outputs
+
+
+# function to ship results of instance folders in scratch_dir that were not shipped when ElmerScanManager stopped
+def collect_scratch_outputs(project_folder, scratch_dir, compress_vtu):
+    work_dir = scratch_project_dir(scratch_dir, project_folder)
+    if os.path.isdir(work_dir):
+        for a_dir in os.listdir(work_dir):
+            if a_dir.startswith(instance_dir_prefix) and os.path.isdir(os.path.join(work_dir, a_dir)):
+                collect_instance_outputs(project_folder, os.path.join(work_dir, a_dir), compress_vtu)
+
+
+# END collect_scratch_outputs
+
+
+# function to start one ElmerSolver instance of a queued step (entry) & hand its process over to a watcher thread.
+# Returns the "instance" dictionary used for bookkeeping by the main loop.
+def launch_instance(entry, case_sif, root_elmer, isolated_instances, exit_events, partitions=1, mpi_launcher='',
+                    threads=0, cpus=(), work_dir='', numa_node=None):
+    project, step, frequency = entry['project'], entry['step'], entry['frequency']
+    # (over) Write the simulation .sif parameters for this instance:
+    two_lines = "$npart = " + str(step) + "\n$f = " + str(frequency) + " 		! Hz \n\n"
+    batch_steps = []
+    if 'batch' in entry:  # one Scanning timestep per step: f(tx - 1) picks the frequency of each timestep
+        batch_steps = [member['step'] for member in entry['batch']]
+        two_lines = "$npart = " + str(step) + "\n$f = [" + \
+                    " ".join(str(member['frequency']) for member in entry['batch']) + "] 		! Hz \n\n"
+        case_sif = set_timestep_intervals(case_sif, len(batch_steps))
+    if isolated_instances:  # private case.sif + ELMERSOLVER_STARTINFO in the own folder of this instance
+        instance_dir = os.path.join(project, instance_dir_prefix + str(step))
+        if work_dir != '':  # (scratch_dir) the relative paths of the .sif point from the project to the mesh
+            case_sif = anchor_sif_paths(case_sif, instance_dir)
+            instance_dir = os.path.join(work_dir, instance_dir_prefix + str(step))
+        prepare_instance_dir(instance_dir, two_lines + case_sif, batch_steps)
+    else:
+        instance_dir = project
+        with open(os.path.join(project, generated_sif), 'w') as contents:
+            contents.write(two_lines + case_sif)  # overwrite case.sif with instructions for this step
+
+    # OpenMP & BLAS threads of each ElmerSolver (threads=0: the environment of ElmerScanManager is not changed)
+    environment = None
+    if threads > 0:
+        environment = dict(os.environ)
+        for variable in thread_variables:
+            environment[variable] = str(threads)
+        environment['OMP_PROC_BIND'] = 'close'  # threads stay on their own cores
+        environment['OMP_PLACES'] = 'cores'
+
+    # CPU affinity (& RAM of the NUMA node) are set by numactl OR taskset before ElmerSolver starts (Linux): OpenMP
+    # builds its thread places from the CPUs it may use when the library is loaded. Both replace themselves with
+    # ElmerSolver (exec), so the process handle stays the ElmerSolver itself.
+    pinning = []
+    if len(cpus) > 0:
+        pinning = cpu_pinning_command(cpus, numa_node)
+
+    # run ElmerSolver & route all printouts to a log file in the project folder. No shell is used, so the
+    # process handle (and its pid) is the ElmerSolver itself (OR the MPI launcher of ElmerSolver_mpi processes).
+    log_file_handle = open(os.path.join(project, post_file + str(step) + "_log.txt"), "w")
+    if partitions > 1:
+        process = subprocess.Popen(pinning + mpi_launcher.format(np=partitions).split() +
+                                   [os.path.join(root_elmer, elmersolver_mpi_executable)],
+                                   stdout=log_file_handle, cwd=instance_dir, env=environment)
+    else:
+        process = subprocess.Popen(
+            pinning + [os.path.join(root_elmer, elmersolver_executable)], stdout=log_file_handle, cwd=instance_dir,
+            env=environment)
+    if len(cpus) > 0 and len(pinning) == 0 and hasattr(psutil.Process, 'cpu_affinity'):  # Windows OR no taskset
+        # noinspection PyBroadException
+        try:  # right after the start: threads & MPI processes started later inherit the CPUs
+            psutil.Process(process.pid).cpu_affinity(list(cpus))
+        except BaseException:
+            pass  # the instance has just exited
+
+    instance = {'entry': entry, 'project': project, 'step': step, 'frequency': frequency, 'process': process,
+                'log': log_file_handle, 'dir': instance_dir if isolated_instances else None,
+                'launch_time': time.time(), 'rss': 0, 'peak_rss': 0, 'cpu_time': 0.0, 'predicted_rss': 0,
+                'partitions': partitions, 'threads': max(1, threads), 'cpus': list(cpus), 'killed': False,
+                'lease_lost': False, 'niced': False, 'suspended': False, 'suspend_time': 0.0, 'suspended_time': 0.0,
+                'log_offset': 0, 'iteration': 0, 'best_residual': None, 'best_iteration': 0, 'escalate_to': None,
+                'restart_file': None, 'warm_start_from': None, 'staged_bytes': 0}
+    threading.Thread(target=watch_instance, args=(instance, exit_events), daemon=True).start()
+    return instance
+
+
+# END launch_instance
+
+
+# function (watcher thread) that blocks until the instance exits (reaps the child process) & reports it to main loop
+def watch_instance(instance, exit_events):
+    instance['process'].wait()
+    exit_events.put(instance)
+
+
+# END watch_instance
+
+
+# function to wrap up an exited instance: returns 'done', 'killed' or 'failed'
+def finish_instance(instance):
+    instance['log'].close()
+    if instance['dir'] is not None:
+        collect_instance_outputs(instance['project'], instance['dir'])
+    if all(os.path.isfile(os.path.join(instance['project'], freq_file + str(member['step']) + freq_file_ext))
+           for member in entry_members(instance['entry'])):
+        return 'done'
+    elif instance['killed']:
+        return 'killed'
+    return 'failed'
+
+
+# END finish_instance
+
+
+# function to update current & peak RAM usage + CPU time of an own instance (nothing changes once it has exited)
+def sample_instance(instance):
+    # noinspection PyBroadException
+    try:
+        prc_info = psutil.Process(instance['process'].pid)
+        rss = 0
+        cpu_time = 0.0
+        for prc in [prc_info] + prc_info.children(recursive=True):  # + all ElmerSolver_mpi processes of MPI runs
+            with prc.oneshot():
+                rss += prc.memory_info().rss
+                cpu_times = prc.cpu_times()
+            cpu_time += cpu_times.user + cpu_times.system
+        instance['rss'] = rss
+        instance['peak_rss'] = max(instance['peak_rss'], rss)
+        instance['cpu_time'] = max(instance['cpu_time'], cpu_time)
+    except BaseException:
+        instance['rss'] = 0
+
+
+# END sample_instance
+
+
+# function to pause ('suspend' = SIGSTOP) OR continue ('resume' = SIGCONT) an own instance with all its child processes
+# (the ElmerSolver_mpi processes of MPI runs). A paused instance uses no CPU & keeps its RAM (the OS may swap it out).
+def preempt_instance(instance, action):
+    # noinspection PyBroadException
+    try:
+        prc_info = psutil.Process(instance['process'].pid)
+        for prc in [prc_info] + prc_info.children(recursive=True):
+            if action == 'suspend':
+                prc.suspend()
+            else:
+                prc.resume()
+    except BaseException:
+        pass  # the instance has just exited
+    instance['suspended'] = action == 'suspend'
+    if instance['suspended']:
+        instance['suspend_time'] = time.time()
+
+
+# END preempt_instance
+
+
+# function to lower the CPU priority of an own instance with all its child processes (for the rest of its run -
+# raising the priority back is not allowed without admin rights)
+def lower_priority(instance):
+    # noinspection PyBroadException
+    try:
+        prc_info = psutil.Process(instance['process'].pid)
+        for prc in [prc_info] + prc_info.children(recursive=True):
+            prc.nice(psutil.BELOW_NORMAL_PRIORITY_CLASS if os.name == 'nt' else 10)
+    except BaseException:
+        pass  # the instance has just exited
+    instance['niced'] = True
+
+
+# END lower_priority
+
+
+# function (registered with atexit) to continue all paused instances when ElmerScanManager stops (for example Ctrl+C)
+def resume_suspended_instances(running):
+    for instance in running:
+        if instance['suspended']:
+            preempt_instance(instance, 'resume')
+
+
+# END resume_suspended_instances
+
+
+# function to get system CPU load without blocking: re-uses the last value if it is younger than 0.5 s
+def system_cpu_load(cpu_sample):
+    if time.time() - cpu_sample[0] >= 0.5:
+        if cpu_sample[0] == 0:
+            cpu_sample[1] = psutil.cpu_percent(interval=0.5)  # the very first measurement needs a reference point
+        else:
+            cpu_sample[1] = psutil.cpu_percent(interval=None)  # CPU load since the previous measurement
+        cpu_sample[0] = time.time()
+    return cpu_sample[1]
+
+
+# END system_cpu_load
+
+
+# function to read number of nodes & elements of the Elmer mesh (first line of "mesh.header")
+def read_mesh_size(project):
+    # noinspection PyBroadException
+    try:
+        with open(os.path.join(project, 'mesh.header'), 'r') as contents:
+            first_line = contents.readline().split()
+        return int(first_line[0]), int(first_line[1])
+    except BaseException:
+        return 0, 0  # unknown mesh size
+
+
+# END read_mesh_size
+
+
+# function to read the element p-order from the 'Element = "p:2"' line of a .sif (1 if not defined)
+def read_element_order(case_sif):
+    for line in case_sif.split('\n'):
+        if line.strip().lower().startswith('element') and '"p:' in line.lower():
+            return int(line.lower().split('"p:')[1].split('"')[0])
+    return 1
+
+
+# END read_element_order
+
+
+# function to read the numbers of all "keyword = value" lines of a .sif (for example "Sound speed" of all materials).
+# Values that are not plain numbers (for example MATC expressions) are ignored.
+def read_sif_numbers(case_sif, keyword):
+    numbers = []
+    for line in case_sif.split('\n'):
+        line = line.split('!')[0]
+        if '=' in line and line.split('=')[0].split('(')[0].strip().lower() == keyword.lower():
+            words = line.split('=', 1)[1].split()
+            if len(words) > 1 and words[0].lower() == 'real':
+                words = words[1:]
+            try:
+                numbers.append(float(words[0]))
+            except (ValueError, IndexError):
+                pass
+    return numbers
+
+
+# END read_sif_numbers
+
+
+# function to find the meshes that a project can use: the "Mesh DB" folder of its .sif + alternative (pre-converted)
+# meshes of the same geometry in sub-folders of the mesh folder. Returns mesh folders relative to the project folder.
+def find_project_meshes(project_folder, mesh_dir):
+    meshes = [mesh_dir]
+    mesh_folder = os.path.join(project_folder, mesh_dir)
+    for a_dir in sorted(os.listdir(mesh_folder)):
+        if os.path.isfile(os.path.join(mesh_folder, a_dir, 'mesh.header')):
+            meshes.append(os.path.normpath(os.path.join(mesh_dir, a_dir)))
+    return meshes
+
+
+# END find_project_meshes
+
+
+# function to estimate the characteristic element size of an Elmer mesh (in mesh units, 0 = unknown): the longest
+# edge of each of up to 10000 sampled elements, 90th percentile (only a few elements are coarser)
+def read_element_size(mesh_folder):
+    # noinspection PyBroadException
+    try:
+        with open(os.path.join(mesh_folder, 'mesh.elements'), 'rb') as contents:
+            nr_of_elements = sum(block.count(b'\n') for block in iter(lambda: contents.read(1048576), b''))
+        sampled = []  # [(element family, [corner node ids])]
+        with open(os.path.join(mesh_folder, 'mesh.elements'), 'r') as contents:
+            for index, line in enumerate(contents):  # element id, body id, element type code, node ids
+                if index % max(1, nr_of_elements // 10000) == 0:
+                    words = line.split()
+                    if len(words) > 3 and int(words[2]) // 100 in element_edges:
+                        sampled.append((int(words[2]) // 100, words[3:]))
+        needed_nodes = set(node for family, nodes in sampled for node in nodes)
+        coordinates = {}
+        with open(os.path.join(mesh_folder, 'mesh.nodes'), 'r') as contents:
+            for line in contents:  # node id, partition, x, y, z
+                words = line.split()
+                if len(words) >= 5 and words[0] in needed_nodes:
+                    coordinates[words[0]] = [float(value) for value in words[2:5]]
+        sizes = sorted(max(sum((a - b) ** 2 for a, b in zip(coordinates[nodes[i]], coordinates[nodes[j]])) ** 0.5
+                           for i, j in element_edges[family]) for family, nodes in sampled)
+        return sizes[int(0.9 * (len(sizes) - 1))]
+    except BaseException:
+        return 0.0  # unknown element size
+
+
+# END read_element_size
+
+
+# function to choose the cheapest discretisation of a frequency that has at least "points_per_wavelength"
+# (= element p-order * wavelength / element size). The cost is estimated as mesh nodes * p-order^3 (number of
+# unknowns). If no discretisation is fine enough, the finest one is used.
+# Returns (mesh folder, element p-order, points per wavelength)
+def choose_discretisation(frequency, meshes, sound_speed, points_per_wavelength, max_element_order):
+    options = []  # [(cost, mesh folder, element p-order, points per wavelength)]
+    for mesh, (mesh_size, element_size) in meshes.items():
+        if element_size > 0:
+            for element_order in range(1, max_element_order + 1):
+                options.append((mesh_size[0] * element_order ** 3, mesh, element_order,
+                                element_order * sound_speed / max(frequency, 1e-9) / element_size))
+    fine_enough = [option for option in options if option[3] >= points_per_wavelength]
+    if len(fine_enough) > 0:
+        choice = min(fine_enough, key=lambda option: (option[0], -option[3]))
+    else:
+        choice = max(options, key=lambda option: (option[3], -option[0]))
+    return choice[1], choice[2], choice[3]
+
+
+# END choose_discretisation
+
+
+# function to get (mesh folder, element p-order) of a queued step. With points_per_wavelength it is chosen once per
+# step (& kept for re-tries), otherwise all steps use the mesh & the element p-order of the .sif
+def step_discretisation(project, entry):
+    if 'batch' in entry:
+        entry = entry['batch'][0]  # (all steps of a batch have the same discretisation, see "form_batch")
+    if 'element_order' not in entry:
+        if project['discretisation'] is None:
+            return project['mesh_dir'], project['element_order']
+        entry['mesh_dir'], entry['element_order'], entry['resolution'] = choose_discretisation(
+            entry['frequency'], project['meshes'], **project['discretisation'])
+    return entry['mesh_dir'], entry['element_order']
+
+
+# END step_discretisation
+
+
+# function to set the mesh folder (relative to the project folder) & the element p-order of "Solver 1" in the .sif
+# of a project (isolated_instances: the .sif is used one folder below the project folder)
+def set_discretisation(case_sif, mesh_dir, element_order, isolated_instances):
+    case_sif = apply_solver_profile(case_sif, {'Element': '"p:' + str(element_order) + '"'}, 1)
+    if isolated_instances:
+        mesh_dir = os.path.join('..', mesh_dir)
+    new_lines = []
+    for line in case_sif.split('\n'):
+        if line.strip().lower().startswith('mesh db'):
+            line = line[:len(line) - len(line.lstrip())] + 'Mesh DB "' + \
+                   posixpath.normpath(mesh_dir.replace('\\', '/')) + '" "."'
+        new_lines.append(line)
+    return '\n'.join(new_lines)
+
+
+# END set_discretisation
+
+
+# function to read the records of all completed steps of a project (see "record_step_cost")
+def load_cost_history(project):
+    cost_history = []
+    if os.path.isfile(os.path.join(project, cost_history_file)):
+        with open(os.path.join(project, cost_history_file), 'r', newline='') as contents:
+            for row in csv.DictReader(contents):
+                row.setdefault('partitions', 1)  # column was added later (older records are serial runs)
+                cost_history.append({key: float(row[key] or 1) for key in cost_history_columns})
+    return cost_history
+
+
+# END load_cost_history
+
+
+# function to append peak RAM, CPU time & wall time of a completed step to the cost history file of its project
+# (CPU & wall time of a batch of steps are shared equally by its "batch_size" steps)
+def record_step_cost(project, instance, member, batch_size, mesh_size, element_order):
+    record = {'step': member['step'], 'frequency': member['frequency'], 'mesh_nodes': mesh_size[0],
+              'mesh_elements': mesh_size[1], 'element_order': element_order, 'peak_rss': instance['peak_rss'],
+              'cpu_time': round(instance['cpu_time'] / batch_size, 2),
+              'wall_time': round((time.time() - instance['launch_time'] - instance['suspended_time']) / batch_size, 2),
+              'partitions': instance['partitions']}
+    old_records = None  # records of a file with columns of an older version (re-written with the current columns)
+    if os.path.isfile(os.path.join(project, cost_history_file)):
+        with open(os.path.join(project, cost_history_file), 'r') as contents:
+            if contents.readline().strip() != ','.join(cost_history_columns):
+                old_records = load_cost_history(project)
+    if old_records is not None or not os.path.isfile(os.path.join(project, cost_history_file)):
+        with open(os.path.join(project, cost_history_file), 'w', newline='') as contents:
+            writer = csv.DictWriter(contents, fieldnames=cost_history_columns)
+            writer.writeheader()
+            writer.writerows(old_records or [])
+    with open(os.path.join(project, cost_history_file), 'a', newline='') as contents:
+        csv.DictWriter(contents, fieldnames=cost_history_columns).writerow(record)
+    return record
+
+
+# END record_step_cost
+
+
+# function to fit "value = a + b * frequency" to the cost history of serial steps with the same mesh & element order.
+# Returns None if nothing is known yet. Predictions never undershoot any recorded step (see "predict_step_cost").
+def fit_cost_model(cost_history, mesh_size, element_order):
+    records = [rec for rec in cost_history if rec['peak_rss'] > 0 and rec['element_order'] == element_order and
+               (rec['mesh_nodes'], rec['mesh_elements']) == mesh_size and rec['partitions'] == 1]
+    if len(records) == 0:
+        return None
+
+    cost_model = {'samples': len(records)}
+    frequencies = [rec['frequency'] for rec in records]
+    for key in ('peak_rss', 'wall_time'):
+        values = [rec[key] for rec in records]
+        mean_f = sum(frequencies) / len(frequencies)
+        mean_v = sum(values) / len(values)
+        spread_f = sum((f - mean_f) ** 2 for f in frequencies)
+        slope = 0.0
+        if spread_f > 0:  # at least two different frequencies
+            slope = sum((f - mean_f) * (v - mean_v) for f, v in zip(frequencies, values)) / spread_f
+        offset = mean_v - slope * mean_f
+        margin = max(v - (offset + slope * f) for f, v in zip(frequencies, values))  # biggest under-prediction
+        cost_model[key] = (offset, slope, margin, min(values))
+    return cost_model
+
+
+# END fit_cost_model
+
+
+# function to predict (peak RAM in bytes, wall time in seconds) of a step with the given frequency
+def predict_step_cost(cost_model, frequency):
+    prediction = []
+    for key in ('peak_rss', 'wall_time'):
+        offset, slope, margin, smallest = cost_model[key]
+        prediction.append(max(smallest, offset + slope * frequency + margin))
+    return tuple(prediction)
+
+
+# END predict_step_cost
+
+
+# function to get the cost model of the discretisation (mesh & element p-order) of a queued step (None = no
+# predictions). Models are fitted once & kept until the cost history changes.
+def step_cost_model(project, entry):
+    if project['cost_models'] is None:
+        return None  # use_cost_model=False
+    mesh, element_order = step_discretisation(project, entry)
+    if (mesh, element_order) not in project['cost_models']:
+        project['cost_models'][(mesh, element_order)] = fit_cost_model(project['cost_history'],
+                                                                       project['meshes'][mesh][0], element_order)
+    return project['cost_models'][(mesh, element_order)]
+
+
+# END step_cost_model
+
+
+# function to read the mesh folder (relative to the project folder) from the "Mesh DB" entry of a .sif
+def read_mesh_dir(case_sif):
+    for line in case_sif.split('\n'):
+        if line.strip().lower().startswith('mesh db'):
+            parts = line.split('"')  # for example:  ['  Mesh DB ', '.', ' ', '.', '']
+            if len(parts) >= 5:
+                return os.path.normpath(os.path.join(parts[1], parts[3]))
+    return '.'
+
+
+# END read_mesh_dir
+
+
+# function to choose the number of MPI partitions of a step (1 = serial ElmerSolver). Long steps are split when there
+# are more free instance slots than steps left in the queue, as long as the extra RAM of partitions fits.
+def choose_partitions(entry, project, steps_left, free_slots, free_ram, ram_safety_factor, mpi_max_partitions,
+                      mpi_min_wall_time):
+    if step_cost_model(project, entry) is None or free_slots < 2 * steps_left:
+        return 1  # nothing known about this step OR all slots will be needed by serial instances anyway
+    ram_needed, wall_time = predict_step_cost(step_cost_model(project, entry), entry['frequency'])
+    if wall_time < mpi_min_wall_time:
+        return 1  # not worth it - MPI start-up & communication overhead
+    partitions = min(mpi_max_partitions, free_slots // steps_left)
+    while partitions > 1 and ram_needed * (1 + mpi_ram_overhead * (partitions - 1)) * ram_safety_factor > free_ram:
+        partitions -= 1
+    return partitions
+
+
+# END choose_partitions
+
+
+# function to read the CPUs that ElmerScanManager may use (its own CPU affinity) grouped by NUMA node & physical core:
+# [node][core] = [logical CPUs (hyper-threads) of that core]. Without Linux sysfs all CPUs are one node.
+def read_cpu_topology():
+    if hasattr(psutil.Process, 'cpu_affinity'):
+        allowed = psutil.Process().cpu_affinity()
+    else:  # macOS
+        allowed = list(range(psutil.cpu_count()))
+    threads_per_core = max(1, psutil.cpu_count() // (psutil.cpu_count(logical=False) or psutil.cpu_count()))
+
+    nodes = []
+    node_dir = os.path.join(cpu_topology_dir, 'node')
+    if os.path.isdir(node_dir):
+        for name in sorted(os.listdir(node_dir)):
+            if name.startswith('node') and name[4:].isdigit():
+                with open(os.path.join(node_dir, name, 'cpulist'), 'r') as contents:
+                    nodes.append((int(name[4:]), parse_cpu_list(contents.read())))
+        nodes.sort()
+    if len(nodes) == 0 or not any(set(cpus) & set(allowed) for node, cpus in nodes):
+        nodes = [(0, sorted(allowed))]
+
+    topology = []
+    for node, cpus in nodes:
+        cores = {}
+        for cpu in cpus:
+            if cpu not in allowed:
+                continue
+            siblings_file = os.path.join(cpu_topology_dir, 'cpu', 'cpu' + str(cpu), 'topology', 'thread_siblings_list')
+            if os.path.isfile(siblings_file):
+                with open(siblings_file, 'r') as contents:
+                    core = min(parse_cpu_list(contents.read()))
+            else:  # (Windows numbers the hyper-threads of a core next to each other)
+                core = cpu // threads_per_core
+            cores.setdefault(core, []).append(cpu)
+        if len(cores) > 0:
+            topology.append([cores[core] for core in sorted(cores)])
+    return topology
+
+
+# END read_cpu_topology
+
+
+# function to read a Linux CPU list like "0-3,8-11" into a list of CPU numbers
+def parse_cpu_list(text):
+    cpus = []
+    for part in text.strip().split(','):
+        if '-' in part:
+            first, last = part.split('-')
+            cpus += list(range(int(first), int(last) + 1))
+        elif part != '':
+            cpus.append(int(part))
+    return cpus
+
+
+# END parse_cpu_list
+
+
+# function to choose the OpenMP/BLAS threads (per partition) of the next instance: the free cores are shared by the
+# instances that can still run next to each other - limited by the steps left & by how many steps of this size fit
+# into free RAM. Small steps run 1 thread each (many instances), big steps get the cores that RAM leaves unused.
+def choose_threads(entry, projects, steps_left, free_cores, free_ram, ram_safety_factor, ram_per_instance, max_threads,
+                   partitions):
+    parallel_instances = steps_left
+    ram_needed = step_ram_need(entry, projects, ram_per_instance)
+    if ram_needed > 0:
+        parallel_instances = min(parallel_instances, max(1, int(free_ram // (ram_needed * ram_safety_factor))))
+    return max(1, min(max_threads, free_cores // (parallel_instances * partitions)))
+
+
+# END choose_threads
+
+
+# function to choose the physical cores of the next instance: all on the NUMA node with the most free cores if they
+# fit there. Otherwise a serial instance gets fewer cores (its threads share one memory) & the partitions of an MPI
+# instance are spread over the nodes. Returns (NUMA node OR None if spread, logical CPUs, number of cores)
+def place_instance(cpu_topology, running, nr_cores, partitions):
+    used = set(cpu for instance in running for cpu in instance['cpus'])
+    free = [[core for core in node if not set(core) & used] for node in cpu_topology]
+    nodes = sorted(range(len(free)), key=lambda node: len(free[node]), reverse=True)
+    if len(free[nodes[0]]) >= nr_cores or partitions == 1:
+        numa_node = nodes[0] if len(cpu_topology) > 1 else None
+        cores = free[nodes[0]][:nr_cores]
+    else:
+        numa_node = None
+        cores = [core for node in nodes for core in free[node]][:nr_cores]
+    if len(cores) == 0:  # (more instances than cores - only with an instance limit above the number of cores)
+        return None, [], 1
+    return numa_node, sorted(cpu for core in cores for cpu in core), len(cores)
+
+
+# END place_instance
+
+
+# function to get the command that starts a program on the given logical CPUs (Linux): numactl - with its RAM bound
+# to the NUMA node of the CPUs if the instance was placed on one node (numa_node is not None) - OR taskset if numactl
+# is not installed. Empty list = neither is available (Windows, macOS): the affinity is set after the start.
+def cpu_pinning_command(cpus, numa_node=None):
+    cpu_list = ','.join(str(cpu) for cpu in cpus)
+    if shutil.which('numactl') is not None:
+        command = ['numactl', '--physcpubind=' + cpu_list]
+        if numa_node is not None:  # (numa_node counts the nodes of cpu_topology - the node number is read again)
+            cpu_dir = os.path.join(cpu_topology_dir, 'cpu', 'cpu' + str(cpus[0]))
+            nodes = [name[4:] for name in (os.listdir(cpu_dir) if os.path.isdir(cpu_dir) else [])
+                     if name.startswith('node') and name[4:].isdigit()]
+            if len(nodes) == 1:
+                command.append('--membind=' + nodes[0])
+        return command
+    if shutil.which('taskset') is not None:
+        return ['taskset', '-c', cpu_list]
+    return []
+
+
+# END cpu_pinning_command
+
+
+# function to partition the mesh of a project with ElmerGrid (once - the partitioning is re-used until mesh changes)
+def prepare_partitioned_mesh(project_folder, mesh_dir, partitions, root_elmer):
+    partitioning = os.path.join(project_folder, mesh_dir, 'partitioning.' + str(partitions))
+    mesh_elements = os.path.join(project_folder, mesh_dir, 'mesh.elements')
+    if os.path.isdir(partitioning) and os.path.getmtime(partitioning) >= os.path.getmtime(mesh_elements):
+        return True  # already partitioned
+
+    print("   ... partitioning the mesh into", str(partitions), "parts with ElmerGrid (only once)")
+    result = subprocess.call([os.path.join(root_elmer, elmergrid_executable), '2', '2', mesh_dir, '-partdual',
+                              '-metiskway', str(partitions)], cwd=project_folder,
+                             stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return result == 0 and os.path.isdir(partitioning)
+
+
+# END prepare_partitioned_mesh
+
+
+# function to get all queued steps of an entry (a batch entry contains several steps, otherwise it is just one step)
+def entry_members(entry):
+    if 'batch' in entry:
+        return entry['batch']
+    return [entry]
+
+
+# END entry_members
+
+
+# function to group the chosen queued step with pending steps of the same project that have adjacent step numbers
+# into one batch (one ElmerSolver launch with several Scanning timesteps). Steps are added while the predicted run
+# time of the batch stays within batch_target_wall_time. The step numbers of a batch must be consecutive because
+# the "vtu: fileindex offset" & "$npart" of the .sif give the results of timestep i the number of step $npart + i - 1.
+# "claim" (distributed mode) must return True for each added step.
+def form_batch(pending_steps, entry, project, batch_max_steps, batch_target_wall_time, claim=None):
+    cost_model = step_cost_model(project, entry)
+    if cost_model is None or entry.get('profile', 0) > 0 or entry.get('single', False):
+        return entry  # no run time predictions yet OR a re-try with another solver profile OR of a failed batch
+    candidates = {}  # step number: queued step (of the same project & with the same mesh & element p-order)
+    for queued in pending_steps:
+        if queued['project'] == entry['project'] and 'batch' not in queued and queued.get('profile', 0) == 0 and \
+                not queued.get('single', False) and step_discretisation(project, queued) == \
+                step_discretisation(project, entry):
+            candidates[queued['step']] = queued
+
+    members = [entry]
+    batch_wall_time = predict_step_cost(cost_model, entry['frequency'])[1]
+    for direction in (1, -1):  # first the following, then the preceding step numbers
+        while len(members) < batch_max_steps:
+            if direction == 1:
+                candidate = candidates.get(max(member['step'] for member in members) + 1)
+            else:
+                candidate = candidates.get(min(member['step'] for member in members) - 1)
+            if candidate is None or os.path.isfile(
+                    os.path.join(candidate['project'], freq_file + str(candidate['step']) + freq_file_ext)):
+                break
+            candidate_wall_time = predict_step_cost(cost_model, candidate['frequency'])[1]
+            if batch_wall_time + candidate_wall_time > batch_target_wall_time:
+                break
+            if claim is not None and not claim(candidate):
+                break
+            members.append(candidate)
+            pending_steps.remove(candidate)
+            batch_wall_time += candidate_wall_time
+
+    if len(members) == 1:
+        return entry
+    members.sort(key=lambda member: member['step'])
+    return {'project': entry['project'], 'step': members[0]['step'],
+            'frequency': max(member['frequency'] for member in members), 'batch': members}
+
+
+# END form_batch
+
+
+# function to set "Timestep intervals" (number of Scanning steps of one ElmerSolver launch) in a .sif
+def set_timestep_intervals(case_sif, intervals):
+    new_lines = []
+    for line in case_sif.split('\n'):
+        if line.strip().lower().startswith('timestep intervals'):
+            line = line.split('=')[0] + '= ' + str(intervals)
+        new_lines.append(line)
+    return '\n'.join(new_lines)
+
+
+# END set_timestep_intervals
+
+
+# function to append one event (with time & ElmerScanManager id) to the journal of a project
+def journal_event(project_folder, event, worker_id, details):
+    record = {'time': round(time.time(), 3), 'event': event, 'worker': worker_id}
+    record.update(details)
+    with open(os.path.join(project_folder, journal_file), 'a', encoding="utf8", newline="\n") as text_file:
+        text_file.write(json.dumps(record) + "\n")
+
+
+# END journal_event
+
+
+# function to get (iteration, residual) from a residual printout line of the Elmer iterative linear solver,
+# for example "      10  0.1234E-02" (see "Linear System Residual Output"). Returns None for all other lines.
+def parse_residual_line(line):
+    words = line.split()
+    if len(words) != 2 or not words[0].isdigit():
+        return None
+    try:
+        return int(words[0]), float(words[1])
+    except ValueError:
+        return None
+
+
+# END parse_residual_line
+
+
+# function to count the linear solves & linear solver iterations in an ElmerSolver log file. The count of iterations
+# is only as precise as "Linear System Residual Output" (the last printed iteration of each solve).
+def read_solver_iterations(log_path):
+    linear_solves = 0
+    linear_iterations = 0
+    last_iteration = 0
+    if not os.path.isfile(log_path):
+        return 0, 0
+    with open(log_path, 'r', errors='replace') as contents:
+        for line in contents:
+            residual = parse_residual_line(line)
+            if residual is None:
+                continue
+            if residual[0] <= last_iteration:  # a new linear solve has started
+                linear_iterations += last_iteration
+                linear_solves += 1
+            last_iteration = residual[0]
+    if last_iteration > 0:
+        linear_iterations += last_iteration
+        linear_solves += 1
+    return linear_solves, linear_iterations
+
+
+# END read_solver_iterations
+
+
+# function to read the new (complete) lines of the log of a running instance & follow the residuals of its linear
+# solves. Returns 'diverged' or 'stalled' when the current linear solve should be stopped, otherwise None.
+def check_convergence(instance, stall_iterations, divergence_factor):
+    with open(instance['log'].name, 'rb') as contents:
+        contents.seek(instance['log_offset'])
+        new_text = contents.read()
+    new_text = new_text[:new_text.rfind(b'\n') + 1]  # a line that is still being written is read next time
+    instance['log_offset'] += len(new_text)
+    for line in new_text.decode(errors='replace').splitlines():
+        residual = parse_residual_line(line)
+        if residual is None:
+            continue
+        iteration, value = residual
+        if iteration <= instance['iteration']:  # a new linear solve has started
+            instance['best_residual'] = None
+        instance['iteration'] = iteration
+        if value != value or value == float('inf'):  # NaN OR inf
+            return 'diverged'
+        if instance['best_residual'] is None or value < instance['best_residual'] * 0.5:
+            instance['best_residual'] = value
+            instance['best_iteration'] = iteration
+        elif value > instance['best_residual'] * divergence_factor:
+            return 'diverged'
+        elif iteration - instance['best_iteration'] >= stall_iterations:
+            return 'stalled'
+    return None
+
+
+# END check_convergence
+
+
+# function to check if ElmerSolver stopped because the linear solver did not converge ("Abort Not Converged")
+def log_reports_not_converged(log_path):
+    if not os.path.isfile(log_path):
+        return False
+    with open(log_path, 'r', errors='replace') as contents:
+        return 'failed convergence' in contents.read().lower()
+
+
+# END log_reports_not_converged
+
+
+# function to get the next solver profile for a re-try of steps that did not converge (None if there is none left)
+def next_solver_profile(members):
+    profile = max(member.get('profile', 0) for member in members) + 1
+    if profile >= len(solver_profiles):
+        return None
+    return profile
+
+
+# END next_solver_profile
+
+
+# function to override "Solver 1" settings of a .sif with a solver profile
+def apply_solver_profile(case_sif, profile, partitions):
+    profile = dict(profile)
+    if partitions > 1 and 'Linear System Direct Method' in profile:
+        profile['Linear System Direct Method'] = 'Mumps'  # Umfpack is serial only
+    return set_section_keywords(case_sif, 'solver 1', profile)
+
+
+# END apply_solver_profile
+
+
+# function to set keywords of one section of a .sif (for example 'solver 1' or 'simulation'). Keys are matched
+# case-insensitively, missing keys are added at the end of the section.
+def set_section_keywords(case_sif, section, keywords):
+    new_lines = []
+    missing = dict((key.lower(), key) for key in keywords)
+    in_section = False
+    for line in case_sif.split('\n'):
+        words = line.split()
+        if ' '.join(words).lower() == section:
+            in_section = True
+        elif in_section and len(words) == 1 and words[0].lower() == 'end':
+            for key_lower in missing:
+                new_lines.append('  ' + missing[key_lower] + ' = ' + keywords[missing[key_lower]])
+            in_section = False
+        elif in_section and '=' in line and line.split('=')[0].strip().lower() in missing:
+            key = missing.pop(line.split('=')[0].strip().lower())
+            line = line.split('=')[0] + '= ' + keywords[key]
+        new_lines.append(line)
+    return '\n'.join(new_lines)
+
+
+# END set_section_keywords
+
+
+# function to make a step save its solution (Elmer "Output File") & start from the solution of another step (restart
+# record of "warm_start_source") - the time of the restarted simulation is set back to 0 for "f(tx - 1)"
+def set_restart(case_sif, restart_file, warm_start_from):
+    keywords = {'Output File': '"' + restart_file.replace('\\', '/') + '"', 'Binary Output': 'Logical True'}
+    if warm_start_from is not None:
+        keywords.update({'Restart File': '"' + warm_start_from['file'].replace('\\', '/') + '"',
+                         'Restart Position': 'Integer ' + str(warm_start_from['position']),
+                         'Restart Time': 'Real 0'})
+    return set_section_keywords(case_sif, 'simulation', keywords)
+
+
+# END set_restart
+
+
+# function to find the completed step (of this run) with the nearest frequency & the same mesh & element p-order,
+# whose solution can be the initial guess of a step. Returns its restart record or None
+def warm_start_source(entry, project):
+    candidates = [restart for restart in project['restarts'].values()
+                  if restart['discretisation'] == step_discretisation(project, entry)]
+    if len(candidates) == 0:
+        return None
+    return min(candidates, key=lambda restart: abs(restart['frequency'] - entry_members(entry)[0]['frequency']))
+
+
+# END warm_start_source
+
+
+# function to order the steps of a project for warm_start: the frequency band is split into "chains" of adjacent
+# steps & the chains are interleaved (first step of each chain, then the second ...), so that parallel instances
+# work on different chains & each step is usually launched after its neighbour of the same chain has finished
+def order_chains(pending, chains):
+    by_frequency = sorted(pending, key=lambda entry: entry['frequency'])
+    chain_length = -(-len(by_frequency) // max(1, chains))  # (rounded up)
+    chain_list = [by_frequency[index:index + chain_length] for index in range(0, len(by_frequency), chain_length)]
+    ordered = []
+    for index in range(chain_length):
+        ordered.extend(chain[index] for chain in chain_list if index < len(chain))
+    return ordered
+
+
+# END order_chains
+
+
+# function to print the average linear solver iterations of cold & warm started steps per octave band
+# (iterations = [(frequency, warm started, linear iterations per step)])
+def print_warm_start_report(iterations):
+    print("--- linear solver iterations per step (warm_start):")
+    bands = {}  # lowest frequency of the octave band: {False: [cold], True: [warm]}
+    for frequency, warm, linear_iterations in iterations:
+        bands.setdefault(octave_band(frequency), {False: [], True: []})[warm].append(linear_iterations)
+    for band in sorted(bands):
+        printout = "      " + str(band) + " - " + str(max(1, band * 2)) + " Hz:"
+        for warm, label in ((False, "cold"), (True, "warm")):
+            if len(bands[band][warm]) > 0:
+                printout += "   " + label + " " + str(round(sum(bands[band][warm]) / len(bands[band][warm]))) + \
+                            " (" + str(len(bands[band][warm])) + " steps)"
+        print(printout)
+
+
+# END print_warm_start_report
+
+
+# function to get the octave band of a frequency (its lowest frequency: 1, 2, 4, 8 ... Hz - 0 below 1 Hz)
+def octave_band(frequency):
+    if frequency < 1:
+        return 0
+    return 2 ** (int(frequency).bit_length() - 1)
+
+
+# END octave_band
+
+
+# function to read the autotune results of a mesh folder: {'mesh': sizes & times of the mesh files, 'bands':
+# {"p:2 256 Hz": {'profile': winner, 'trials': {profile: [wall time, peak RAM] OR None}}}}. Results of a changed
+# mesh are forgotten.
+def load_solver_tuning(mesh_folder):
+    mesh_stamp = [[os.stat(os.path.join(mesh_folder, mesh_file)).st_size,
+                   os.stat(os.path.join(mesh_folder, mesh_file)).st_mtime_ns]
+                  for mesh_file in ('mesh.header', 'mesh.nodes', 'mesh.elements', 'mesh.boundary')
+                  if os.path.isfile(os.path.join(mesh_folder, mesh_file))]
+    # noinspection PyBroadException
+    try:
+        with open(os.path.join(mesh_folder, solver_tuning_file), 'r') as contents:
+            tuning = json.load(contents)
+        if tuning['mesh'] == mesh_stamp:
+            return tuning
+    except BaseException:
+        pass  # no (readable) autotune results yet
+    return {'mesh': mesh_stamp, 'bands': {}}
+
+
+# END load_solver_tuning
+
+
+# function to run one trial solve of a step with a "Solver 1" profile in its own folder (one level below the project
+# folder like an isolated instance). Iterative solvers stop after autotune_trial_iterations: their time to reach the
+# convergence tolerance is extrapolated from the residual decrease (the results of such a trial are not valid).
+# time_limit = [seconds] is shared by the trials of the same step that run at the same time (& lowered meanwhile).
+# Returns ([wall time, peak RAM] OR None if it failed, diverged or was stopped at the time limit, converged)
+def run_trial(trial_dir, entry, case_sif, root_elmer, time_limit):
+    tolerance = (read_sif_numbers(case_sif, 'Linear System Convergence Tolerance') or [1e-10])[0]
+    case_sif = set_section_keywords(case_sif, 'solver 1', {'Linear System Max Iterations': str(
+        autotune_trial_iterations), 'Linear System Abort Not Converged': 'False', 'Linear System Residual Output': '1'})
+    prepare_instance_dir(trial_dir, "$npart = " + str(entry['step']) + "\n$f = " + str(entry['frequency']) +
+                         " 		! Hz \n\n" + case_sif)
+    log_path = os.path.join(trial_dir, post_file + str(entry['step']) + "_log.txt")
+    with open(log_path, "w") as log_file_handle:
+        trial = {'process': subprocess.Popen(os.path.join(root_elmer, elmersolver_executable),
+                                             stdout=log_file_handle, cwd=trial_dir),
+                 'rss': 0, 'peak_rss': 0, 'cpu_time': 0.0}
+        launch_time = time.time()
+        while trial['process'].poll() is None:
+            sample_instance(trial)
+            if time.time() - launch_time > time_limit[0]:
+                trial['process'].kill()
+            time.sleep(0.1)
+    wall_time = time.time() - launch_time
+    if not os.path.isfile(os.path.join(trial_dir, freq_file + str(entry['step']) + freq_file_ext)):
+        return None, False
+
+    residuals = []  # (iteration, residual) of the last linear solve
+    with open(log_path, 'r', errors='replace') as contents:
+        for line in contents:
+            residual = parse_residual_line(line)
+            if residual is not None:
+                if len(residuals) > 0 and residual[0] <= residuals[-1][0]:
+                    residuals = []  # a new linear solve has started
+                residuals.append(residual)
+    direct = re.search(r'^\s*linear system solver\s*=\s*"?direct', case_sif, re.IGNORECASE | re.MULTILINE)
+    if direct or len(residuals) == 0 or residuals[-1][0] < autotune_trial_iterations:  # converged within the trial
+        return [round(wall_time, 2), trial['peak_rss']], True
+    (first_iteration, first_residual), (last_iteration, last_residual) = residuals[0], residuals[-1]
+    if last_iteration <= first_iteration or not 0 < last_residual < first_residual:
+        return None, False  # stalled OR diverged
+    rate = math.log(first_residual / last_residual) / (last_iteration - first_iteration)  # per iteration
+    needed_iterations = last_iteration + max(0.0, math.log(last_residual / tolerance)) / rate
+    return [round(wall_time * needed_iterations / last_iteration, 2), trial['peak_rss']], False
+
+
+# END run_trial
+
+
+# function to choose the "Solver 1" profile of each octave band & discretisation of a project by trial solves of up
+# to autotune_samples representative steps (spread over the band, highest frequency first) with all tuning_profiles.
+# Trials of all bands run at the same time on up to max_trials cores while free RAM allows (RAM of the biggest
+# finished trial * ram_safety_factor - one trial at a time until the first has finished). A trial is stopped when it
+# takes twice as long as the best trial of its step. Score = (extrapolated) wall time * max(peak RAM, RAM per CPU
+# core): the fastest profile wins unless it needs more than its share of RAM. Results are kept in the mesh folder &
+# the result of the best converged trial of a step is kept as the result of that step. Bands where no trial
+# succeeded are not kept (tuned again on the next launch).
+def autotune_project(project_folder, project, root_elmer, isolated_instances, autotune_samples, autotune_max_seconds,
+                     max_trials=1, ram_safety_factor=0.95):
+    ram_per_core = psutil.virtual_memory().total / (psutil.cpu_count() or 1)
+    case_sif = project['case_sif'] if isolated_instances else relocate_sif_paths(project['case_sif'])
+    groups = {}  # (mesh folder, element p-order, octave band): [pending steps]
+    for entry in project['pending']:
+        mesh, element_order = step_discretisation(project, entry)
+        groups.setdefault((mesh, element_order, octave_band(entry['frequency'])), []).append(entry)
+
+    bands = {}  # (mesh folder, element p-order, octave band) of bands to tune: their trials
+    jobs = []  # trial solves to run: (band, sample, profile index, profile name, .sif of the trial)
+    samples = {}  # step of a sample: {'time_limit': [seconds], 'best_trial': folder, 'best_time': seconds}
+    for (mesh, element_order, band), entries in sorted(groups.items()):
+        band_key = 'p:' + str(element_order) + ' ' + str(band) + ' Hz'
+        tuning = load_solver_tuning(os.path.join(project_folder, mesh))
+        if band_key in tuning['bands']:
+            project['tuned'][(mesh, element_order, band)] = tuning['bands'][band_key]['profile']
+            continue
+        entries = sorted(entries, key=lambda queued: queued['frequency'], reverse=True)
+        nr_of_samples = min(autotune_samples, len(entries))
+        trial_sif = case_sif
+        if (mesh, element_order) != (project['mesh_dir'], project['element_order']):
+            trial_sif = set_discretisation(trial_sif, mesh, element_order, True)
+        bands[(mesh, element_order, band)] = dict((name, []) for name in tuning_profiles)  # [wall time, RAM]/sample
+        for index in range(nr_of_samples):
+            sample = entries[round(index * (len(entries) - 1) / max(1, nr_of_samples - 1))]
+            samples[sample['step']] = {'time_limit': [autotune_max_seconds], 'best_trial': None,
+                                       'best_time': float('inf')}
+            for profile_index, name in enumerate(tuning_profiles):
+                jobs.append(((mesh, element_order, band), sample, profile_index, name,
+                             apply_solver_profile(trial_sif, tuning_profiles[name], 1)))
+    if len(jobs) == 0:
+        return
+    print("--- autotune of", str(len(bands)), "octave bands of", os.path.basename(project_folder) + ":",
+          str(len(jobs)), "trial solves on up to", str(max_trials), "cores")
+
+    trial_ram = 0  # peak RAM of the biggest finished trial
+    running = {}  # future of a running trial: its job & folder
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, max_trials)) as executor:
+        while len(jobs) > 0 or len(running) > 0:
+            while len(jobs) > 0 and len(running) < max_trials and (len(running) == 0 or (
+                    trial_ram > 0 and psutil.virtual_memory().available > trial_ram * ram_safety_factor)):
+                key, sample, profile_index, name, trial_sif = jobs.pop(0)
+                if None in bands[key][name]:
+                    continue  # already failed with another sample
+                trial_dir = os.path.join(project_folder, autotune_dir_prefix + str(sample['step']) + '_' +
+                                         str(profile_index))
+                future = executor.submit(run_trial, trial_dir, sample, trial_sif, root_elmer,
+                                         samples[sample['step']]['time_limit'])
+                running[future] = (key, sample, name, trial_dir)
+            done, not_done = concurrent.futures.wait(list(running), timeout=1.0,
+                                                     return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                key, sample, name, trial_dir = running.pop(future)
+                result, converged = future.result()
+                sample_state = samples[sample['step']]
+                bands[key][name].append(result)
+                print("      ", sample['frequency'], "Hz  ", name + ":", "failed OR too slow" if result is None
+                      else str(result[0]) + " s" + ("" if converged else " (extrapolated)") + ", " +
+                      str(round(result[1] / 1073741824, 2)) + " GB")
+                if result is not None:
+                    trial_ram = max(trial_ram, result[1])
+                    # (trials of the same step that are still running are stopped at twice this time)
+                    sample_state['time_limit'][0] = min(sample_state['time_limit'][0], 2 * result[0])
+                if converged and result[0] < sample_state['best_time']:
+                    if sample_state['best_trial'] is not None:
+                        shutil.rmtree(sample_state['best_trial'], ignore_errors=True)
+                    sample_state['best_trial'] = trial_dir
+                    sample_state['best_time'] = result[0]
+                else:
+                    shutil.rmtree(trial_dir, ignore_errors=True)
+
+    for sample_state in samples.values():
+        if sample_state['best_trial'] is not None:
+            collect_instance_outputs(project_folder, sample_state['best_trial'])  # (a valid result of this step)
+    for (mesh, element_order, band), trials in sorted(bands.items()):
+        band_key = 'p:' + str(element_order) + ' ' + str(band) + ' Hz'
+        scores = dict((name, sum(result[0] * max(result[1], ram_per_core) for result in trials[name]))
+                      for name in trials if None not in trials[name] and len(trials[name]) > 0)
+        if len(scores) == 0:  # (not kept: tuned again on the next launch)
+            print("      " + band_key + ": no profile solved the trial steps - the .sif is used as it is")
+            project['tuned'][(mesh, element_order, band)] = 'sif'
+            continue
+        winner = min(scores, key=lambda name: scores[name])
+        print("      " + band_key + " winner:", winner)
+        tuning = load_solver_tuning(os.path.join(project_folder, mesh))  # (+ results of other projects meanwhile)
+        tuning['bands'][band_key] = {'profile': winner, 'trials': trials}
+        with open(os.path.join(project_folder, mesh, solver_tuning_file + '.tmp'), 'w') as text_file:
+            json.dump(tuning, text_file, indent=1)
+        os.replace(os.path.join(project_folder, mesh, solver_tuning_file + '.tmp'),
+                   os.path.join(project_folder, mesh, solver_tuning_file))
+        project['tuned'][(mesh, element_order, band)] = winner
+
+    for entry in project['pending'].copy():  # steps solved by trials
+        if os.path.isfile(os.path.join(project_folder, freq_file + str(entry['step']) + freq_file_ext)):
+            project['pending'].remove(entry)
+            complete_step(project, entry['step'])
+
+
+# END autotune_project
+
+
+# function to (over)write the live status of ElmerScanManager in Prometheus text format (atomically replaced)
+def write_metrics(metrics_file, projects, running, pending_steps, claimed_elsewhere, max_instances, ram_per_instance,
+                  nr_launched):
+    lines = ['# HELP elmerscan_steps Number of frequency steps of each project by state.',
+             '# TYPE elmerscan_steps gauge']
+    for project_folder, project in projects.items():
+        label = 'project="' + project_folder.replace('\\', '\\\\').replace('"', '\\"') + '"'
+        states = {'total': len(project['steps']), 'completed': len(project['completed']),
+                  'failed': len(project['failed']),
+                  'pending': sum(len(entry_members(entry)) for entry in pending_steps
+                                 if entry['project'] == project_folder),
+                  'running': sum(len(entry_members(instance['entry'])) for instance in running
+                                 if instance['project'] == project_folder),
+                  'running_elsewhere': sum(1 for entry in claimed_elsewhere if entry['project'] == project_folder)}
+        for state, value in states.items():
+            lines.append('elmerscan_steps{' + label + ',state="' + state + '"} ' + str(value))
+    lines += ['# HELP elmerscan_instances Running ElmerSolver instances of this ElmerScanManager.',
+              '# TYPE elmerscan_instances gauge',
+              'elmerscan_instances ' + str(len(running)),
+              '# HELP elmerscan_partitions Instance slots in use (MPI instances use one slot per partition).',
+              '# TYPE elmerscan_partitions gauge',
+              'elmerscan_partitions ' + str(sum(instance['partitions'] for instance in running)),
+              '# HELP elmerscan_max_instances Current instance limit (0 = not yet known).',
+              '# TYPE elmerscan_max_instances gauge',
+              'elmerscan_max_instances ' + str(max_instances),
+              '# HELP elmerscan_instance_rss_bytes RAM of all running instances.',
+              '# TYPE elmerscan_instance_rss_bytes gauge',
+              'elmerscan_instance_rss_bytes ' + str(sum(instance['rss'] for instance in running)),
+              '# HELP elmerscan_ram_per_instance_bytes Biggest RAM of an initialized instance.',
+              '# TYPE elmerscan_ram_per_instance_bytes gauge',
+              'elmerscan_ram_per_instance_bytes ' + str(ram_per_instance),
+              '# HELP elmerscan_launched_steps_total Steps launched by this ElmerScanManager.',
+              '# TYPE elmerscan_launched_steps_total counter',
+              'elmerscan_launched_steps_total ' + str(nr_launched)]
+    with open(metrics_file + '.tmp', 'w', encoding="utf8", newline="\n") as text_file:
+        text_file.write("\n".join(lines) + "\n")
+    os.replace(metrics_file + '.tmp', metrics_file)
+
+
+# END write_metrics
+
+
+# function to read the values that SaveScalars wrote for a completed step (all numbers of its .csv file)
+def read_step_response(project_folder, step):
+    values = []
+    with open(os.path.join(project_folder, freq_file + str(step) + freq_file_ext), 'r') as contents:
+        for value in contents.read().split():
+            try:
+                values.append(float(value))
+            except ValueError:
+                pass  # not a number
+    return values
+
+
+# END read_step_response
+
+
+# function to read the names of the values that SaveScalars wrote for a step (lines "   1: res: ..." of the
+# .csv.names file). Missing names (for example the .names file was already deleted) are "column_N".
+def read_scalar_names(project_folder, step, nr_of_values):
+    names = []
+    names_file = os.path.join(project_folder, freq_file + str(step) + headers_to_delete)
+    if os.path.isfile(names_file):
+        with open(names_file, 'r', errors='replace') as contents:
+            for line in contents.readlines():
+                words = line.split(':', 1)
+                if len(words) == 2 and words[0].strip().isdigit() and words[1].strip() != '':
+                    name = words[1].strip()
+                    while name in names or name.lower() in ('step', 'frequency'):
+                        name = name + ' ' + words[0].strip()  # (column names must be unique)
+                    names.append(name)
+    for column in range(len(names), nr_of_values):
+        names.append('column_' + str(column + 1))
+    return names[:nr_of_values]
+
+
+# END read_scalar_names
+
+
+# function to add the SaveScalars values of completed steps [(step, frequency), ...] to the result store of a project.
+# Each step is one transaction & steps whose .csv file did not change since it was stored (table "stored_files") are
+# skipped, so an interrupted run is simply completed by the next call. The row of a re-run step is replaced & the row
+# of a step without .csv file (not completed, for example deleted to re-run it) is removed.
+def store_step_results(project_folder, steps):
+    connection = sqlite3.connect(os.path.join(project_folder, result_store_file), timeout=60)
+    try:
+        with connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS results (step INTEGER PRIMARY KEY, frequency REAL)")
+            connection.execute("CREATE TABLE IF NOT EXISTS stored_files (step INTEGER PRIMARY KEY, csv_mtime INTEGER)")
+        columns = [row[1] for row in connection.execute("PRAGMA table_info(results)")]
+        stored = dict(connection.execute("SELECT step, csv_mtime FROM stored_files").fetchall())
+        for step, frequency in steps:
+            csv_path = os.path.join(project_folder, freq_file + str(step) + freq_file_ext)
+            try:
+                csv_mtime = os.stat(csv_path).st_mtime_ns
+            except FileNotFoundError:
+                if step in stored:
+                    with connection:
+                        connection.execute("DELETE FROM results WHERE step = ?", [step])
+                        connection.execute("DELETE FROM stored_files WHERE step = ?", [step])
+                continue
+            if stored.get(step) == csv_mtime:
+                continue
+            values = read_step_response(project_folder, step)
+            names = read_scalar_names(project_folder, step, len(values))
+            quoted_names = ['"' + name.replace('"', '""') + '"' for name in names]
+            with connection:
+                for name, quoted_name in zip(names, quoted_names):
+                    if name not in columns:
+                        connection.execute("ALTER TABLE results ADD COLUMN " + quoted_name + " REAL")
+                        columns.append(name)
+                # (the whole row is replaced: values of columns that the re-run step did not write become NULL)
+                connection.execute("INSERT OR REPLACE INTO results (step, frequency" +
+                                   "".join(", " + quoted_name for quoted_name in quoted_names) + ") VALUES (?, ?" +
+                                   ", ?" * len(values) + ")", [step, frequency] + values)
+                connection.execute("INSERT OR REPLACE INTO stored_files (step, csv_mtime) VALUES (?, ?)",
+                                   [step, csv_mtime])
+    finally:
+        connection.close()
+
+
+# END store_step_results
+
+
+# function to get the exclusive right to write the result store of a project (distributed mode) by creating its lock
+# file. Returns False if another ElmerScanManager writes it right now. Locks older than 10 minutes are left behind by
+# a stopped manager and are taken over.
+def claim_result_store(project_folder, worker_id):
+    lock_path = os.path.join(project_folder, result_store_file + lease_file_ext)
+    for attempt in range(2):
+        try:
+            lock_handle = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            lock = read_lease(lock_path)
+            if lock is not None and not lease_expired(lock[1] / 1e9, 600):
+                print("   result store is written by another ElmerScanManager:", lock[0])
+                return False
+            # noinspection PyBroadException
+            try:
+                os.remove(lock_path)
+            except BaseException:
+                pass  # another manager was faster
+            continue
+        with os.fdopen(lock_handle, 'w') as lock_file:
+            lock_file.write(worker_id + '\n')
+        return True
+    return False
+
+
+# END claim_result_store
+
+
+# function to read the result store of a project: returns (column names, rows sorted by frequency)
+def read_result_store(project_folder):
+    connection = sqlite3.connect(os.path.join(project_folder, result_store_file))
+    try:
+        cursor = connection.execute("SELECT * FROM results ORDER BY frequency, step")
+        return [column[0] for column in cursor.description], cursor.fetchall()
+    finally:
+        connection.close()
+
+
+# END read_result_store
+
+
+# function to hash everything (except the frequency) that the results of a project depend on: the .sif without
+# comments, empty lines & "Mesh DB" path, the content of the mesh files & the ElmerSolver executable (size & time)
+def result_cache_base(project_folder, case_sif, mesh_dir, root_elmer):
+    base = hashlib.sha256()
+    for line in case_sif.split('\n'):
+        line = ' '.join(line.split('!')[0].split())
+        if line != '' and not line.lower().startswith('mesh db'):
+            base.update(line.encode() + b'\n')
+    mesh_folder = os.path.normpath(os.path.join(project_folder, mesh_dir))
+    for mesh_file in sorted(os.listdir(mesh_folder)):
+        if mesh_file.startswith('mesh.') and os.path.isfile(os.path.join(mesh_folder, mesh_file)):
+            base.update(mesh_file.encode())
+            with open(os.path.join(mesh_folder, mesh_file), 'rb') as contents:
+                for block in iter(lambda: contents.read(1048576), b''):
+                    base.update(block)
+    solver = shutil.which(os.path.join(root_elmer, elmersolver_executable))
+    if solver is not None:
+        base.update(str(os.stat(solver).st_size).encode() + b' ' + str(os.stat(solver).st_mtime_ns).encode())
+    return base.hexdigest()
+
+
+# END result_cache_base
+
+
+# function to get the cache folder of one step. The step number is not part of the key: results are stored with
+# neutral file names & renamed to the step number when they are restored.
+def result_cache_folder(cache_dir, entry, project, root_elmer):
+    mesh, element_order = step_discretisation(project, entry)
+    cache_base = project['cache_base']
+    if (mesh, element_order) != (project['mesh_dir'], project['element_order']):  # another mesh or element p-order
+        if (mesh, element_order) not in project['cache_bases']:
+            project['cache_bases'][(mesh, element_order)] = result_cache_base(
+                entry['project'], set_discretisation(project['case_sif'], mesh, element_order, False), mesh,
+                root_elmer)
+        cache_base = project['cache_bases'][(mesh, element_order)]
+    key = hashlib.sha256((cache_base + ' ' + repr(float(entry['frequency']))).encode()).hexdigest()
+    return os.path.join(cache_dir, key[:2], key)
+
+
+# END result_cache_folder
+
+
+# function to get the result files of one step: {name in the project folder: neutral name in the cache}
+def step_result_files(step):
+    return {post_file + str(step).zfill(4) + '.vtu': 'result.vtu',
+            freq_file + str(step) + headers_to_delete: 'result' + headers_to_delete,
+            freq_file + str(step) + freq_file_ext: 'result' + freq_file_ext}  # (completion marker last)
+
+
+# END step_result_files
+
+
+# function to hard-link (or copy) a file, an existing target is replaced
+def link_or_copy(source, target, hard_link=True):
+    if os.path.isfile(target):
+        os.remove(target)
+    if hard_link:
+        try:
+            os.link(source, target)
+            return
+        except OSError:  # for example another drive
+            pass
+    shutil.copy2(source, target)
+
+
+# END link_or_copy
+
+
+# function to restore the results of a step from the result cache (the completion marker last). Returns True if found.
+# hard_link=False: the files are copied (ElmerSolver writes into the project folder - see isolated_instances)
+def restore_cached_step(cache_dir, entry, project, root_elmer, hard_link=True):
+    cached = result_cache_folder(cache_dir, entry, project, root_elmer)
+    if not os.path.isfile(os.path.join(cached, 'result' + freq_file_ext)):
+        return False
+    try:
+        for project_name, cache_name in step_result_files(entry['step']).items():
+            if os.path.isfile(os.path.join(cached, cache_name)):
+                link_or_copy(os.path.join(cached, cache_name), os.path.join(entry['project'], project_name),
+                             hard_link)
+        os.utime(cached)  # most recently used
+    except FileNotFoundError:  # evicted by another ElmerScanManager just now: a cache miss (unless all was restored)
+        return os.path.isfile(os.path.join(entry['project'], freq_file + str(entry['step']) + freq_file_ext))
+    return True
+
+
+# END restore_cached_step
+
+
+# function to store the results of a completed step in the result cache (a complete folder is renamed into place,
+# so other ElmerScanManagers never see half-stored results). Returns the number of bytes added to the cache.
+def store_cached_step(cache_dir, entry, project, root_elmer, hard_link=True):
+    cached = result_cache_folder(cache_dir, entry, project, root_elmer)
+    files = step_result_files(entry['step'])
+    if os.path.isdir(cached) or not os.path.isfile(os.path.join(entry['project'], freq_file + str(entry['step']) +
+                                                                freq_file_ext)):
+        return 0
+    temp_folder = cached + '.tmp' + str(os.getpid())
+    shutil.rmtree(temp_folder, ignore_errors=True)
+    os.makedirs(temp_folder)
+    stored_bytes = 0
+    for project_name, cache_name in files.items():
+        if os.path.isfile(os.path.join(entry['project'], project_name)):
+            link_or_copy(os.path.join(entry['project'], project_name), os.path.join(temp_folder, cache_name),
+                         hard_link)
+            stored_bytes += os.path.getsize(os.path.join(temp_folder, cache_name))
+    try:
+        os.rename(temp_folder, cached)
+    except OSError:  # stored by another ElmerScanManager just now
+        shutil.rmtree(temp_folder, ignore_errors=True)
+        return 0
+    return stored_bytes
+
+
+# END store_cached_step
+
+
+# function to store the results of all steps of an exited instance in the result cache & delete the least recently
+# used results if the cache grew over cache_max_gb. Returns the new size of the cache (bytes).
+def store_cached_steps(cache_dir, members, project, root_elmer, hard_link, cache_size, cache_max_gb):
+    for member in members:
+        cache_size += store_cached_step(cache_dir, member, project, root_elmer, hard_link)
+    if cache_size > cache_max_gb * 1073741824:  # (re-counted: other managers may have stored results)
+        cache_size = evict_result_cache(cache_dir, cache_max_gb)
+    return cache_size
+
+
+# END store_cached_steps
+
+
+# function to delete the least recently used results until the cache is smaller than 90 % of cache_max_gb (it is not
+# walked again after every stored step). Returns the size of the cache in bytes.
+def evict_result_cache(cache_dir, cache_max_gb):
+    entries = []  # [last use, size, folder]
+    for prefix in os.listdir(cache_dir):
+        if not os.path.isdir(os.path.join(cache_dir, prefix)):
+            continue
+        for key in os.listdir(os.path.join(cache_dir, prefix)):
+            cached = os.path.join(cache_dir, prefix, key)
+            if '.tmp' in key or not os.path.isdir(cached):
+                continue
+            # noinspection PyBroadException
+            try:
+                size = sum(os.path.getsize(os.path.join(cached, c_file)) for c_file in os.listdir(cached))
+                entries.append([os.stat(cached).st_mtime, size, cached])
+            except BaseException:
+                pass  # evicted by another ElmerScanManager just now
+    total_size = sum(cache_entry[1] for cache_entry in entries)
+    if total_size <= cache_max_gb * 1073741824:
+        return total_size
+    for last_use, size, cached in sorted(entries):
+        if total_size <= 0.9 * cache_max_gb * 1073741824:
+            break
+        shutil.rmtree(cached, ignore_errors=True)
+        total_size -= size
+    return total_size
+
+
+# END evict_result_cache
+
+
+# function for adaptive refinement: find completed steps where the response (values saved by SaveScalars) changes
+# fast & add new steps half-way to their neighbours. A step is not resolved when any of its values differs more than
+# refine_tolerance (relative to the biggest of the 3 values) from the straight line between its two completed
+# neighbour frequencies. New steps get new step numbers & are appended to the frequency file of the project, so a
+# re-started ElmerScanManager finds them too. Returns the new queued steps (at most project['refine_budget']).
+def refine_project(project_folder, project, refine_tolerance, refine_min_df):
+    all_steps, frequencies = read_frequencies(project_folder, main_frequencies_to_simulate)
+    known = sorted(zip(frequencies, all_steps))  # all steps of the project (completed or not) by frequency
+    for frequency, step in known:
+        if step not in project['responses'] and \
+                os.path.isfile(os.path.join(project_folder, freq_file + str(step) + freq_file_ext)):
+            project['responses'][step] = read_step_response(project_folder, step)
+
+    new_frequencies = []
+    for i in range(1, len(known) - 1):
+        (f_low, low), (f_mid, mid), (f_high, high) = known[i - 1], known[i], known[i + 1]
+        if low not in project['responses'] or mid not in project['responses'] or high not in project['responses'] \
+                or f_high - f_low <= 0:
+            continue  # only ranges that are completely solved (& not already being refined)
+        weight = (f_mid - f_low) / (f_high - f_low)
+        deviation = 0
+        for value_low, value_mid, value_high in zip(project['responses'][low], project['responses'][mid],
+                                                    project['responses'][high]):
+            scale = max(abs(value_low), abs(value_mid), abs(value_high))
+            if scale > 0:
+                deviation = max(deviation, abs(value_mid - value_low - weight * (value_high - value_low)) / scale)
+        if deviation > refine_tolerance:
+            for f_a, f_b in ((f_low, f_mid), (f_mid, f_high)):
+                f_new = round((f_a + f_b) / 2, 6)
+                if f_b - f_a >= 2 * refine_min_df and f_new not in new_frequencies:
+                    new_frequencies.append(f_new)
+
+    new_steps = []
+    next_step = max(all_steps) + 1
+    for f_new in new_frequencies[:max(0, project['refine_budget'])]:
+        new_steps.append({'project': project_folder, 'step': next_step, 'frequency': f_new})
+        next_step += 1
+    if len(new_steps) > 0:
+        with open(os.path.join(project_folder, main_frequencies_to_simulate), 'a') as text_file:
+            for entry in new_steps:
+                text_file.write("\n" + str(entry['step']) + " " + str(entry['frequency']))
+        project['refine_budget'] -= len(new_steps)
+        project['steps'].update(entry['step'] for entry in new_steps)
+    return new_steps
+
+
+# END refine_project
 
 
 if __name__ == '__main__':
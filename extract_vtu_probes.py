@@ -0,0 +1,531 @@
+import os   # script for Python 3
+import re
+import mmap
+import zlib
+import time
+import struct
+import hashlib
+import argparse
+import concurrent.futures
+import numpy as np  # pip install numpy
+
+#       ---  "numpy" is required !  https://numpy.org/install/  ---
+
+#  "extract_vtu_probes.py" executable script extracts frequency responses (SPL versus frequency) at listening positions
+#   from the "case_t .vtu" results of Elmer FEM Scanning projects (run by "elmer_scan_manager.py") - without ParaView.
+#   The probe points are located in the mesh once (the interpolation weights are cached per mesh), then the pressure
+#   at all probes is read from the .vtu files of all frequency steps in parallel (memory-mapped: only the values
+#   around the probes are read from disk).
+
+#                               HOW TO USE:
+#
+#   1- Write the listening positions into a "Scanning_PROBES.txt" file in the project folder: one probe per row
+#           "name x y z" (or just "x y z"), in the coordinates of the .vtu files (as shown by ParaView).
+#   2- This "extract_vtu_probes.py" file needs to be next to the project OR one level above (or more) to extract the
+#           probes of multiple projects at once (or use "start_path").
+#   3- make sure you have Python 3.7 or newer to run this script.  & use "pip install numpy" to add required package.
+#   4- "run" this "extract_vtu_probes.py" file with Python 3.
+#           - "scan_probes/probe_spl.csv" in each project: one row per completed step (sorted by frequency) with the
+#               SPL in dB (re 20 uPa) of each probe.
+#           - "scan_probes/probe_pressure.npz": frequencies, steps & complex pressure of each probe (for numpy).
+#   5- DONE
+#
+# Extra tips:
+#   1- Steps that were already extracted are not read again (unless their .vtu file changed), so re-running the script
+#           during a scan only adds the new steps. With follow=True the script keeps polling until all steps of the
+#           projects are complete - the results land in "scan_probes" as the steps complete.
+#   2- The pressure is read from the point data "pressure wave 1" (real part) & "pressure wave 2" (imaginary part)
+#           written by HelmholtzSolver (or from one array with 2 components). Use "field" for other variable names.
+#   3- Steps solved with different meshes (see points_per_wavelength of elmer_scan_manager.py) are fine: the probes
+#           are located once in each mesh ("probe_weights_ .npz" in "scan_probes" - delete them after moving probes).
+#   4- Probes outside of the mesh get empty values (NaN). Only serial .vtu results are read (not MPI .pvtu parts).
+#   5- Sweeps: the "Scanning_PROBES.txt" next to "Scanning_SWEEP.txt" is used for all "sweep_ " folders of the sweep.
+#
+#   made for Python 3.7+                            see license details at the end of the script.
+#       v1.00    2026-10-17     First version.
+#
+
+# hard-coded filenames:
+main_frequencies_to_simulate = 'Scanning_FREQUNCIES.txt'  # each row contains one frequency value in [Hz]
+sweep_spec_file = 'Scanning_SWEEP.txt'  # a sweep: its steps run in the "sweep_ " sub-folders, not in the folder itself
+probes_file_name = 'Scanning_PROBES.txt'  # each row: "name x y z" of one listening position
+probes_dir = 'scan_probes'  # output folder (inside each project)
+probe_pressure_file = 'probe_pressure.npz'  # complex pressure of each probe & step (numpy arrays)
+probe_spl_file = 'probe_spl.csv'  # SPL in dB of each probe & step
+probe_weights_prefix = 'probe_weights_'  # cached probe locations in one mesh: point ids & interpolation weights
+post_file = 'case_t'
+freq_file = 'case_frequency_'
+freq_file_ext = '.csv'
+reference_pressure = 2e-5  # Pa (0 dB SPL)
+steps_per_job = 8  # .vtu files read by one worker process at a time
+# numpy types of the VTK data types
+vtk_types = {'Int8': 'i1', 'UInt8': 'u1', 'Int16': 'i2', 'UInt16': 'u2', 'Int32': 'i4', 'UInt32': 'u4',
+             'Int64': 'i8', 'UInt64': 'u8', 'Float32': 'f4', 'Float64': 'f8'}
+# VTK cell type: (dimension, corner nodes of the simplices - tetrahedra in 3D, triangles in 2D - the cell is split into)
+# quadratic cells are interpolated linearly between their corner nodes (which come first in VTK)
+cell_simplices = {10: (3, ((0, 1, 2, 3),)), 24: (3, ((0, 1, 2, 3),)),  # (quadratic) tetrahedron
+                  12: (3, ((0, 6, 1, 2),  # hexahedron: 6 tetrahedra around the 0-6 diagonal
+                              (0, 6, 2, 3), (0, 6, 3, 7), (0, 6, 7, 4), (0, 6, 4, 5), (0, 6, 5, 1))),
+                  13: (3, ((0, 1, 2, 3), (1, 2, 3, 4), (2, 3, 4, 5))),  # wedge
+                  14: (3, ((0, 1, 2, 4), (0, 2, 3, 4))),  # pyramid
+                  5: (2, ((0, 1, 2),)), 22: (2, ((0, 1, 2),)),  # (quadratic) triangle
+                  9: (2, ((0, 1, 2), (0, 2, 3))), 23: (2, ((0, 1, 2), (0, 2, 3))), 28: (2, ((0, 1, 2), (0, 2, 3)))}
+for a_type in (25, 29):  # quadratic & tri-quadratic hexahedron = hexahedron
+    cell_simplices[a_type] = cell_simplices[12]
+for a_type in (26, 32):  # quadratic wedges = wedge
+    cell_simplices[a_type] = cell_simplices[13]
+
+
+def create_cli():
+    # 1 parse command line input ----------------------------------------------------
+
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument(
+        "--start_path", default='False', type=str,
+        help=("Optional Search directory for projects (sub-folders are searched too). "
+              "If start_path='False' - projects are searched next to this script OR in sub-folders."))
+    parser.add_argument(
+        "--probes_file", default=probes_file_name, type=str,
+        help=("File with one probe per row: \"name x y z\" OR \"x y z\". A relative path is searched in each project "
+              "folder first, then in the folders above it (for example for the sweep_ folders of a sweep)."))
+    parser.add_argument(
+        "--field", default='pressure wave', type=str,
+        help=("Name of the point data in the .vtu files (not case-sensitive): '<field> 1' & '<field> 2' are the real "
+              "& imaginary part OR '<field>' with 2 components."))
+    parser.add_argument(
+        "--follow", default='False', choices=('True', 'False'), type=str,
+        help="Keep polling the projects & extract new steps until all steps of all projects are complete.")
+    parser.add_argument(
+        "--poll_seconds", default='30', type=float,
+        help="follow=True: seconds between checks for newly completed steps.")
+    parser.add_argument(
+        "--max_workers", default='0', type=int,
+        help="Number of processes that read .vtu files at the same time. 0 = number of CPU cores.")
+    parser.add_argument(
+        "--hold_window", default='True', choices=('True', 'False'), type=str,
+        help="Wait for Enter at the end (keeps the Windows command-line window open).")
+
+    args = vars(parser.parse_args())
+    return args
+
+
+# END create_cli
+
+
+def main(start_path='False', probes_file=probes_file_name, field='pressure wave', follow=False, poll_seconds=30,
+         max_workers=0, hold_window=True):
+    follow = str(follow) == 'True'
+    hold_window = str(hold_window) == 'True'
+    field = field.strip().lower()
+
+    if start_path == 'False':
+        start_path = os.path.dirname(os.path.realpath(__file__))
+    if max_workers <= 0:
+        max_workers = os.cpu_count() or 1
+
+    projects = find_projects(start_path)
+    if len(projects) == 0:
+        print('ERROR - no projects ("' + main_frequencies_to_simulate + '" files) found in "' + start_path + '"')
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as pool:
+            while True:
+                steps_left = 0
+                for project_folder in projects:
+                    steps_left += extract_project(project_folder, start_path, probes_file, field, pool)
+                if not follow or steps_left == 0:
+                    break
+                print('   ... waiting for', str(steps_left), 'steps to complete   [',
+                      time.strftime("%d %b - %H:%M:%S", time.localtime()), ']')
+                time.sleep(poll_seconds)
+        print('\n-------READY - probe results are in the "' + probes_dir + '" folder of each project')
+
+    if hold_window:
+        # hold Windows command-line window open:
+        input('Hit >>> ENTER <<< to EXIT   ')
+
+
+# END main
+
+
+# function to find all project folders (with a frequency file) in a folder & its sub-folders. The folder of a sweep is
+# not a project itself (see elmer_scan_manager.py) - only its "sweep_ " sub-folders are.
+def find_projects(start_path):
+    projects = []
+    for folder, sub_folders, files in os.walk(start_path):
+        if main_frequencies_to_simulate in files and sweep_spec_file not in files:
+            projects.append(folder)
+    return sorted(projects)
+
+
+# END find_projects
+
+
+# function to find the probes file of a project: in the project folder OR in a folder above it (up to start_path)
+def find_probes_file(project_folder, start_path, probes_file):
+    if os.path.isabs(probes_file):
+        return probes_file if os.path.isfile(probes_file) else None
+    folder = os.path.abspath(project_folder)
+    while True:
+        if os.path.isfile(os.path.join(folder, probes_file)):
+            return os.path.join(folder, probes_file)
+        if folder == os.path.abspath(start_path) or os.path.dirname(folder) == folder:
+            return None
+        folder = os.path.dirname(folder)
+
+
+# END find_probes_file
+
+
+# function to read the probes file: (names, coordinates as an array [probe, xyz])
+def read_probes(probes_path):
+    names = []
+    coordinates = []
+    with open(probes_path, 'r') as contents:
+        for line in contents.readlines():
+            values = line.replace(',', ' ').replace(';', ' ').split()
+            if len(values) == 0 or values[0].startswith('#'):
+                continue  # empty lines & comments are OK - just skip
+            if len(values) == 3:
+                names.append('probe_' + str(len(names) + 1))
+            elif len(values) == 4:
+                names.append(values[0])
+                values = values[1:]
+            else:
+                raise Exception('incompatible ' + probes_path + ' file! (rows "name x y z" or "x y z" expected)')
+            coordinates.append([float(value) for value in values])
+    return names, np.array(coordinates, dtype=float).reshape(-1, 3)
+
+
+# END read_probes
+
+
+# function to read the steps & frequencies of a project (the same format as elmer_scan_manager.py: one column with
+# frequencies OR two columns with step number & frequency)
+def read_frequencies(project_folder):
+    steps = []
+    frequencies = []
+    with open(os.path.join(project_folder, main_frequencies_to_simulate), 'r') as contents:
+        for line in contents.readlines():
+            values = line.split()
+            if len(values) == 1:
+                steps.append(len(steps) + 1)
+                frequencies.append(float(values[0].replace(',', '.')))
+            elif len(values) == 2:
+                steps.append(int(values[0]))
+                frequencies.append(float(values[1].replace(',', '.')))
+    return steps, frequencies
+
+
+# END read_frequencies
+
+
+# function to extract the probes of all completed steps of one project that were not extracted before. The results
+# are saved after every finished job (incrementally). Returns the number of steps that are not yet complete.
+def extract_project(project_folder, start_path, probes_file, field, pool):
+    probes_path = find_probes_file(project_folder, start_path, probes_file)
+    if probes_path is None:
+        print('NOTE - no "' + probes_file + '" for project "' + project_folder + '" - skipped')
+        return 0
+    names, probes = read_probes(probes_path)
+    results = load_probe_results(project_folder, names, probes)
+
+    steps_left = 0
+    to_extract = {}  # step: (frequency, .vtu file, modification time)
+    for step, frequency in zip(*read_frequencies(project_folder)):
+        vtu_path = os.path.join(project_folder, post_file + str(step).zfill(4) + '.vtu')
+        if not os.path.isfile(os.path.join(project_folder, freq_file + str(step) + freq_file_ext)) or \
+                not os.path.isfile(vtu_path):
+            steps_left += 1  # (the completion marker is written after the .vtu file)
+            continue
+        modified = os.stat(vtu_path).st_mtime_ns
+        if step not in results or results[step][2] != modified:
+            to_extract[step] = (frequency, vtu_path, modified)
+    if len(to_extract) == 0:
+        return steps_left
+
+    print('--- Project "' + project_folder + '":', str(len(to_extract)), 'steps to extract at', str(len(names)),
+          'probes')
+    meshes = {}  # mesh key: steps with results on that mesh
+    for step, (frequency, vtu_path, modified) in to_extract.items():
+        meshes.setdefault(vtu_mesh_key(vtu_path), []).append(step)
+    jobs = []
+    for mesh_key, steps in meshes.items():
+        point_ids, weights = probe_weights(project_folder, to_extract[steps[0]][1], mesh_key, probes)
+        for first in range(0, len(steps), steps_per_job):
+            jobs.append(pool.submit(extract_probe_pressures, [(step, to_extract[step][1]) for step in
+                                                              steps[first:first + steps_per_job]],
+                                    point_ids, weights, field))
+    for future in concurrent.futures.as_completed(jobs):
+        for step, pressures in future.result():
+            results[step] = (to_extract[step][0], pressures, to_extract[step][2])
+        save_probe_results(project_folder, names, probes, results)
+    print('   ' + str(len(results)), 'steps extracted ->', os.path.join(project_folder, probes_dir, probe_spl_file))
+    return steps_left
+
+
+# END extract_project
+
+
+# function to load the probe results of earlier runs {step: (frequency, complex pressures, .vtu modification time)}.
+# Results of other probes are not used.
+def load_probe_results(project_folder, names, probes):
+    results = {}
+    pressure_path = os.path.join(project_folder, probes_dir, probe_pressure_file)
+    if os.path.isfile(pressure_path):
+        with np.load(pressure_path) as saved:
+            if list(saved['probe_names']) == names and np.array_equal(saved['probes'], probes):
+                for index, step in enumerate(saved['steps']):
+                    results[int(step)] = (float(saved['frequencies'][index]), saved['pressure'][index],
+                                          int(saved['modified'][index]))
+    return results
+
+
+# END load_probe_results
+
+
+# function to save the probe results of a project (sorted by frequency) as .npz & as SPL table in a .csv file. Both
+# files are written under a temporary name first (readers never see a half-written file).
+def save_probe_results(project_folder, names, probes, results):
+    os.makedirs(os.path.join(project_folder, probes_dir), exist_ok=True)
+    steps = sorted(results, key=lambda step: (results[step][0], step))
+    frequencies = np.array([results[step][0] for step in steps])
+    pressure = np.array([results[step][1] for step in steps], dtype=complex).reshape(len(steps), len(names))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        spl = 20 * np.log10(np.abs(pressure) / reference_pressure)
+
+    pressure_path = os.path.join(project_folder, probes_dir, probe_pressure_file)
+    with open(pressure_path + '.tmp', 'wb') as contents:
+        np.savez(contents, steps=np.array(steps), frequencies=frequencies, pressure=pressure, spl=spl,
+                 modified=np.array([results[step][2] for step in steps], dtype=np.int64),
+                 probe_names=np.array(names), probes=probes)
+    os.replace(pressure_path + '.tmp', pressure_path)
+
+    spl_path = os.path.join(project_folder, probes_dir, probe_spl_file)
+    with open(spl_path + '.tmp', 'w', encoding="utf8", newline="\n") as text_file:
+        text_file.write('frequency,step,' + ','.join(name + ' SPL dB' for name in names) + '\n')
+        for index, step in enumerate(steps):
+            text_file.write(repr(float(frequencies[index])) + ',' + str(step) + ',' +
+                            ','.join('%.3f' % value for value in spl[index]) + '\n')
+    os.replace(spl_path + '.tmp', spl_path)
+
+
+# END save_probe_results
+
+
+# function to read the XML part of a .vtu file (everything before the appended binary data) into a description of
+# its data arrays. Supported: "raw" appended data (as written by ElmerSolver), zlib compressed appended data & ASCII.
+def read_vtu_header(vtu_path):
+    with open(vtu_path, 'rb') as contents:
+        head = b''
+        while True:
+            block = contents.read(65536)
+            head += block
+            appended = head.find(b'<AppendedData')
+            if block == b'' or (appended >= 0 and head.find(b'_', appended) >= 0):
+                break
+    text = head[:appended if appended >= 0 else len(head)].decode('utf8', errors='replace')
+    if 'compressor=' in text and 'vtkZLibDataCompressor' not in text:
+        raise Exception('unsupported compressor in ' + vtu_path + ' (only zlib)')
+
+    header = {'points': int(re.search(r'NumberOfPoints="(\d+)"', text).group(1)),
+              'cells': int(re.search(r'NumberOfCells="(\d+)"', text).group(1)),
+              'byte_order': '>' if 'byte_order="BigEndian"' in text else '<',
+              'size_type': 'Q' if 'header_type="UInt64"' in text else 'I',
+              'compressed': 'vtkZLibDataCompressor' in text,
+              'data_start': head.find(b'_', appended) + 1 if appended >= 0 else -1,
+              'arrays': []}
+    for match in re.finditer(r'<DataArray([^>]*?)(/?)>', text):
+        attributes = dict(re.findall(r'(\w+)="([^"]*)"', match.group(1)))
+        section = max(('<PointData', '<CellData', '<Points', '<Cells'),
+                      key=lambda tag: text.rfind(tag, 0, match.start()))  # (the last section tag before the array)
+        array = {'name': attributes.get('Name', '').lower(), 'section': section[1:], 'type': attributes['type'],
+                 'components': int(attributes.get('NumberOfComponents', '1')),
+                 'format': attributes.get('format', 'ascii'), 'offset': int(attributes.get('offset', '0'))}
+        if array['format'] == 'ascii' and match.group(2) == '':
+            array['text'] = re.sub(r'<InformationKey.*?</InformationKey>', ' ',  # (value ranges written by VTK)
+                                   text[match.end():text.find('</DataArray>', match.end())], flags=re.DOTALL)
+        elif array['format'] != 'appended':
+            raise Exception('unsupported ' + array['format'] + ' data in ' + vtu_path + ' (appended OR ascii)')
+        header['arrays'].append(array)
+    return header
+
+
+# END read_vtu_header
+
+
+# function to read one data array of a .vtu file (as [value] OR [value, component]). Raw appended data is used
+# in place from the memory-mapped file (zero-copy): with "rows" only these values are read from the disk.
+def read_vtu_array(header, mapped, array, rows=None):
+    dtype = np.dtype(vtk_types[array['type']]).newbyteorder(header['byte_order'])
+    if array['format'] == 'ascii':
+        values = np.array(array['text'].split(), dtype=dtype.newbyteorder('='))
+    else:
+        size_format = header['byte_order'] + header['size_type']
+        size_bytes = struct.calcsize(size_format)
+        position = header['data_start'] + array['offset']
+        if header['compressed']:  # header: number of blocks, block size, last block size, compressed block sizes
+            nr_blocks = struct.unpack_from(size_format, mapped, position)[0]
+            block_sizes = struct.unpack_from(header['byte_order'] + header['size_type'] * nr_blocks, mapped,
+                                             position + 3 * size_bytes)
+            position += (3 + nr_blocks) * size_bytes
+            blocks = []
+            for block_size in block_sizes:
+                blocks.append(zlib.decompress(mapped[position:position + block_size]))
+                position += block_size
+            values = np.frombuffer(b''.join(blocks), dtype=dtype)
+        else:
+            size = struct.unpack_from(size_format, mapped, position)[0]
+            values = np.frombuffer(mapped, dtype=dtype, count=size // dtype.itemsize, offset=position + size_bytes)
+    if array['components'] > 1:
+        values = values.reshape(-1, array['components'])
+    if rows is not None:
+        return values[rows]  # (a copy of the rows only)
+    return np.array(values)  # (a copy: the file is closed afterwards)
+
+
+# END read_vtu_array
+
+
+# function to identify the mesh of a .vtu file: number of points & cells + a hash of the beginning of the point
+# coordinates (steps solved on the same mesh share the probe locations)
+def vtu_mesh_key(vtu_path):
+    header = read_vtu_header(vtu_path)
+    points = [array for array in header['arrays'] if array['section'] == 'Points'][0]
+    if points['format'] == 'ascii':
+        sample = points['text'][:65536].encode('utf8')
+    else:
+        with open(vtu_path, 'rb') as contents:
+            contents.seek(header['data_start'] + points['offset'])
+            sample = contents.read(65536)
+    return str(header['points']) + '_' + str(header['cells']) + '_' + '%08x' % zlib.crc32(sample)
+
+
+# END vtu_mesh_key
+
+
+# function to get the point ids & interpolation weights of the probes in the mesh of a .vtu file: from the cache of
+# the project if the same probes were located in the same mesh before, otherwise located now (& cached)
+def probe_weights(project_folder, vtu_path, mesh_key, probes):
+    probes_hash = hashlib.sha256(probes.tobytes()).hexdigest()[:10]
+    cache_path = os.path.join(project_folder, probes_dir, probe_weights_prefix + mesh_key + '_' + probes_hash + '.npz')
+    if os.path.isfile(cache_path):
+        with np.load(cache_path) as cached:
+            return cached['point_ids'], cached['weights']
+
+    header = read_vtu_header(vtu_path)
+    with open(vtu_path, 'rb') as contents, mmap.mmap(contents.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        mesh = {}
+        for array in header['arrays']:
+            if array['section'] == 'Points':
+                mesh['points'] = read_vtu_array(header, mapped, array).reshape(-1, 3).astype(float)
+            elif array['section'] == 'Cells' and array['name'] in ('connectivity', 'offsets', 'types'):
+                mesh[array['name']] = read_vtu_array(header, mapped, array).astype(np.int64)
+    index = build_simplex_index(mesh['points'], mesh['connectivity'], mesh['offsets'], mesh['types'])
+    point_ids, weights = locate_probes(index, mesh['points'], probes)
+    outside = int(np.sum(np.isnan(weights[:, 0])))
+    print('   probes located in mesh', mesh_key, '(' + str(len(index['simplices'])), 'simplices)' +
+          ('' if outside == 0 else '  WARNING - ' + str(outside) + ' probes are outside of the mesh'))
+
+    os.makedirs(os.path.join(project_folder, probes_dir), exist_ok=True)
+    with open(cache_path + '.tmp', 'wb') as contents:
+        np.savez(contents, point_ids=point_ids, weights=weights)
+    os.replace(cache_path + '.tmp', cache_path)
+    return point_ids, weights
+
+
+# END probe_weights
+
+
+# function to split all cells of the mesh into simplices (tetrahedra, OR triangles of a 2D mesh) & sort them by the
+# lower x of their bounding boxes: the simplices around a point are then found by binary search (spatial index)
+def build_simplex_index(points, connectivity, offsets, types):
+    starts = np.concatenate(([0], offsets[:-1]))
+    dimension = 3 if any(cell_simplices[a_type][0] == 3 for a_type in np.unique(types) if a_type in cell_simplices) \
+        else 2
+    simplices = []
+    for cell_type, (cell_dimension, corners) in cell_simplices.items():
+        cells = np.nonzero(types == cell_type)[0]
+        if cell_dimension != dimension or len(cells) == 0:
+            continue
+        nodes = connectivity[starts[cells][:, None] + np.arange(max(max(corner) for corner in corners) + 1)]
+        simplices += [nodes[:, list(corner)] for corner in corners]
+    if len(simplices) == 0:
+        raise Exception('no supported cells (tetrahedra, hexahedra, wedges, pyramids, triangles, quads) in the mesh')
+    simplices = np.concatenate(simplices)
+    corner_coordinates = points[:, :dimension][simplices]
+    lower = corner_coordinates.min(axis=1)
+    upper = corner_coordinates.max(axis=1)
+    order = np.argsort(lower[:, 0], kind='stable')
+    return {'dimension': dimension, 'simplices': simplices[order], 'lower': lower[order], 'upper': upper[order],
+            'max_width': float(np.max(upper[:, 0] - lower[:, 0]))}
+
+
+# END build_simplex_index
+
+
+# function to find the simplex of each probe & its barycentric coordinates (= linear interpolation weights of its
+# corner points). Returns (point ids [probe, corner], weights [probe, corner]) - NaN weights for probes outside.
+def locate_probes(index, points, probes):
+    dimension = index['dimension']
+    point_ids = np.zeros((len(probes), dimension + 1), dtype=np.int64)
+    weights = np.full((len(probes), dimension + 1), np.nan)
+    tolerance = 1e-9 * max(index['max_width'], 1e-30)
+    for number, probe in enumerate(probes[:, :dimension]):
+        # candidates: simplices with lower x in [x - widest simplex, x] & a bounding box around the probe
+        first = np.searchsorted(index['lower'][:, 0], probe[0] - index['max_width'] - tolerance, 'left')
+        last = np.searchsorted(index['lower'][:, 0], probe[0] + tolerance, 'right')
+        candidates = np.arange(first, last)
+        candidates = candidates[np.all((index['lower'][candidates] <= probe + tolerance) &
+                                       (index['upper'][candidates] >= probe - tolerance), axis=1)]
+        corners = points[:, :dimension][index['simplices'][candidates]]
+        edges = (corners[:, 1:] - corners[:, :1]).transpose(0, 2, 1)  # [simplex, xyz, edge]
+        regular = np.abs(np.linalg.det(edges)) > 1e-12 * index['max_width'] ** dimension
+        if not np.any(regular):
+            continue  # outside of the mesh
+        local = np.linalg.solve(edges[regular], (probe - corners[regular, 0])[:, :, None])[:, :, 0]
+        barycentric = np.concatenate((1 - local.sum(axis=1, keepdims=True), local), axis=1)
+        best = np.argmax(barycentric.min(axis=1))  # the simplex that contains the probe the most
+        if barycentric[best].min() >= -1e-6:
+            point_ids[number] = index['simplices'][candidates[regular][best]]
+            weights[number] = barycentric[best]
+    return point_ids, weights
+
+
+# END locate_probes
+
+
+# function (worker process) to interpolate the complex pressure at the probes from the .vtu files of some steps.
+# Returns [(step, complex pressure of each probe)]
+def extract_probe_pressures(vtu_files, point_ids, weights, field):
+    results = []
+    for step, vtu_path in vtu_files:
+        header = read_vtu_header(vtu_path)
+        point_data = dict((array['name'], array) for array in header['arrays'] if array['section'] == 'PointData')
+        with open(vtu_path, 'rb') as contents, mmap.mmap(contents.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            if field + ' 1' in point_data:  # real & imaginary part as separate arrays
+                real = read_vtu_array(header, mapped, point_data[field + ' 1'], point_ids.ravel())
+                imaginary = np.zeros(len(real))
+                if field + ' 2' in point_data:
+                    imaginary = read_vtu_array(header, mapped, point_data[field + ' 2'], point_ids.ravel())
+            elif field in point_data:  # one array with (real, imaginary) components
+                values = read_vtu_array(header, mapped, point_data[field], point_ids.ravel())
+                real = values if values.ndim == 1 else values[:, 0]
+                imaginary = np.zeros(len(real)) if values.ndim == 1 else values[:, 1]
+            else:
+                raise Exception('no point data "' + field + '" in ' + vtu_path + ' (available: ' +
+                                ', '.join(point_data) + ')')
+        pressure = (real.astype(float) + 1j * imaginary.astype(float)).reshape(point_ids.shape)
+        results.append((step, np.sum(weights * pressure, axis=1)))
+    return results
+
+
+# END extract_probe_pressures
+
+
+if __name__ == '__main__':
+    main(**create_cli())
+# END __name__
+
+
+# Made for Elmer FEM   https://github.com/elmercsc/elmerfem
+# licensed under the MIT license
@@ -0,0 +1,144 @@
+# Tests of the scheduling of elmer_scan_manager.py WITHOUT Elmer: a fake "ElmerSolver" executable (a Python script
+# first in PATH) writes the same result files as Elmer for the steps of its case.sif.
+#
+# Run from the repository folder:  python -m pytest -q
+
+import os
+import re
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+repository_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, repository_dir)
+
+import benchmark_scan_manager  # noqa: E402 (stand_in_sif: a minimal Scanning project)
+import elmer_scan_manager  # noqa: E402
+
+# fake ElmerSolver: a batch of steps ("$f = [...]") fails after its first step like a not converged Elmer run - the
+# .csv of the batch has only the row of the first step & the exit code is 1. Single steps complete.
+fake_solver = '''
+import sys
+with open('ELMERSOLVER_STARTINFO', 'r') as contents:
+    sif_name = contents.read().split()[0]
+npart = 1
+frequencies = []
+with open(sif_name, 'r') as contents:
+    for line in contents.read().split('\\n'):
+        if line.replace(' ', '').startswith('$npart='):
+            npart = int(line.split('=')[1].split()[0])
+        elif line.replace(' ', '').startswith('$f='):
+            frequencies = [float(value) for value in line.split('=')[1].split('!')[0].strip().strip('[]').split()]
+if len(frequencies) > 1:
+    frequencies = frequencies[:1]
+    exit_code = 1
+else:
+    exit_code = 0
+for index, frequency in enumerate(frequencies):
+    print('      10  1.0000E-10')
+    with open('case_t' + str(npart + index).zfill(4) + '.vtu', 'w') as text_file:
+        text_file.write('fake result')
+with open('case_frequency_' + str(npart) + '.csv.names', 'w') as text_file:
+    text_file.write('Variables in columns of matrix: case_frequency_' + str(npart) + '.csv\\n   1: time\\n'
+                    '   2: res: fake value\\n')
+with open('case_frequency_' + str(npart) + '.csv', 'w') as text_file:
+    text_file.writelines(str(frequency) + ' 1.0\\n' for frequency in frequencies)
+if exit_code != 0:
+    print('ERROR:: IterSolve: Failed convergence tolerances.')
+sys.exit(exit_code)
+'''
+
+
+@pytest.fixture
+def fake_project(tmp_path):
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    (bin_dir / 'ElmerSolver').write_text('#!' + sys.executable + '\n' + fake_solver)
+    os.chmod(str(bin_dir / 'ElmerSolver'), 0o755)
+
+    project = tmp_path / 'project'
+    project.mkdir()
+    (project / 'Scanning_case.sif').write_text(benchmark_scan_manager.stand_in_sif)
+    (project / 'Scanning_FREQUNCIES.txt').write_text(''.join(str(step * 10.0) + '\n' for step in range(1, 7)))
+    (project / 'mesh.elements').write_text('')
+    (project / 'mesh.header').write_text('1000 5000 0\n')
+    # cost records of earlier runs (batches are only formed from predicted wall times)
+    (project / elmer_scan_manager.cost_history_file).write_text(
+        ','.join(elmer_scan_manager.cost_history_columns) + '\n' +
+        ''.join(str(step) + ',' + str(step * 10.0) + ',1000,5000,2,30000000,1.0,1.0,1\n' for step in range(1, 7)))
+    return bin_dir, project
+
+
+# function to run elmer_scan_manager.main() in its own Python process (as from the command line) with the fake
+# ElmerSolver first in PATH. Returns the exit code & the printed output.
+def run_manager(bin_dir, project, options):
+    options = dict(options)
+    options['start_path'] = str(project)
+    environment = dict(os.environ)
+    environment['PATH'] = str(bin_dir) + os.pathsep + environment.get('PATH', '')
+    command = [sys.executable, '-c', 'import sys\nsys.path.insert(0, ' + repr(repository_dir) + ')\n'
+               'import elmer_scan_manager\nelmer_scan_manager.main(**' + repr(options) + ')']
+    manager = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL,
+                             env=environment, timeout=300)
+    return manager.returncode, manager.stdout.decode('utf-8', 'replace')
+
+
+def test_failed_batch_requeues_missing_steps_and_finishes(fake_project):
+    bin_dir, project = fake_project
+    exit_code, output = run_manager(bin_dir, project, {
+        'batch_max_steps': 2, 'isolated_instances': True, 'use_cost_model': True, 'auto_set_max_instances': False,
+        'max_instances': 2, 'sec_to_initialize': 0.1, 'kill_processes_on_overload': False,
+        'cleanup_after_finish': False})
+
+    assert exit_code == 0, output
+    assert '(batch of 2 steps)' in output and 're-tried one by one' in output, output
+    for step in range(1, 7):
+        assert (project / ('case_frequency_' + str(step) + '.csv')).is_file(), output
+    # the steps of a failed batch are counted once: completed (has its row) OR re-queued as a single step
+    for completed, total in re.findall(r'(\d+)/(\d+) completed in', output):
+        assert int(completed) <= int(total) == 6, output
+    assert 'is finished: 6/6' in output, output
+    assert not [name for name in os.listdir(str(project)) if name.startswith('instance_step_')]
+
+
+def test_lease_is_kept_within_clock_margin(tmp_path):
+    entry = {'project': str(tmp_path), 'step': 3}
+    lease_path = str(tmp_path / (elmer_scan_manager.freq_file + '3' + elmer_scan_manager.lease_file_ext))
+    assert elmer_scan_manager.claim_step(entry, 'host_a:1', 10)
+    assert not elmer_scan_manager.claim_step(entry, 'host_b:2', 10)
+
+    # not renewed for longer than lease_seconds, but less than lease_clock_margin more: still held
+    old_time = time.time() - 10 - elmer_scan_manager.lease_clock_margin / 2
+    os.utime(lease_path, (old_time, old_time))
+    assert elmer_scan_manager.step_is_claimed(entry, 10)
+    assert not elmer_scan_manager.claim_step(entry, 'host_b:2', 10)
+
+    # expired: taken over by the other manager, the first one can no longer renew it
+    old_time = time.time() - 10 - elmer_scan_manager.lease_clock_margin - 1
+    os.utime(lease_path, (old_time, old_time))
+    assert not elmer_scan_manager.step_is_claimed(entry, 10)
+    assert elmer_scan_manager.claim_step(entry, 'host_b:2', 10)
+    assert not elmer_scan_manager.renew_step(entry, 'host_a:1')
+    assert elmer_scan_manager.renew_step(entry, 'host_b:2')
+
+
+def test_heartbeat_renews_leases_during_long_task(tmp_path):
+    entry = {'project': str(tmp_path), 'step': 1}
+    lease_path = str(tmp_path / (elmer_scan_manager.freq_file + '1' + elmer_scan_manager.lease_file_ext))
+    assert elmer_scan_manager.claim_step(entry, 'host_a:1', 0.4)
+    old_time = time.time() - 100
+    os.utime(lease_path, (old_time, old_time))
+
+    task_thread = []
+
+    def long_task(seconds):
+        task_thread.append(threading.current_thread())
+        time.sleep(seconds)
+        return 'done'
+
+    assert elmer_scan_manager.run_with_heartbeat(long_task, (0.5,), [entry], 'host_a:1', 0.4) == 'done'
+    assert task_thread[0] is not threading.main_thread()
+    assert time.time() - os.path.getmtime(lease_path) < 1